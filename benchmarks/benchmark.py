@@ -0,0 +1,414 @@
+#
+#  This file is part of the Connection-Set Algebra (CSA).
+#  Copyright (C) 2010,2011,2012 Mikael Djurfeldt
+#
+#  CSA is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  CSA is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Benchmarks of the masks, operators and value sets of CSA
+#
+# Each case builds a connection set with about the given number of
+# connections and measures
+#
+#   build      time to construct the connection set
+#   first      time from the start of iteration to the first connection
+#   time       time to generate all connections in blocks (the
+#              fastest of --repeat runs)
+#   rate       connections per second
+#   peak       peak memory allocated during generation (bytes)
+#   tupleRate  connections per second of iteration over tuples (for
+#              sizes up to --tuple-limit)
+#   unoptimized  time to generate all connections in blocks with the
+#              optimizer disabled (for the cases in optimizerCases and
+#              sizes up to unoptimizedLimit)
+#
+# Results are written as JSON.  With --compare, the rates are
+# compared with those of an earlier result file.
+#
+# Usage:
+#
+#   python benchmarks/benchmark.py [--sizes 10000,100000,1000000]
+#       [--cases PATTERN] [--repeat 3] [--output results.json]
+#       [--compare old.json]
+#
+
+import os
+import sys
+import json
+import math
+import time
+import fnmatch
+import platform
+import argparse
+import tracemalloc
+import random as pyrandom
+
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), '..'))
+
+import numpy
+import csa
+from csa import *
+from csa import _sparse
+from csa import _optimize
+
+seed = 4711
+
+# Number of elements N such that N * N * density connections are
+# produced
+#
+def side (n, density = 1.0):
+    return max (int (math.sqrt (n / density)), 1)
+
+def square (N):
+    return (0, N - 1)
+
+def geometry (n, r):
+    # about N * N * pi * r * r connections for N points in the unit
+    # square
+    N = side (n, math.pi * r * r)
+    g = random2d (N)
+    return (N, euclidMetric2d (g))
+
+
+# Cases
+#
+# Each case is a function of the approximate number of connections
+# returning a finite mask or connection set
+#
+cases = {}
+
+def case (name):
+    def register (f):
+        cases[name] = f
+        return f
+    return register
+
+# Elementary masks
+#
+@case ('elementary/cross')
+def crossCase (n):
+    N = side (n)
+    return cross (square (N), square (N))
+
+@case ('elementary/full')
+def fullCase (n):
+    N = side (n)
+    return cross (square (N), square (N)) * full
+
+@case ('elementary/oneToOne')
+def oneToOneCase (n):
+    return cross (square (n), square (n)) * oneToOne
+
+@case ('elementary/random')
+def randomCase (n):
+    N = side (n, 0.1)
+    return cross (square (N), square (N)) * random (0.1, seed = seed)
+
+@case ('elementary/randomN')
+def randomNCase (n):
+    N = side (n, 0.1)
+    return random (N = n, seed = seed) * cross (square (N), square (N))
+
+@case ('elementary/fanIn')
+def fanInCase (n):
+    N = side (n, 0.1)
+    return random (fanIn = max (n // N, 1), seed = seed) \
+           * cross (square (N), square (N))
+
+@case ('elementary/fanOut')
+def fanOutCase (n):
+    N = side (n, 0.1)
+    return random (fanOut = max (n // N, 1), seed = seed) \
+           * cross (square (N), square (N))
+
+@case ('misc/disc')
+def discCase (n):
+    (N, d) = geometry (n, 0.1)
+    return cross (square (N), square (N)) * (disc (0.1) * d)
+
+@case ('misc/rectangle')
+def rectangleCase (n):
+    (N, d) = geometry (n, 0.1)
+    g = d.geometries[0]
+    return cross (square (N), square (N)) * (rectangle (0.2, 0.15) * g)
+
+@case ('misc/gaussianRandom')
+def gaussianRandomCase (n):
+    (N, d) = geometry (n, 0.1)
+    return cross (square (N), square (N)) * (random * (gaussian (0.1, 0.3) * d))
+
+@case ('misc/randomDisc')
+def randomDiscCase (n):
+    (N, d) = geometry (n / 0.5, 0.1)
+    return cross (square (N), square (N)) * random (0.5, seed = seed) \
+           * (disc (0.1) * d)
+
+# dense random mask and small discs, where the fused mask thins the
+# neighbours
+#
+@case ('misc/randomDiscLocal')
+def randomDiscLocalCase (n):
+    (N, d) = geometry (n / 0.8, 0.01)
+    return cross (square (N), square (N)) * random (0.8, seed = seed) \
+           * (disc (0.01) * d)
+
+@case ('misc/block')
+def blockCase (n):
+    N = side (n, 0.25)
+    return cross (square (N), square (N)) \
+           * (block (10) * cross ((0, N // 10), (0, N // 10))
+              * random (0.25, seed = seed))
+
+@case ('misc/repeat')
+def repeatCase (n):
+    N = side (n, 0.1)
+    return cross (square (N), square (N)) \
+           * (repeat (100) * (cross ((0, 99), (0, 99))
+                              * random (0.1, seed = seed)))
+
+# Operators
+#
+@case ('operator/intersection')
+def intersectionCase (n):
+    N = side (n, 0.1)
+    return cross (square (N), square (N)) * random (0.5, seed = seed) \
+           * random (0.2, seed = seed + 1)
+
+@case ('operator/sparseIntersection')
+def sparseIntersectionCase (n):
+    N = side (n, 0.01)
+    return cross (square (N), square (N)) * random (0.1, seed = seed) \
+           * (fix * (cross (square (N), square (N))
+                     * random (0.1, seed = seed + 1)))
+
+@case ('operator/multisetSum')
+def multisetSumCase (n):
+    N = side (n, 0.1)
+    return cross (square (N), square (N)) * random (0.05, seed = seed) \
+           + cross (square (N), square (N)) * random (0.05, seed = seed + 1)
+
+@case ('operator/difference')
+def differenceCase (n):
+    N = side (n, 0.1)
+    return cross (square (N), square (N)) \
+           * (random (0.2, seed = seed) - random (0.5, seed = seed + 1))
+
+@case ('operator/transpose')
+def transposeCase (n):
+    N = side (n, 0.1)
+    return transpose * (cross (square (N), square (N))
+                        * random (0.1, seed = seed))
+
+@case ('operator/shift')
+def shiftCase (n):
+    N = side (n, 0.1)
+    return shift (10, 20) * (cross (square (N), square (N))
+                             * random (0.1, seed = seed))
+
+@case ('operator/fix')
+def fixCase (n):
+    N = side (n, 0.1)
+    return fix * (cross (square (N), square (N)) * random (0.1, seed = seed))
+
+@case ('operator/partition')
+def partitionCase (n):
+    N = side (n, 0.1)
+    c = cross (square (N), square (N)) * random (0.1, seed = seed)
+    masks = [cross (square (N), (k * N // 4, (k + 1) * N // 4 - 1))
+             for k in range (4)]
+    return partition (c, masks, 1)
+
+# Value sets
+#
+@case ('valueset/constant')
+def constantCase (n):
+    N = side (n, 0.1)
+    return cset (cross (square (N), square (N)) * random (0.1, seed = seed),
+                 1.0, 2.0)
+
+@case ('valueset/function')
+def functionCase (n):
+    N = side (n, 0.1)
+    return cset (cross (square (N), square (N)) * random (0.1, seed = seed),
+                 vset (lambda i, j: i - j))
+
+@case ('valueset/metric')
+def metricCase (n):
+    (N, d) = geometry (n, 0.1)
+    return cset (cross (square (N), square (N)) * (disc (0.1) * d),
+                 d, 2.0 * (gaussian (0.1, 0.3) * d) + 1.0)
+
+
+# Cases which are also measured without the optimizer, showing that
+# its rewrites are no slower
+#
+optimizerCases = ['misc/randomDisc', 'misc/randomDiscLocal']
+unoptimizedLimit = 10000
+
+def measure (c, tupleLimit, repetitions):
+    result = {}
+    start = time.time ()
+    iterator = iter (c)
+    try:
+        next (iterator)
+    except StopIteration:
+        pass
+    result['first'] = time.time () - start
+    del iterator
+
+    times = []
+    for k in range (repetitions):
+        start = time.time ()
+        n = 0
+        for b in _sparse.valueBlocks (c):
+            n += len (b[0])
+        times.append (time.time () - start)
+    result['time'] = min (times)
+    result['connections'] = n
+    result['rate'] = n / max (result['time'], 1e-9)
+
+    tracemalloc.start ()
+    for b in _sparse.valueBlocks (c):
+        pass
+    result['peak'] = tracemalloc.get_traced_memory ()[1]
+    tracemalloc.stop ()
+
+    if n <= tupleLimit:
+        start = time.time ()
+        for x in c:
+            pass
+        result['tupleRate'] = n / max (time.time () - start, 1e-9)
+    return result
+
+def measureUnoptimized (c, repetitions):
+    _optimize.enabled = False
+    try:
+        times = []
+        for k in range (repetitions):
+            start = time.time ()
+            for b in _sparse.valueBlocks (c):
+                pass
+            times.append (time.time () - start)
+    finally:
+        _optimize.enabled = True
+    return min (times)
+
+def xmlRoundTrip (repetitions = 100):
+    from lxml import etree
+    (N, d) = geometry (10000, 0.1)
+    expressions = {
+        'random' : cross (square (100), square (100)) * random (0.1),
+        'randomN' : random (N = 100) * cross (square (100), square (100)),
+        'oneToOne' : cross (square (100), square (100)) * oneToOne,
+        'sum' : cross (square (100), square (100)) * random (0.1)
+                + cross (square (10), square (10)) }
+    results = {}
+    for (name, c) in expressions.items ():
+        start = time.time ()
+        for k in range (repetitions):
+            parseString (etree.tostring (c.to_xml ()))
+        results['xml/' + name] = \
+            { 'time' : (time.time () - start) / repetitions }
+    return results
+
+def run (sizes, pattern, tupleLimit, repetitions):
+    results = []
+    for name in sorted (cases):
+        if not fnmatch.fnmatch (name, pattern):
+            continue
+        for size in sizes:
+            entry = { 'case' : name, 'size' : size }
+            # the geometries and unseeded random masks draw from these
+            pyrandom.seed (seed)
+            numpy.random.seed (seed)
+            try:
+                start = time.time ()
+                c = cases[name] (size)
+                entry['build'] = time.time () - start
+                entry.update (measure (c, tupleLimit, repetitions))
+                if name in optimizerCases and size <= unoptimizedLimit:
+                    entry['unoptimized'] = measureUnoptimized (c,
+                                                               repetitions)
+            except Exception as e:
+                entry['error'] = '%s: %s' % (type (e).__name__, e)
+            report (entry)
+            results.append (entry)
+    if fnmatch.fnmatch ('xml/', pattern) or pattern == '*':
+        try:
+            for (name, entry) in sorted (xmlRoundTrip ().items ()):
+                entry['case'] = name
+                report (entry)
+                results.append (entry)
+        except ImportError as e:
+            print ('skipping xml round-trips: %s' % e)
+    return results
+
+def report (entry):
+    if 'error' in entry:
+        print ('%-32s %9s  %s' % (entry['case'], entry.get ('size', ''),
+                                  entry['error']))
+    elif 'rate' in entry:
+        print ('%-32s %9d %9d conn %9.3f s %12.0f conn/s %9.3f s first %8.1f MB'
+               % (entry['case'], entry['size'], entry['connections'],
+                  entry['time'], entry['rate'], entry['first'],
+                  entry['peak'] / 1e6))
+        if 'unoptimized' in entry:
+            print ('%-32s %9s %14s %9.3f s unoptimized'
+                   % ('', '', '', entry['unoptimized']))
+    else:
+        print ('%-32s %9s %9.6f s' % (entry['case'], '', entry['time']))
+
+def compare (results, old):
+    key = lambda e: (e['case'], e.get ('size'))
+    previous = dict ((key (e), e) for e in old['results'])
+    print ('\n%-32s %9s %10s' % ('case', 'size', 'speed-up'))
+    for entry in results:
+        e = previous.get (key (entry))
+        if e == None or 'error' in e or 'error' in entry:
+            continue
+        ratio = e['time'] / max (entry['time'], 1e-9)
+        print ('%-32s %9s %9.2fx%s' % (entry['case'], entry.get ('size', ''),
+                                       ratio,
+                                       '  SLOWER' if ratio < 0.9 else ''))
+
+def main ():
+    parser = argparse.ArgumentParser (description = 'Benchmark CSA')
+    parser.add_argument ('--sizes', default = '10000,100000,1000000',
+                         help = 'comma-separated numbers of connections')
+    parser.add_argument ('--cases', default = '*',
+                         help = 'glob pattern selecting cases')
+    parser.add_argument ('--tuple-limit', type = int, default = 1000000,
+                         help = 'largest size also iterated over tuples')
+    parser.add_argument ('--repeat', type = int, default = 3,
+                         help = 'repetitions of which the fastest is kept')
+    parser.add_argument ('--output', default = 'benchmark.json',
+                         help = 'JSON file for the results')
+    parser.add_argument ('--compare', help = 'JSON file of earlier results')
+    args = parser.parse_args ()
+    sizes = [int (float (s)) for s in args.sizes.split (',')]
+    results = run (sizes, args.cases, args.tuple_limit, args.repeat)
+    with open (args.output, 'w') as f:
+        json.dump ({ 'csa' : csa.__version__,
+                     'python' : platform.python_version (),
+                     'numpy' : numpy.__version__,
+                     'platform' : platform.platform (),
+                     'date' : time.strftime ('%Y-%m-%dT%H:%M:%S'),
+                     'sizes' : sizes,
+                     'results' : results }, f, indent = 1)
+    if args.compare:
+        with open (args.compare) as f:
+            compare (results, json.load (f))
+
+if __name__ == '__main__':
+    main ()
@@ -0,0 +1,165 @@
+#
+#  This file is part of the Connection-Set Algebra (CSA).
+#  Copyright (C) 2010,2011,2012 Mikael Djurfeldt
+#
+#  CSA is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  CSA is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import numpy
+
+from . import connset as cs
+from . import intervalset as iset
+from . import _elementary
+from . import _sparse
+
+# Load-balanced partitioning
+#
+# The number of connections per target is estimated over bins of the
+# target range: exactly for masks which can count their connections,
+# analytically for masks of known structure and otherwise by counting
+# the connections of a sample of targets in each bin.  The targets
+# are then divided into ranges holding about the same number of
+# connections.
+#
+binsPerPartition = 16
+samplesPerBin = 4
+
+def binEdges (low1, high1, bins):
+    bins = max (1, min (bins, high1 - low1))
+    return low1 + (high1 - low1) * numpy.arange (bins + 1,
+                                                 dtype = numpy.int64) // bins
+
+def setCounts (s, edges):
+    return numpy.diff (s.rank (edges)).astype (numpy.float64)
+
+# Returns the expected number of connections with sources in [low0,
+# high0) for the targets in each bin, or None if unknown
+#
+def expectedCounts (mask, low0, high0, edges):
+    widths = numpy.diff (edges).astype (numpy.float64)
+    if isinstance (mask, cs.IntervalSetMask):
+        return mask.set0.count (low0, high0) * setCounts (mask.set1, edges)
+    elif isinstance (mask, cs.ISetBoundedMask):
+        return boundedCounts (mask.set0, mask.set1, mask.subMask,
+                              low0, high0, edges)
+    elif isinstance (mask, cs.MaskIntersection):
+        for (op1, op2) in [(mask.op1, mask.op2), (mask.op2, mask.op1)]:
+            if isinstance (op1, cs.IntervalSetMask):
+                return boundedCounts (op1.set0, op1.set1, op2,
+                                      low0, high0, edges)
+        counts1 = expectedCounts (mask.op1, low0, high0, edges)
+        counts2 = expectedCounts (mask.op2, low0, high0, edges)
+        if counts1 is None or counts2 is None:
+            return None
+        # assume that the operands are independent
+        area = numpy.maximum ((high0 - low0) * widths, 1.0)
+        return counts1 * counts2 / area
+    elif isinstance (mask, cs.MaskMultisetSum):
+        counts1 = expectedCounts (mask.op1, low0, high0, edges)
+        counts2 = expectedCounts (mask.op2, low0, high0, edges)
+        if counts1 is None or counts2 is None:
+            return None
+        return counts1 + counts2
+    elif isinstance (mask, cs.MaskPartition):
+        return expectedCounts (mask.subMask, low0, high0, edges)
+    elif isinstance (mask, _elementary.OneToOne):
+        counts = numpy.diff (numpy.clip (edges, low0, high0))
+        return counts.astype (numpy.float64)
+    elif isinstance (mask, _elementary.ConstantRandomMask):
+        return min (max (mask.p, 0.0), 1.0) * (high0 - low0) * widths
+    elif isinstance (mask, _elementary.RandomSourcesMask):
+        set0 = mask.mask.set0
+        set1 = mask.mask.set1
+        fraction = set0.count (low0, high0) / float (max (len (set0), 1))
+        if isinstance (mask, _elementary.FanInRandomMask):
+            return fraction * mask.fanIn * setCounts (set1, edges)
+        elif isinstance (mask, _elementary.SampleNRandomMask):
+            return fraction * mask.N * setCounts (set1, edges) \
+                   / max (len (set1), 1)
+    return None
+
+# Expected counts of cross (set0, set1) * mask
+#
+def boundedCounts (set0, set1, mask, low0, high0, edges):
+    low0 = max (low0, set0.min ())
+    if set0.finite ():
+        high0 = min (high0, set0.max () + 1)
+    if high0 <= low0:
+        return numpy.zeros (len (edges) - 1)
+    counts = expectedCounts (mask, low0, high0, edges)
+    if counts is None:
+        return None
+    widths = numpy.maximum (numpy.diff (edges), 1)
+    return counts * set0.count (low0, high0) / float (high0 - low0) \
+           * setCounts (set1, edges) / widths
+
+# Estimates the counts by generating the connections of samplesPerBin
+# targets in each bin
+#
+def sampledCounts (mask, low0, high0, edges):
+    state = cs.State ()
+    obj = mask.startIteration (state)
+    counts = numpy.zeros (len (edges) - 1)
+    for k in range (len (edges) - 1):
+        width = edges[k + 1] - edges[k]
+        samples = numpy.unique (edges[k] + (2 * numpy.arange (samplesPerBin)
+                                            + 1) * width
+                                // (2 * samplesPerBin))
+        n = 0
+        for j in samples.tolist ():
+            for (sources, targets) in obj.blockIterator (low0, high0,
+                                                         j, j + 1, state):
+                n += len (sources)
+        counts[k] = n * width / float (len (samples))
+    return counts
+
+def estimatedCounts (mask, edges):
+    (low0, high0, low1, high1) = mask.bounds ()
+    counts = [mask.count (low0, high0, a, b)
+              for (a, b) in zip (edges[:-1].tolist (), edges[1:].tolist ())]
+    if None not in counts:
+        return numpy.array (counts, dtype = numpy.float64)
+    mask = cs.optimize (mask)
+    counts = expectedCounts (mask, low0, high0, edges)
+    if counts is None:
+        counts = sampledCounts (mask, low0, high0, edges)
+    return counts
+
+# Returns K cross masks dividing the targets of the finite mask or
+# connection set c into ranges with about the same expected number of
+# connections
+#
+def balancedMasks (c, K):
+    mask = _sparse.maskOf (c)
+    assert cs.isFinite (mask), 'expected finite connection-set'
+    (low0, high0, low1, high1) = mask.bounds ()
+    edges = binEdges (low1, high1, binsPerPartition * K)
+    counts = estimatedCounts (mask, edges)
+    cumulative = numpy.concatenate (([0.0], numpy.cumsum (counts)))
+    total = cumulative[-1]
+    cuts = [low1]
+    for k in range (1, K):
+        goal = total * k / K
+        b = min (numpy.searchsorted (cumulative, goal, 'right') - 1,
+                 len (counts) - 1)
+        fraction = (goal - cumulative[b]) / counts[b] if counts[b] > 0 else 0.0
+        cut = int (round (edges[b] + fraction * (edges[b + 1] - edges[b])))
+        cuts.append (min (max (cut, cuts[-1]), high1))
+    cuts.append (max (high1, low1))
+    set0 = iset.IntervalSet ((low0, high0 - 1)) if high0 > low0 \
+           else iset.IntervalSet ([])
+    return [cs.intervalSetMask (set0,
+                                iset.IntervalSet ((start, end - 1))
+                                if end > start else iset.IntervalSet ([]))
+            for (start, end) in zip (cuts[:-1], cuts[1:])]
@@ -0,0 +1,140 @@
+#
+#  This file is part of the Connection-Set Algebra (CSA).
+#  Copyright (C) 2010,2011,2012 Mikael Djurfeldt
+#
+#  CSA is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  CSA is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import collections
+import hashlib
+import types
+import numpy
+
+from .csaobject import CSAObject
+
+# Interning and memoization of results computed from CSA expressions
+#
+# Objects are identified by a structural key, computed from the class
+# and the attributes of the objects of the expression tree, so that
+# identical sub-expressions which were built separately, including
+# the seeds of random masks, have equal keys.  Functions, and other
+# objects which cannot be compared by value, are identified by their
+# id.  Cached results keep their expression alive, so that such ids
+# are not reused while the results are cached.
+#
+# Results are held in a least-recently-used cache, bounded both in the
+# number of results and in their total size, counted in connections
+# or elements.
+#
+maxCachedResults = 64
+maxCachedSize = 2**24
+
+scalarTypes = (type (None), bool, int, float, complex, str, bytes)
+functionTypes = (types.FunctionType, types.BuiltinFunctionType,
+                 types.MethodType)
+
+
+def structuralKey (obj):
+    return keyOf (obj, {})
+
+# Cycles in the object graph are replaced by the distance to the
+# object referred back to, so that the keys of sub-expressions do not
+# depend on where they occur.  Attributes which a class derives from
+# the other attributes, listed in its class attribute
+# derivedAttributes, are not part of the key.
+#
+def keyOf (obj, visiting):
+    if isinstance (obj, scalarTypes):
+        return obj
+    elif isinstance (obj, numpy.generic):
+        return obj.item ()
+    elif isinstance (obj, (list, tuple)):
+        return (type (obj).__name__,) \
+               + tuple (keyOf (x, visiting) for x in obj)
+    elif isinstance (obj, dict):
+        return ('dict',) + tuple ((keyOf (k, visiting), keyOf (v, visiting))
+                                  for (k, v) in obj.items ())
+    elif isinstance (obj, numpy.ndarray) and obj.dtype != object:
+        digest = hashlib.sha1 (numpy.ascontiguousarray (obj)).digest ()
+        return ('ndarray', obj.dtype.str, obj.shape, digest)
+    elif isinstance (obj, functionTypes) or not hasattr (obj, '__dict__') \
+         or isinstance (obj, type):
+        return ('id', id (obj))
+    key = obj.__dict__.get ('_structuralKey')
+    if key != None:
+        return key
+    if id (obj) in visiting:
+        return ('cycle', len (visiting) - visiting[id (obj)])
+    visiting[id (obj)] = len (visiting)
+    derived = getattr (type (obj), 'derivedAttributes', ())
+    key = (type (obj).__name__,) \
+          + tuple ((name, keyOf (value, visiting))
+                   for (name, value) in sorted (vars (obj).items ())
+                   if name != '_structuralKey' and name not in derived)
+    del visiting[id (obj)]
+    if isinstance (obj, CSAObject):
+        obj._structuralKey = key
+    return key
+
+
+class ResultCache (object):
+    def __init__ (self):
+        self.entries = collections.OrderedDict ()
+        self.size = 0
+
+    def clear (self):
+        self.entries.clear ()
+        self.size = 0
+
+    # Returns the entry (obj, result, size) of key, or None
+    #
+    def lookup (self, key):
+        entry = self.entries.get (key)
+        if entry != None:
+            self.entries.move_to_end (key)
+        return entry
+
+    def insert (self, key, entry):
+        if entry[2] > maxCachedSize:
+            return
+        self.entries[key] = entry
+        self.size += entry[2]
+        while len (self.entries) > maxCachedResults \
+              or self.size > maxCachedSize:
+            (_, evicted) = self.entries.popitem (last = False)
+            self.size -= evicted[2]
+
+
+cache = ResultCache ()
+
+def clear ():
+    cache.clear ()
+
+# Returns compute (), or the result cached for an identical obj.  kind
+# and args distinguish different results computed from obj.
+#
+def memoize (kind, obj, args, compute, size = lambda result: 1):
+    key = (kind, structuralKey (obj), args)
+    entry = cache.lookup (key)
+    if entry != None:
+        return entry[1]
+    result = compute ()
+    cache.insert (key, (obj, result, size (result)))
+    return result
+
+# Returns an object identical to obj which was interned earlier, or
+# obj.  Interned objects must not be modified.
+#
+def intern (obj):
+    return memoize ('intern', obj, (), lambda: obj)
@@ -16,12 +16,12 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import random
 import numpy
 import copy
 
 from . import connset as cs
 from . import intervalset as iset
+from . import _rng
 
 from .csaobject import *
 
@@ -52,25 +52,111 @@ class OneToOne (cs.Mask):
         for i in range (max (low0, low1), min (high0, high1)):
             yield (i, i)
 
+    def blockIterator (self, low0, high0, low1, high1, state):
+        for (start, end) in cs.rangeBlocks (max (low0, low1),
+                                            min (high0, high1),
+                                            1):
+            indices = numpy.arange (start, end, dtype = numpy.int64)
+            yield (indices, indices.copy ())
+
+    def count (self, low0, high0, low1, high1):
+        return max (min (high0, high1) - max (low0, low1), 0)
+
+    def transpose (self):
+        return self
+
 
 class ConstantRandomMask (cs.Mask):
     tag = 'randomMask'
     
-    def __init__ (self, p):
+    def __init__ (self, p, seed = None):
         cs.Mask.__init__ (self)
         self.p = p
-        self.state = random.getstate ()
+        self.seed = _rng.makeSeed () if seed == None else seed
+        self.stream = _rng.RandomStream (self.seed, ConstantRandomMask.tag)
         self.name = ConstantRandomMask.tag
 
+    def iterator (self, low0, high0, low1, high1, state):
+        return cs.blocksToIterator (self.blockIterator (low0, high0,
+                                                        low1, high1,
+                                                        state))
+
+    # Sources are divided into tiles of tileSize candidates.  Within
+    # each tile, target j draws the gaps between accepted candidates
+    # from a geometric distribution, so that the cost is proportional
+    # to the number of connections rather than to the number of
+    # candidates.  The gaps of tile t are draws t * 2**32, t * 2**32 + 1,
+    # ... of target j, so every tile can be generated on its own.
+    #
+    # The tile size is chosen so that about expectedPerTile
+    # connections are expected per tile.
+    #
+    expectedPerTile = 64
+
     def startIteration (self, state):
-        random.setstate (self.state)
-        return self
+        obj = copy.copy (self)
+        if 0.0 < self.p < 1.0:
+            obj.tileSize = 1 << max (int (numpy.ceil (numpy.log2 (
+                ConstantRandomMask.expectedPerTile / self.p))), 0)
+            mean = self.p * obj.tileSize
+            obj.roundSize = int (mean + 4.0 * numpy.sqrt (mean)) + 1
+            obj.logq = numpy.log1p (- self.p)
+        return obj
 
-    def iterator (self, low0, high0, low1, high1, state):
-        for j in range (low1, high1):
-            for i in range (low0, high0):
-                if random.random () < self.p:
-                    yield (i, j)
+    def blockIterator (self, low0, high0, low1, high1, state):
+        if high0 <= low0 or self.p <= 0.0:
+            return
+        if self.p >= 1.0:
+            full = cs.IntervalSetMask (iset.N, iset.N)
+            for b in full.blockIterator (low0, high0, low1, high1, state):
+                yield b
+            return
+        T = self.tileSize
+        tiles = numpy.arange (low0 // T, (high0 - 1) // T + 1,
+                              dtype = numpy.int64)
+        for (start, end) in cs.rangeBlocks (low1, high1,
+                                            len (tiles) * self.roundSize):
+            targets = numpy.repeat (numpy.arange (start, end,
+                                                  dtype = numpy.int64),
+                                    len (tiles))
+            pairTiles = numpy.tile (tiles, end - start)
+            (pairs, positions) = self.sampleTiles (targets, pairTiles)
+            sources = pairTiles[pairs] * T + positions
+            targets = targets[pairs]
+            keep = (sources >= low0) & (sources < high0)
+            sources = sources[keep]
+            targets = targets[keep]
+            order = numpy.lexsort ((sources, targets))
+            yield (sources[order], targets[order])
+
+    # Return the accepted positions within the tiles of the (target,
+    # tile) pairs as arrays of pair indices and positions
+    #
+    def sampleTiles (self, targets, tiles):
+        T = self.tileSize
+        b = self.roundSize
+        pairs = numpy.arange (len (targets))
+        offsets = numpy.zeros (len (targets), dtype = numpy.int64)
+        draw = 0
+        resPairs = []
+        resPositions = []
+        while len (pairs):
+            k = (tiles[pairs] << 32)[:, numpy.newaxis] \
+                + numpy.arange (draw, draw + b)
+            u = self.stream.uniform (targets[pairs][:, numpy.newaxis], k)
+            gaps = numpy.minimum (numpy.floor (numpy.log (u) / self.logq), T)
+            positions = offsets[pairs][:, numpy.newaxis] - 1 \
+                        + numpy.cumsum (gaps.astype (numpy.int64) + 1, axis = 1)
+            inside = positions < T
+            (rows, cols) = numpy.nonzero (inside)
+            resPairs.append (pairs[rows])
+            resPositions.append (positions[rows, cols])
+            # pairs with all draws inside the tile need another round
+            more = inside[:, -1]
+            offsets[pairs[more]] = positions[more, -1] + 1
+            pairs = pairs[more]
+            draw += b
+        return (numpy.concatenate (resPairs), numpy.concatenate (resPositions))
 
     def repr (self):
         return 'random(%s)' % self.p
@@ -81,17 +167,94 @@ class ConstantRandomMask (cs.Mask):
 registerTag (ConstantRandomMask.tag, ConstantRandomMask, 1)
 
 
+# RandomSourcesMask is the common base of SampleNRandomMask and
+# FanInRandomMask.  Each target j of the underlying FiniteISetMask
+# draws its number of connections, perTarget (j), of sources with
+# replacement.  Draw k of target j is taken from position (j, k) of
+# the random stream, so that partitions of the mask only need to
+# generate their own targets and then select their own sources.
+# Draws are generated in bulk for whole ranges of targets.
+#
+class RandomSourcesMask (cs.Finite, cs.Mask):
+    def __init__ (self, mask, seed, name):
+        cs.Mask.__init__ (self)
+        assert isinstance (mask, cs.FiniteISetMask), \
+               '%s currently only operates on FiniteISetMask:s' \
+               % self.__class__.__name__
+        self.mask = mask
+        self.seed = _rng.makeSeed () if seed == None else seed
+        self.stream = _rng.RandomStream (self.seed, name)
+
+    def bounds (self):
+        return self.mask.bounds ()
+
+    def startIteration (self, state):
+        obj = copy.copy (self)  # local state: N0
+        obj.N0 = len (self.mask.set0)
+        return obj
+
+    # number of connections of each target in the array targets
+    #
+    def perTarget (self, targets):
+        return NotImplemented
+
+    # The connections can only be counted without drawing them if
+    # all sources are within the bounds
+    #
+    def count (self, low0, high0, low1, high1):
+        set0 = self.mask.set0
+        if low0 > set0.min () or high0 <= set0.max ():
+            return None
+        targets = self.mask.set1.boundedArray (low1, high1)
+        obj = self.startIteration (cs.State ())
+        return int (obj.perTarget (targets).sum ())
+
+    def iterator (self, low0, high0, low1, high1, state):
+        return cs.blocksToIterator (self.blockIterator (low0, high0,
+                                                        low1, high1,
+                                                        state))
+
+    def blockIterator (self, low0, high0, low1, high1, state):
+        targets = self.mask.set1.boundedArray (low1, high1)
+        counts = self.perTarget (targets)
+        # split targets into chunks of about blockSize draws
+        ends = numpy.cumsum (counts)
+        splits = numpy.searchsorted (ends,
+                                     numpy.arange (cs.blockSize,
+                                                   ends[-1] if len (ends) else 0,
+                                                   cs.blockSize),
+                                     'right')
+        splits = numpy.unique (numpy.concatenate (([0], splits,
+                                                   [len (targets)])))
+        for (a, b) in zip (splits[:-1], splits[1:]):
+            (sources, js) = self.sample (targets[a:b], counts[a:b])
+            keep = (sources >= low0) & (sources < high0)
+            yield (sources[keep], js[keep])
+
+    # Draw the sources of the given targets and return them as
+    # arrays of sources and targets sorted in post-order
+    #
+    def sample (self, targets, counts):
+        js = numpy.repeat (targets, counts)
+        starts = numpy.cumsum (counts) - counts
+        k = numpy.arange (len (js)) - numpy.repeat (starts, counts)
+        sources = self.mask.set0.select (self.stream.integers (self.N0, js, k))
+        order = numpy.lexsort ((sources, js))
+        return (sources[order], js[order])
+
+
 class SampleNRandomOperator (cs.Operator):
     tag = 'random_N'
     
-    def __init__ (self, N):
+    def __init__ (self, N, seed = None):
         self.N = N
+        self.seed = seed
 
     def __mul__ (self, other):
         assert isinstance (other, cs.Finite) \
                and isinstance (other, cs.Mask), \
                'expected finite mask'
-        return SampleNRandomMask (self.N, other)
+        return SampleNRandomMask (self.N, other, self.seed)
 
     def repr (self):
         return 'random(N = %s)' % self.N
@@ -102,82 +265,28 @@ class SampleNRandomOperator (cs.Operator):
 registerTag (SampleNRandomOperator.tag, SampleNRandomOperator, 1)
 
 
-class SampleNRandomMask (cs.Finite,cs.Mask):
+class SampleNRandomMask (RandomSourcesMask):
     # The algorithm based on first sampling the number of connections
     # per partition has been arrived at through discussions with Hans
     # Ekkehard Plesser.
     #
-    def __init__ (self, N, mask):
-        cs.Mask.__init__ (self)
+    # The number of connections per target is drawn from a
+    # multinomial distribution over all targets of the mask.
+    #
+    def __init__ (self, N, mask, seed = None):
+        RandomSourcesMask.__init__ (self, mask, seed,
+                                    SampleNRandomOperator.tag)
         self.N = N
-        assert isinstance (mask, cs.FiniteISetMask), \
-               'SampleNRandomMask currently only operates on FiniteISetMask:s'
-        self.mask = mask
-        self.randomState = random.getstate ()
-        self.npRandomState = numpy.random.get_state ()
-
-    def bounds (self):
-        return self.mask.bounds ()
 
     def startIteration (self, state):
-        obj = copy.copy (self)  # local state: N, N0, perTarget, sources
-        random.setstate (self.randomState)
-        obj.isPartitioned = False
-        if 'partitions' in state:
-            obj.isPartitioned = True
-            partitions = list (map (self.mask.intersection, state['partitions']))
-            sizes = list (map (len, partitions))
-            total = sum (sizes)
-            
-            # The following yields the same result on all processes.
-            # We should add a seed function to the CSA.
-            if 'seed' in state:
-                seed = state['seed']
-            else:
-                seed = 'SampleNRandomMask'
-            # Numpy requires an unsigned 32-bit integer
-            numpy.random.seed (hash (seed) % (numpy.iinfo(numpy.uint32).max + 1))
-            N = numpy.random.multinomial (self.N, numpy.array (sizes) \
-                                           / float (total))
-            obj.N = N[state['selected']]
-            obj.mask = partitions[state['selected']]
-            assert isinstance (obj.mask, cs.FiniteISetMask), \
-                   'SampleNRandomMask iterator only handles finite IntervalSetMask partitions'
-        obj.mask = obj.mask.startIteration (state)
-        obj.N0 = len (obj.mask.set0)
-        obj.lastBound0 = False
-        N1 = len (obj.mask.set1)
-        numpy.random.set_state (self.npRandomState)
-        obj.perTarget = numpy.random.multinomial (obj.N, [1.0 / N1] * N1)
+        obj = RandomSourcesMask.startIteration (self, state)
+        N1 = len (self.mask.set1)
+        obj.counts = self.stream.generator ('perTarget').multinomial (
+            self.N, numpy.full (N1, 1.0 / N1))
         return obj
 
-    def iterator (self, low0, high0, low1, high1, state):
-        m = self.mask.set1.count (0, low1)
-        
-        if self.isPartitioned and m > 0:
-            # "replacement" for a proper random.jumpahead (n)
-            # This is required so that different partitions of this
-            # mask aren't produced using the same stream of random
-            # numbers.
-            random.seed (random.getrandbits (32) + m)
-            
-        if self.lastBound0 != (low0, high0):
-            self.lastBound0 = (low0, high0)
-            self.sources = []
-            for i in self.mask.set0.boundedIterator (low0, high0):
-                self.sources.append (i)
-
-        nSources = len (self.sources)
-        for j in self.mask.set1.boundedIterator (low1, high1):
-            s = []
-            for k in range (0, self.perTarget[m]):
-                i = random.randint (0, self.N0 - 1)
-                if i < nSources:
-                    s.append (self.sources[i])
-            s.sort ()
-            for i in s:
-                yield (i, j)
-            m += 1
+    def perTarget (self, targets):
+        return self.counts[self.mask.set1.rank (targets)]
 
     def repr (self):
         return self._repr_applyop ('random(N=%s)' % self.N, self.mask)
@@ -192,14 +301,15 @@ class SampleNRandomMask (cs.Finite,cs.Mask):
 class FanInRandomOperator (cs.Operator):
     tag = 'random_fanIn'
     
-    def __init__ (self, fanIn):
+    def __init__ (self, fanIn, seed = None):
         self.fanIn = fanIn
+        self.seed = seed
 
     def __mul__ (self, other):
         assert isinstance (other, cs.Finite) \
                and isinstance (other, cs.Mask), \
                'expected finite mask'
-        return FanInRandomMask (self.fanIn, other)
+        return FanInRandomMask (self.fanIn, other, self.seed)
 
     def repr (self):
         return 'random(fanIn=%s)' % self.fanIn
@@ -210,90 +320,13 @@ class FanInRandomOperator (cs.Operator):
 registerTag (FanInRandomOperator.tag, FanInRandomOperator, 1)
 
 
-# This code is copied and modified from SampleNRandomMask
-# *fixme* refactor code and eliminate code duplication
-class FanInRandomMask (cs.Finite, cs.Mask):
-    # The algorithm based on first sampling the number of connections
-    # per partition has been arrived at through discussions with Hans
-    # Ekkehard Plesser.
-    #
-    def __init__ (self, fanIn, mask):
-        cs.Mask.__init__ (self)
+class FanInRandomMask (RandomSourcesMask):
+    def __init__ (self, fanIn, mask, seed = None):
+        RandomSourcesMask.__init__ (self, mask, seed, FanInRandomOperator.tag)
         self.fanIn = fanIn
-        assert isinstance (mask, cs.FiniteISetMask), \
-               'FanInRandomMask currently only operates on FiniteISetMask:s'
-        self.mask = mask
-        self.randomState = random.getstate ()
 
-    def bounds (self):
-        return self.mask.bounds ()
-
-    def startIteration (self, state):
-        obj = copy.copy (self)  # local state: N, N0, perTarget, sources
-        random.setstate (self.randomState)
-        obj.isPartitioned = False
-        if 'partitions' in state:
-            obj.isPartitioned = True
-            partitions = list (map (self.mask.intersection, state['partitions']))
-            
-            # The following yields the same result on all processes.
-            # We should add a seed function to the CSA.
-            if 'seed' in state:
-                seed = state['seed']
-            else:
-                seed = 'FanInRandomMask'
-            # Numpy.random.seed requires an unsigned 32 bit integer
-            numpy.random.seed (hash (seed) % (numpy.iinfo(numpy.uint32).max + 1))
-
-            selected = state['selected']
-            obj.mask = partitions[selected]
-            assert isinstance (obj.mask, cs.FiniteISetMask), \
-                   'FanInRandomMask iterator only handles finite IntervalSetMask partitions'
-        obj.mask = obj.mask.startIteration (state)
-        obj.N0 = len (obj.mask.set0)
-        obj.lastBound0 = False
-        if obj.isPartitioned:
-            obj.perTarget = []
-            for j in obj.mask.set1:
-                size = 0
-                sourceDist = numpy.zeros (len (partitions))
-                for k in range (len (partitions)):
-                    if j in partitions[k].set1:
-                        sourceDist[k] = len (partitions[k].set0)
-                sourceDist /= sum (sourceDist)
-                dist = numpy.random.multinomial (self.fanIn, sourceDist)
-                obj.perTarget.append (dist[selected])
-        else:
-            obj.perTarget = [self.fanIn] * len (obj.mask.set1)
-        return obj
-
-    def iterator (self, low0, high0, low1, high1, state):
-        m = self.mask.set1.count (0, low1)
-        
-        if self.isPartitioned and m > 0:
-            # "replacement" for a proper random.jumpahead (n)
-            # This is required so that different partitions of this
-            # mask aren't produced using the same stream of random
-            # numbers.
-            random.seed (random.getrandbits (32) + m)
-            
-        if self.lastBound0 != (low0, high0):
-            self.lastBound0 = (low0, high0)
-            self.sources = []
-            for i in self.mask.set0.boundedIterator (low0, high0):
-                self.sources.append (i)
-
-        nSources = len (self.sources)
-        for j in self.mask.set1.boundedIterator (low1, high1):
-            s = []
-            for k in range (0, self.perTarget[m]):
-                i = random.randint (0, self.N0 - 1)
-                if i < nSources:
-                    s.append (self.sources[i])
-            s.sort ()
-            for i in s:
-                yield (i, j)
-            m += 1
+    def perTarget (self, targets):
+        return numpy.full (len (targets), self.fanIn, dtype = numpy.int64)
 
     def repr (self):
         return self._repr_applyop ('random(fanIn=%s)' % self.fanIn, self.mask)
@@ -308,14 +341,16 @@ class FanInRandomMask (cs.Finite, cs.Mask):
 class FanOutRandomOperator (cs.Operator):
     tag = 'random_fanOut'
     
-    def __init__ (self, fanOut):
+    def __init__ (self, fanOut, seed = None):
         self.fanOut = fanOut
+        self.seed = seed
 
     def __mul__ (self, other):
         assert isinstance (other, cs.Finite) \
                and isinstance (other, cs.Mask), \
                'expected finite mask'
-        return FanInRandomMask (self.fanOut, other.transpose ()).transpose ()
+        return FanInRandomMask (self.fanOut, other.transpose (),
+                                self.seed).transpose ()
 
     def repr (self):
         return 'random(fanOut=%s)' % self.fanOut
@@ -17,13 +17,15 @@
 #
 
 import math
-import random
 import copy
-#from scipy.spatial import KDTree
+import numpy
 
 from . import connset as cs
 from . import valueset as vs
 from . import _elementary
+from . import _rng
+from . import _spatial
+from . import _cache
 
 from .csaobject import *
 
@@ -31,40 +33,65 @@ class Random (cs.Operator):
     def __mul__ (self, valueSet):
         return ValueSetRandomMask (valueSet)
     
-    def __call__ (self, p = None, N = None, fanIn = None, fanOut = None):
+    def __call__ (self, p = None, N = None, fanIn = None, fanOut = None,
+                  seed = None):
         if p != None:
             assert N == None and fanIn == None and fanOut == None, \
                    'inconsistent parameters'
-            return _elementary.ConstantRandomMask (p)
+            return _elementary.ConstantRandomMask (p, seed)
         elif N != None:
             assert fanIn == None and fanOut == None, \
                    'inconsistent parameters'
-            return _elementary.SampleNRandomOperator (N)
+            return _elementary.SampleNRandomOperator (N, seed)
         elif fanIn != None:
             assert fanOut == None, \
                    'inconsistent parameters'
-            return _elementary.FanInRandomOperator (fanIn)
+            return _elementary.FanInRandomOperator (fanIn, seed)
         elif fanOut != None:
-            return _elementary.FanOutRandomOperator (fanOut)
+            return _elementary.FanOutRandomOperator (fanOut, seed)
         assert False, 'inconsistent parameters'
 
 
 class ValueSetRandomMask (cs.Mask):
-    def __init__ (self, valueSet):
+    def __init__ (self, valueSet, seed = None):
         cs.Mask.__init__ (self)
         self.valueSet = valueSet
-        self.state = random.getstate ()
-
-    def startIteration (self, state):
-        random.setstate (self.state)
-        return self
+        self.seed = _rng.makeSeed () if seed == None else seed
+        self.stream = _rng.RandomStream (self.seed, 'valueSetRandomMask')
+        self.sparse = isinstance (valueSet, vs.ValueSet) \
+                      and valueSet.hasSupport ()
 
     def iterator (self, low0, high0, low1, high1, state):
+        if self.sparse:
+            return cs.blocksToIterator (self.blockIterator (low0, high0,
+                                                            low1, high1,
+                                                            state))
+        return self.scanIterator (low0, high0, low1, high1, state)
+
+    def scanIterator (self, low0, high0, low1, high1, state):
+        sources = numpy.arange (low0, high0, dtype = numpy.int64)
         for j in range (low1, high1):
+            draws = self.stream.uniform (j, sources).tolist ()
             for i in range (low0, high0):
-                if random.random () < self.valueSet (i, j):
+                if draws[i - low0] < self.valueSet (i, j):
                     yield (i, j)
 
+    # Only pairs in the support of the value set can be connected
+    #
+    def blockIterator (self, low0, high0, low1, high1, state):
+        if not self.sparse:
+            return cs.Mask.blockIterator (self, low0, high0, low1, high1,
+                                          state)
+        return self.supportBlocks (low0, high0, low1, high1)
+
+    def supportBlocks (self, low0, high0, low1, high1):
+        width = self.valueSet.supportWidth (low0, high0)
+        for targets in targetChunks (low1, high1, width):
+            (sources, targets, values) = \
+                self.valueSet.support (low0, high0, targets)
+            keep = self.stream.uniform (targets, sources) < values
+            yield (sources[keep], targets[keep])
+
     def _to_xml (self):
         return CSAObject.apply ('times', 'random', self.valueSet._to_xml ())
 
@@ -77,6 +104,15 @@ class Disc (cs.Operator):
         return DiscMask (self.r, metric)
 
 
+# Targets in [low1, high1) in chunks for the spatial indices, where
+# width is the expected number of candidate pairs per target, so
+# that each chunk has about blockSize candidates
+#
+def targetChunks (low1, high1, width):
+    for (low, high) in cs.rangeBlocks (low1, high1, int (math.ceil (width))):
+        yield numpy.arange (low, high, dtype = numpy.int64)
+
+
 class DiscMask (cs.Mask):
     def __init__ (self, r, metric):
         cs.Mask.__init__ (self)
@@ -84,12 +120,115 @@ class DiscMask (cs.Mask):
         self.metric = metric
 
     def iterator (self, low0, high0, low1, high1, state):
+        if _spatial.isIndexableMetric (self.metric):
+            return cs.blocksToIterator (self.blockIterator (low0, high0,
+                                                            low1, high1,
+                                                            state))
+        return self.scanIterator (low0, high0, low1, high1, state)
+
+    def blockIterator (self, low0, high0, low1, high1, state):
+        if not _spatial.isIndexableMetric (self.metric):
+            return cs.Mask.blockIterator (self, low0, high0, low1, high1,
+                                          state)
+        return self.neighbourBlocks (low0, high0, low1, high1)
+
+    def neighbourBlocks (self, low0, high0, low1, high1):
+        width = _spatial.expectedNeighbourCandidates (self.metric, self.r,
+                                                      low0, high0)
+        for targets in targetChunks (low1, high1, width):
+            (sources, targets, distances) = \
+                _spatial.neighbours (self.metric, self.r, low0, high0, targets)
+            yield (sources, targets)
+
+    def scanIterator (self, low0, high0, low1, high1, state):
         for j in range (low1, high1):
             for i in range (low0, high0):
                 if self.metric (i, j) < self.r:
                     yield (i, j)
 
 
+# RandomDiscMask is random (p) * disc (r) * metric fused by the
+# optimizer.  The connections are those of the intersection.  Either
+# the candidates of the random mask are tested against the disc, or,
+# if the metric can be indexed and the neighbours are fewer, the
+# neighbours are thinned by the random mask: the tiles of the random
+# mask (see ConstantRandomMask) which contain neighbours of a target
+# are drawn, and the neighbours drawn in them are kept.
+#
+class RandomDiscMask (cs.Mask):
+    def __init__ (self, randomMask, discMask):
+        cs.Mask.__init__ (self)
+        self.randomMask = randomMask
+        self.discMask = discMask
+
+    def repr (self):
+        return 'random(%s)*disc(%s)' % (self.randomMask.p, self.discMask.r)
+
+    def startIteration (self, state):
+        obj = copy.copy (self)
+        obj.randomMask = self.randomMask.startIteration (state)
+        return obj
+
+    def iterator (self, low0, high0, low1, high1, state):
+        return cs.blocksToIterator (self.blockIterator (low0, high0,
+                                                        low1, high1,
+                                                        state))
+
+    def blockIterator (self, low0, high0, low1, high1, state):
+        if 0.0 < self.randomMask.p < 1.0 \
+           and _spatial.isIndexableMetric (self.discMask.metric):
+            # candidates and draws per target of both methods
+            random = self.randomMask
+            width = _spatial.expectedNeighbourCandidates (
+                self.discMask.metric, self.discMask.r, low0, high0)
+            tiles = min (width, (high0 - low0) / random.tileSize + 1)
+            draws = width + tiles * random.roundSize
+            if draws < (high0 - low0) * random.p:
+                return self.thinnedBlocks (low0, high0, low1, high1, draws)
+        return self.testedBlocks (low0, high0, low1, high1, state)
+
+    def testedBlocks (self, low0, high0, low1, high1, state):
+        r = self.discMask.r
+        metric = self.discMask.metric
+        for (sources, targets) in self.randomMask.blockIterator (low0, high0,
+                                                                 low1, high1,
+                                                                 state):
+            keep = vs.evaluate (metric, sources, targets) < r
+            yield (sources[keep], targets[keep])
+
+    # Targets are chunked so that each chunk has about blockSize draws
+    #
+    def thinnedBlocks (self, low0, high0, low1, high1, draws):
+        for (low, high) in cs.rangeBlocks (low1, high1,
+                                           int (math.ceil (draws))):
+            for (sources, targets) in \
+                    self.discMask.neighbourBlocks (low0, high0, low, high):
+                if len (sources):
+                    yield self.thin (sources, targets, low0, high0)
+
+    # Keeps the pairs (sources, targets) drawn by the random mask.
+    # Pairs, and (target, tile) pairs, are numbered relative to the
+    # first target.
+    #
+    def thin (self, sources, targets, low0, high0):
+        random = self.randomMask
+        T = random.tileSize
+        base = targets[0]
+        width = high0 - low0
+        nTiles = width // T + 2
+        tileKeys = numpy.unique ((targets - base) * nTiles
+                                 + sources // T - low0 // T)
+        tileTargets = tileKeys // nTiles + base
+        tiles = tileKeys % nTiles + low0 // T
+        (pairs, positions) = random.sampleTiles (tileTargets, tiles)
+        drawn = tiles[pairs] * T + positions
+        inside = (drawn >= low0) & (drawn < high0)
+        drawnKeys = (tileTargets[pairs][inside] - base) * width \
+                    + (drawn[inside] - low0)
+        keep = numpy.isin ((targets - base) * width + (sources - low0),
+                           drawnKeys)
+        return (sources[keep], targets[keep])
+
 class Rectangle (cs.Operator):
     def __init__ (self, width, height):
         self.width = width
@@ -111,7 +250,40 @@ class RectangleMask (cs.Mask):
         self.g0 = g0
         self.g1 = g1
 
+    def isIndexable (self):
+        return _spatial.isIndexable (self.g0) \
+               and _spatial.isIndexable (self.g1) \
+               and self.g0.dim == 2 and self.g1.dim == 2
+
     def iterator (self, low0, high0, low1, high1, state):
+        if self.isIndexable ():
+            return cs.blocksToIterator (self.blockIterator (low0, high0,
+                                                            low1, high1,
+                                                            state))
+        return self.scanIterator (low0, high0, low1, high1, state)
+
+    def blockIterator (self, low0, high0, low1, high1, state):
+        if not self.isIndexable ():
+            return cs.Mask.blockIterator (self, low0, high0, low1, high1,
+                                          state)
+        return self.neighbourBlocks (low0, high0, low1, high1)
+
+    # The rectangle is contained in the disc through its corners
+    #
+    def neighbourBlocks (self, low0, high0, low1, high1):
+        r = math.sqrt (self.hwidth * self.hwidth + self.hheight * self.hheight)
+        width = _spatial.expectedCandidates (self.g0, low0, high0, r)
+        for targets in targetChunks (low1, high1, width):
+            (sources, targets) = _spatial.candidatePairs (self.g0, self.g1, r,
+                                                          low0, high0, targets)
+            d = self.g0.coordinates (sources) - self.g1.coordinates (targets)
+            keep = (numpy.abs (d[:,0]) < self.hwidth) \
+                   & (numpy.abs (d[:,1]) < self.hheight)
+            (sources, targets) = (sources[keep], targets[keep])
+            order = numpy.lexsort ((sources, targets))
+            yield (sources[order], targets[order])
+
+    def scanIterator (self, low0, high0, low1, high1, state):
         for j in range (low1, high1):
             for i in range (low0, high0):
                 p0 = self.g0 (i)
@@ -129,7 +301,7 @@ class Gaussian (cs.Operator):
         self.cutoff = cutoff
         
     def __mul__ (self, metric):
-        return GaussianValueSet (self, metric)
+        return _cache.intern (GaussianValueSet (self, metric))
 
 
 class GaussianValueSet (OpExprValue, vs.ValueSet):
@@ -143,6 +315,26 @@ class GaussianValueSet (OpExprValue, vs.ValueSet):
         d = self.metric (i, j)
         return math.exp (- d * d / self.sigma22) if d < self.cutoff else 0.0
 
+    def evaluate (self, i, j):
+        d = vs.evaluate (self.metric, i, j)
+        return numpy.where (d < self.cutoff,
+                            numpy.exp (- d * d / self.sigma22),
+                            0.0)
+
+    def hasSupport (self):
+        return _spatial.isIndexableMetric (self.metric)
+
+    # Values are non-zero only within the cutoff
+    #
+    def support (self, low0, high0, targets):
+        (sources, targets, d) = \
+            _spatial.neighbours (self.metric, self.cutoff, low0, high0, targets)
+        return (sources, targets, numpy.exp (- d * d / self.sigma22))
+
+    def supportWidth (self, low0, high0):
+        return _spatial.expectedNeighbourCandidates (self.metric, self.cutoff,
+                                                     low0, high0)
+
 
 class Block (cs.Operator):
     def __init__ (self, M, N):
@@ -152,11 +344,276 @@ class Block (cs.Operator):
     def __mul__ (self, other):
         c = cs.coerceCSet (other)
         if isinstance (c, cs.Mask):
+            if cs.isFinite (c):
+                return FiniteBlockMask (self.M, self.N, c)
             return BlockMask (self.M, self.N, c)
         else:
             return cs.ConnectionSet (BlockCSet (self.M, self.N, c))
 
 
+# Block and repeat expansion
+#
+# The template of block and repeat is generated in blocks of whole
+# target columns, which are expanded with array operations into the
+# connections within the bounds.  The expansions produce arrays
+# (sources, targets, origins) in post-order, where origins holds the
+# index of the template connection of each connection, so that values
+# of the template can be broadcast.
+#
+
+# The state of the template, which does not take part in the
+# partitioning of the expanded mask
+#
+def templateState (state):
+    s = cs.State (state)
+    s.pop ('partitions', None)
+    return s
+
+# Index ranges [bounds[c], bounds[c + 1]) of the columns of a block
+#
+def columnBounds (targets):
+    starts = numpy.flatnonzero (numpy.diff (targets)) + 1
+    return numpy.concatenate (([0], starts, [len (targets)]))
+
+# Yields the rows rows[starts[c]:starts[c] + lengths[c]] of column c =
+# columns[k] for each expanded target targets[k], in chunks of about
+# blockSize connections
+#
+def emitColumns (rows, origins, starts, lengths, columns, targets):
+    sizes = lengths[columns]
+    ends = numpy.cumsum (sizes)
+    k = 0
+    while k < len (targets):
+        e = max (numpy.searchsorted (ends, ends[k] - sizes[k] + cs.blockSize,
+                                     'right'),
+                 k + 1)
+        index = cs.expandRanges (starts[columns[k:e]], sizes[k:e])
+        if len (index):
+            yield (rows[index], numpy.repeat (targets[k:e], sizes[k:e]),
+                   origins[index])
+        k = e
+
+# Template connection (i, j) is expanded into the M x N block of
+# sources [M i, M (i + 1)) and targets [N j, N (j + 1))
+#
+def blockExpansion (M, N, sources, targets, low0, high0, low1, high1):
+    starts = numpy.maximum (M * sources, low0)
+    counts = numpy.maximum (numpy.minimum (M * (sources + 1), high0) - starts, 0)
+    rows = cs.expandRanges (starts, counts)
+    origins = numpy.repeat (numpy.arange (len (sources)), counts)
+    bounds = columnBounds (targets)
+    columnIds = numpy.repeat (numpy.arange (len (bounds) - 1), numpy.diff (bounds))
+    if numpy.any ((numpy.diff (sources) == 0) & (numpy.diff (columnIds) == 0)):
+        # multiple template connections give multiple rows, which are
+        # sorted into adjacent rows
+        order = numpy.lexsort ((rows, numpy.repeat (columnIds, counts)))
+        (rows, origins) = (rows[order], origins[order])
+    offsets = numpy.concatenate (([0], numpy.cumsum (counts)))
+    starts = offsets[bounds[:-1]]
+    lengths = offsets[bounds[1:]] - starts
+    columnTargets = targets[bounds[:-1]]
+    first = numpy.maximum (N * columnTargets, low1)
+    widths = numpy.maximum (numpy.minimum (N * (columnTargets + 1), high1)
+                            - first, 0)
+    return emitColumns (rows, origins, starts, lengths,
+                        numpy.repeat (numpy.arange (len (first)), widths),
+                        cs.expandRanges (first, widths))
+
+# The template connections (i, j) in [0, M) x [0, N) are repeated at
+# (i + a M, j + b N) for all a, b >= 0.  The rows of the columns of
+# the template are built over all source repeats a for groups of
+# targets holding about blockSize connections.  The rows of a column
+# which alone exceeds blockSize are built for chunks of repeats.
+#
+def repeatExpansion (M, N, sources, targets, low0, high0, low1, high1):
+    low0 = max (low0, 0)
+    low1 = max (low1, 0)
+    if high0 <= low0 or high1 <= low1 or len (sources) == 0:
+        return
+    repeats = numpy.arange (low0 // M, (high0 - 1) // M + 1, dtype = numpy.int64)
+    bounds = columnBounds (targets)
+    lengths = numpy.diff (bounds)
+    # the column of each target of the template, or -1
+    column = numpy.full (N, -1, dtype = numpy.int64)
+    column[targets[bounds[:-1]]] = numpy.arange (len (lengths))
+    width = max (1, int (len (repeats) * lengths.mean ()))
+    for (start, end) in cs.rangeBlocks (low1, high1, width):
+        jjs = numpy.arange (start, end, dtype = numpy.int64)
+        columns = column[jjs % N]
+        jjs = jjs[columns >= 0]
+        columns = columns[columns >= 0]
+        sizes = len (repeats) * lengths[columns]
+        ends = numpy.cumsum (sizes)
+        k = 0
+        while k < len (jjs):
+            e = max (numpy.searchsorted (ends, ends[k] - sizes[k] + cs.blockSize,
+                                         'right'),
+                     k + 1)
+            if sizes[k] > cs.blockSize:
+                blocks = repeatedColumn (M, sources, repeats,
+                                         bounds[columns[k]],
+                                         lengths[columns[k]],
+                                         jjs[k], low0, high0)
+            else:
+                blocks = repeatedColumns (M, sources, repeats, bounds, lengths,
+                                          columns[k:e], jjs[k:e], low0, high0)
+            for b in blocks:
+                yield b
+            k = e
+
+# The rows of the template columns columns over all source repeats,
+# for the targets jjs
+#
+def repeatedColumns (M, sources, repeats, bounds, lengths, columns, jjs,
+                     low0, high0):
+    used = numpy.unique (columns)
+    counts = len (repeats) * lengths[used]
+    local = cs.expandRanges (numpy.zeros (len (counts), dtype = numpy.int64),
+                                   counts)
+    columnIds = numpy.repeat (numpy.arange (len (counts)), counts)
+    width = numpy.repeat (lengths[used], counts)
+    origins = numpy.repeat (bounds[used], counts) + local % width
+    rows = M * repeats[local // width] + sources[origins]
+    keep = (rows >= low0) & (rows < high0)
+    (rows, origins) = (rows[keep], origins[keep])
+    usedLengths = numpy.bincount (columnIds[keep], minlength = len (counts))
+    starts = numpy.cumsum (usedLengths) - usedLengths
+    return emitColumns (rows, origins, starts, usedLengths,
+                        numpy.searchsorted (used, columns), jjs)
+
+# The rows of the template connections [start, start + length), which
+# form the column of target jj, in chunks of source repeats
+#
+def repeatedColumn (M, sources, repeats, start, length, jj, low0, high0):
+    step = max (1, cs.blockSize // length)
+    column = numpy.arange (start, start + length)
+    for k in range (0, len (repeats), step):
+        chunk = repeats[k:k + step]
+        rows = (M * chunk[:,numpy.newaxis] + sources[column]).ravel ()
+        origins = numpy.tile (column, len (chunk))
+        keep = (rows >= low0) & (rows < high0)
+        if numpy.any (keep):
+            yield (rows[keep], numpy.full (numpy.count_nonzero (keep), jj),
+                   origins[keep])
+
+# Splits the template indices covering [low, high) into ranges
+# (start, end, n) where each template index of the range expands into
+# n indices within [low, high)
+#
+def blockSegments (low, high, M):
+    low = max (low, 0)
+    if high <= low:
+        return []
+    (first, last) = (low // M, (high - 1) // M)
+    if first == last:
+        return [(first, first + 1, high - low)]
+    segments = [(first, first + 1, M * (first + 1) - low)]
+    if last > first + 1:
+        segments.append ((first + 1, last, M))
+    segments.append ((last, last + 1, high - M * last))
+    return segments
+
+# Number of elements x in [low, high) with x >= 0 and x % M == k for
+# each k in the array ks
+#
+def residueCounts (low, high, M, ks):
+    f = lambda h: numpy.maximum ((max (h, 0) - ks + M - 1) // M, 0)
+    return f (high) - f (low)
+
+
+# Regroups value blocks (sources, targets, values) so that the
+# connections of a target are never split between blocks
+#
+def wholeTargetValueBlocks (blocks):
+    pending = None
+    for block in blocks:
+        if pending != None:
+            block = (numpy.concatenate ((pending[0], block[0])),
+                     numpy.concatenate ((pending[1], block[1])),
+                     [numpy.concatenate ((p, v))
+                      for (p, v) in zip (pending[2], block[2])])
+        targets = block[1]
+        if not len (targets):
+            continue
+        k = numpy.searchsorted (targets, targets[-1])
+        if k:
+            yield (block[0][:k], targets[:k], [v[:k] for v in block[2]])
+        pending = (block[0][k:], targets[k:], [v[k:] for v in block[2]])
+    if pending != None and len (pending[1]):
+        yield pending
+
+
+# The value of the template at the indices (i, j) of the template
+# connection which (i, j) is expanded from
+#
+class TemplateValueSet (vs.ValueSet):
+    def __init__ (self, valueSet, index):
+        vs.ValueSet.__init__ (self)
+        self.valueSet = valueSet
+        self.index = index
+
+    def __call__ (self, i, j):
+        return self.valueSet (*self.index (i, j))
+
+    def evaluate (self, i, j):
+        return vs.evaluate (self.valueSet, *self.index (i, j))
+
+
+# Connection-sets with values expanded from a template connection-set.
+# The values of the template are evaluated once per template
+# connection and broadcast to the expanded connections.  Intersection
+# with a mask keeps the mask as a window, which filters the expanded
+# connections, so that partitions of the connection-set are also
+# expanded from the template.
+#
+class ExpandedCSet (cs.CSet):
+    def __init__ (self, M, N, c, mask):
+        cs.CSet.__init__ (self, mask, *[None for v in c.valueSets])
+        self.M = M
+        self.N = N
+        self.c = c
+        self.window = None
+
+    def makeValueSet (self, k):
+        return TemplateValueSet (cs.coerceValueSet (self.c.value (k)),
+                                 self.templateIndex)
+
+    def intersection (self, other):
+        assert isinstance (other, cs.Mask), 'expected Mask operand'
+        obj = copy.copy (self)
+        obj._mask = self.mask ().intersection (other)
+        if self.window == None:
+            obj.window = other
+        else:
+            obj.window = self.window.intersection (other)
+        return obj
+
+    def startIteration (self, state):
+        obj = copy.copy (self)
+        obj.templateState = templateState (state)
+        obj.template = self.c.startIteration (obj.templateState)
+        if self.window != None:
+            obj.window = self.window.startIteration (state)
+        return obj
+
+    def blockIterator (self, low0, high0, low1, high1, state):
+        for (sources, targets, values) in self.expansion (low0, high0,
+                                                          low1, high1):
+            if not len (targets):
+                continue
+            if self.window != None:
+                window = cs.concatenateBlocks (
+                    self.window.blockIterator (low0, high0,
+                                               int (targets[0]),
+                                               int (targets[-1]) + 1,
+                                               state))
+                (occurrence, count) = cs.blockMultiplicities (
+                    (sources, targets), window)
+                keep = count > 0
+                (sources, targets) = (sources[keep], targets[keep])
+                values = [v[keep] for v in values]
+            yield (sources, targets, values)
+
 class BlockMask (cs.Mask):
     def __init__ (self, M, N, mask):
         cs.Mask.__init__ (self)
@@ -165,48 +622,75 @@ class BlockMask (cs.Mask):
         self.m = mask
 
     def startIteration (self, state):
-        #*fixme* filter out 'partitions' from state
-        nState = {}
-        for k in state:
-            if k != 'partitions':
-                nState[k] = state[k]
-        self.obj = self.m.startIteration (nState)
-        return self
+        obj = copy.copy (self)
+        obj.mState = templateState (state)
+        obj.obj = self.m.startIteration (obj.mState)
+        return obj
 
     def iterator (self, low0, high0, low1, high1, state):
-        maskIter =  self.obj.iterator (low0 // self.M,
-                                       (high0 + self.M - 1) // self.M,
-                                       low1 // self.N,
-                                       (high1 + self.N - 1) // self.N,
-                                       state)
-        try:
-            pre = []
-            (i, j) = next (maskIter)
-            while True:
-                # collect connections in one connection matrix column
-                post = j
-                while j == post:
-                    pre.append (i)
-                    (i, j) = next (maskIter)
-
-                # generate blocks for the column
-                for jj in range (max (self.N * post, low1),
-                                  min (self.N * (post + 1), high1)):
-                    for k in pre:
-                        for ii in range (max (self.M * k, low0),
-                                          min (self.M * (k + 1), high0)):
-                            yield (ii, jj)
-                pre = []
-        except StopIteration:
-            if pre:
-                # generate blocks for the last column
-                for jj in range (max (self.N * post, low1),
-                                  min (self.N * (post + 1), high1)):
-                    for k in pre:
-                        for ii in range (max (self.M * k, low0),
-                                          min (self.M * (k + 1), high0)):
-                            yield (ii, jj)
-
+        return cs.blocksToIterator (self.blockIterator (low0, high0,
+                                                        low1, high1,
+                                                        state))
+
+    def templateBlocks (self, low0, high0, low1, high1):
+        return cs.wholeTargetBlocks (
+            self.obj.blockIterator (low0 // self.M,
+                                    (high0 + self.M - 1) // self.M,
+                                    low1 // self.N,
+                                    (high1 + self.N - 1) // self.N,
+                                    self.mState))
+
+    def blockIterator (self, low0, high0, low1, high1, state):
+        for (sources, targets) in self.templateBlocks (low0, high0,
+                                                       low1, high1):
+            for (s, t, origins) in blockExpansion (self.M, self.N,
+                                                   sources, targets,
+                                                   low0, high0,
+                                                   low1, high1):
+                yield (s, t)
+
+    # Each template connection within a rectangle of the template
+    # contributes the same number of connections, so the count is a
+    # weighted sum of the template counts of at most nine rectangles
+    #
+    def count (self, low0, high0, low1, high1):
+        n = 0
+        for (tLow0, tHigh0, rows) in blockSegments (low0, high0, self.M):
+            for (tLow1, tHigh1, columns) in blockSegments (low1, high1, self.N):
+                k = self.m.count (tLow0, tHigh0, tLow1, tHigh1)
+                if k == None:
+                    return None
+                n += rows * columns * k
+        return n
+
+
+class FiniteBlockMask (cs.Finite, BlockMask):
+    def bounds (self):
+        (low0, high0, low1, high1) = self.m.bounds ()
+        return (self.M * low0, self.M * high0, self.N * low1, self.N * high1)
+
+
+class BlockCSet (ExpandedCSet):
+    def __init__ (self, M, N, c):
+        mask = c.mask ()
+        if cs.isFinite (mask):
+            mask = FiniteBlockMask (M, N, mask)
+        else:
+            mask = BlockMask (M, N, mask)
+        ExpandedCSet.__init__ (self, M, N, c, mask)
+
+    def templateIndex (self, i, j):
+        return (i // self.M, j // self.N)
+
+    def expansion (self, low0, high0, low1, high1):
+        (M, N) = (self.M, self.N)
+        blocks = self.template.blockIterator (low0 // M, (high0 + M - 1) // M,
+                                              low1 // N, (high1 + N - 1) // N,
+                                              self.templateState)
+        for (sources, targets, values) in wholeTargetValueBlocks (blocks):
+            for (s, t, origins) in blockExpansion (M, N, sources, targets,
+                                                   low0, high0, low1, high1):
+                yield (s, t, [v[origins] for v in values])
 
 class Repeat (cs.Operator):
     def __init__ (self, M, N):
@@ -221,9 +705,7 @@ class Repeat (cs.Operator):
             return cs.ConnectionSet (RepeatCSet (self.M, self.N, c))
 
 
-# Not fully implemented
-# Currently only handles cases where we iterate over an even number of
-# ocurrences of the template mask, both with regard to sources and targets
+# The template is the part of the mask within [0, M) x [0, N)
 #
 class RepeatMask (cs.Mask):
     def __init__ (self, M, N, mask):
@@ -232,40 +714,54 @@ class RepeatMask (cs.Mask):
         self.N = N
         self.m = mask
 
+    def startIteration (self, state):
+        obj = copy.copy (self)
+        mState = templateState (state)
+        (obj.sources, obj.targets) = cs.concatenateBlocks (
+            self.m.startIteration (mState).blockIterator (0, self.M,
+                                                          0, self.N,
+                                                          mState))
+        return obj
+
     def iterator (self, low0, high0, low1, high1, state):
-        try:
-            jj = low1
-            nextHigh1 = (low1 + self.N) / self.N * self.N
-            while nextHigh1 <= high1:
-                maskIter =  self.m.iterator (0,
-                                             self.M,
-                                             0,
-                                             self.N,
-                                             state)
-                try:
-                    (i, j) = next (maskIter)
-                    post = j
-                    while post < self.N:
-                        pre = []
-                        while j == post:
-                            pre.append (i)
-                            (i, j) = next (maskIter)
-                        ii = low0
-                        while ii < high0:
-                            for k in pre:
-                                yield (ii + k, jj + post)
-                            ii += self.M
-                        post = j
-                except StopIteration:
-                    ii = low0
-                    while ii < high0:
-                        for k in pre:
-                            yield (ii + k, jj + post)
-                        ii += self.M
-                jj = nextHigh1
-                nextHigh1 += self.N
-        except StopIteration:
-            return
+        return cs.blocksToIterator (self.blockIterator (low0, high0,
+                                                        low1, high1,
+                                                        state))
+
+    def blockIterator (self, low0, high0, low1, high1, state):
+        for (s, t, origins) in repeatExpansion (self.M, self.N,
+                                                self.sources, self.targets,
+                                                low0, high0, low1, high1):
+            yield (s, t)
+
+    def count (self, low0, high0, low1, high1):
+        obj = self.startIteration (cs.State ())
+        return int ((residueCounts (low0, high0, self.M, obj.sources)
+                     * residueCounts (low1, high1, self.N, obj.targets)).sum ())
+
+
+class RepeatCSet (ExpandedCSet):
+    def __init__ (self, M, N, c):
+        ExpandedCSet.__init__ (self, M, N, c, RepeatMask (M, N, c.mask ()))
+
+    def templateIndex (self, i, j):
+        return (i % self.M, j % self.N)
+
+    def startIteration (self, state):
+        obj = ExpandedCSet.startIteration (self, state)
+        blocks = list (obj.template.blockIterator (0, self.M, 0, self.N,
+                                                   obj.templateState))
+        (obj.sources, obj.targets) = cs.concatenateBlocks (blocks)
+        obj.values = [numpy.concatenate ([b[2][k] for b in blocks]
+                                         + [numpy.empty (0)])
+                      for k in range (self.arity)]
+        return obj
+
+    def expansion (self, low0, high0, low1, high1):
+        for (s, t, origins) in repeatExpansion (self.M, self.N,
+                                                self.sources, self.targets,
+                                                low0, high0, low1, high1):
+            yield (s, t, [v[origins] for v in self.values])
 
 
 class Transpose (cs.Operator):
@@ -285,7 +781,7 @@ class Shift (cs.Operator):
     def __mul__ (self, other):
         c = cs.coerceCSet (other)
         if isinstance (c, cs.Mask):
-            return other.shift (self.M, self.N)
+            return _cache.intern (other.shift (self.M, self.N))
         else:
             return cs.ConnectionSet (other.shift (self.M, self.N))
 
@@ -299,27 +795,11 @@ class Fix (cs.Operator):
             return cs.ConnectionSet (FixedCSet (other))
 
 
-class FixedMask (cs.FiniteMask):
+class FixedMask (cs.ArrayMask):
     def __init__ (self, mask):
-        cs.FiniteMask.__init__ (self)
-        ls = []
-        for c in mask:
-            ls.append (c)
-        self.connections = ls
-        targets = list (map (cs.target, ls))
-        self.low0 = min (ls)[0]
-        self.high0 = max (ls)[0] + 1
-        self.low1 = min (targets)
-        self.high1 = max (targets) + 1
-
-    def iterator (self, low0, high0, low1, high1, state):
-        if not self.isBoundedBy (low0, high0, low1, high1):
-            return iter (self.connections)
-        else:
-            return self.boundedIterator (low0, high0, low1, high1)
-
-    def boundedIterator (self, low0, high0, low1, high1):
-        for c in self.connections:
-            if low0 <= c[0] and c[0] < high0 \
-               and low1 <= c[1] and c[1] < high1:
-                yield c
+        # materializations are shared between identical masks
+        mask = cs.coerceCSet (mask)
+        (sources, targets) = _cache.memoize ('fix', mask, (),
+                                             lambda: cs.concatenateBlocks (mask.blocks ()),
+                                             lambda b: len (b[0]))
+        cs.ArrayMask.__init__ (self, sources, targets)
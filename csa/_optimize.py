@@ -0,0 +1,214 @@
+#
+#  This file is part of the Connection-Set Algebra (CSA).
+#  Copyright (C) 2010,2011,2012 Mikael Djurfeldt
+#
+#  CSA is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  CSA is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import copy
+import functools
+
+from . import connset as cs
+from . import _elementary
+from . import _misc
+
+# Rewriting of mask expressions before iteration
+#
+# The optimizer rewrites the expression tree of a mask into an
+# equivalent tree which is cheaper to iterate.  Rewrites never change
+# the connections produced nor their order, and random masks keep
+# their seeds, so that the connections are the same as for the
+# original expression.
+#
+# The rules are:
+#
+#   cancel transposes       transpose of a transpose
+#   transpose cross         transpose of an interval set mask
+#   transpose intersection  transpose of an intersection of masks
+#                           which can all be transposed without sorting
+#   merge shifts            shift of a shift
+#   fold cross              several cross (...) bounding an intersection
+#   fuse random disc        random (p) * disc (r) * metric
+#   reorder                 intersection operands, sparsest first
+#
+# Each rewrite is recorded as a tuple (rule, before, after) in the log
+# if one is given.
+#
+enabled = True
+
+def optimize (mask, log = None):
+    if not enabled:
+        return mask
+    return Optimizer (log).optimize (mask)
+
+
+class Optimizer (object):
+    def __init__ (self, log = None):
+        self.log = log
+
+    def rewrite (self, rule, before, after):
+        if self.log != None:
+            self.log.append ((rule, before, after))
+        return after
+
+    def optimize (self, mask):
+        if isinstance (mask, cs.TransposedMask):
+            return self.transposed (mask)
+        elif isinstance (mask, cs.ShiftedMask):
+            return self.shifted (mask)
+        elif isinstance (mask, (cs.MaskIntersection, cs.ISetBoundedMask)):
+            return self.intersection (mask)
+        elif isinstance (mask, (cs.MaskMultisetSum, cs.MaskDifference)):
+            return self.binary (mask)
+        elif isinstance (mask, cs.MaskPartition):
+            return self.withSubMask (mask, self.optimize (mask.subMask))
+        else:
+            return mask
+
+    @staticmethod
+    def withSubMask (mask, subMask):
+        if subMask is mask.subMask:
+            return mask
+        obj = copy.copy (mask)
+        obj._mask = obj
+        obj.subMask = subMask
+        return obj
+
+    def binary (self, mask):
+        op1 = self.optimize (mask.op1)
+        op2 = self.optimize (mask.op2)
+        if op1 is mask.op1 and op2 is mask.op2:
+            return mask
+        obj = copy.copy (mask)
+        obj._mask = obj
+        obj.op1 = op1
+        obj.op2 = op2
+        return obj
+
+    def transposed (self, mask):
+        subMask = self.optimize (mask.subMask)
+        if isinstance (subMask, cs.TransposedMask):
+            return self.rewrite ('cancel transposes', mask, subMask.subMask)
+        elif isinstance (subMask, cs.IntervalSetMask):
+            return self.rewrite ('transpose cross', mask,
+                                 cs.intervalSetMask (subMask.set1,
+                                                     subMask.set0))
+        elif isinstance (subMask, (cs.MaskIntersection, cs.ISetBoundedMask)):
+            transposes = [nativeTranspose (m) for m in self.operands (subMask)]
+            if None not in transposes and singleSourceInterval (transposes):
+                result = functools.reduce (lambda m1, m2: m1.intersection (m2),
+                                           transposes)
+                return self.rewrite ('transpose intersection', mask,
+                                     self.optimize (result))
+        return self.withSubMask (mask, subMask)
+
+    def shifted (self, mask):
+        subMask = self.optimize (mask.subMask)
+        # The inner shift drops connections with negative indices.
+        # This is implied by the outer shift unless the inner shift
+        # is negative and the outer positive.
+        if isinstance (subMask, cs.ShiftedMask) \
+           and (subMask.M >= 0 or mask.M <= 0) \
+           and (subMask.N >= 0 or mask.N <= 0):
+            return self.rewrite ('merge shifts', mask,
+                                 cs.shiftedMask (subMask.subMask,
+                                                 subMask.M + mask.M,
+                                                 subMask.N + mask.N))
+        return self.withSubMask (mask, subMask)
+
+    # The operands of a chain of intersections
+    #
+    def operands (self, mask):
+        if isinstance (mask, cs.ISetBoundedMask):
+            return [cs.intervalSetMask (mask.set0, mask.set1)] \
+                   + self.operands (mask.subMask)
+        elif isinstance (mask, cs.MaskIntersection):
+            return self.operands (mask.op1) + self.operands (mask.op2)
+        else:
+            return [self.optimize (mask)]
+
+    def intersection (self, mask):
+        operands = self.operands (mask)
+        crosses = [m for m in operands if isinstance (m, cs.IntervalSetMask)]
+        others = [m for m in operands
+                  if not isinstance (m, cs.IntervalSetMask)]
+        if crosses:
+            set0 = functools.reduce (lambda s, t: s.intersection (t),
+                                     [m.set0 for m in crosses])
+            set1 = functools.reduce (lambda s, t: s.intersection (t),
+                                     [m.set1 for m in crosses])
+            # ISetBoundedMask only produces connections in post-order
+            # if the sources form a single interval
+            if len (set0.intervalBounds ()[0]) > 1 or not others:
+                return mask
+        operands = self.fuse (others)
+        result = functools.reduce (lambda m1, m2: m1.intersection (m2),
+                                   sorted (operands, key = sparsity))
+        if crosses:
+            result = cs.ISetBoundedMask (set0, set1, result)
+        if len (crosses) > 1:
+            self.rewrite ('fold cross', mask, result)
+        if [id (m) for m in sorted (operands, key = sparsity)] \
+           != [id (m) for m in operands]:
+            self.rewrite ('reorder', mask, result)
+        return result
+
+    def fuse (self, operands):
+        randoms = [m for m in operands
+                   if isinstance (m, _elementary.ConstantRandomMask)]
+        discs = [m for m in operands if isinstance (m, _misc.DiscMask)]
+        if not randoms or not discs:
+            return operands
+        fused = _misc.RandomDiscMask (randoms[0], discs[0])
+        self.rewrite ('fuse random disc',
+                      randoms[0].intersection (discs[0]), fused)
+        return [fused if m is randoms[0] else m
+                for m in operands if m is not discs[0]]
+
+
+# The intersection of crosses with other masks only produces
+# connections in post-order if the sources of the crosses form a
+# single interval
+#
+def singleSourceInterval (masks):
+    sets = [m.set0 for m in masks if isinstance (m, cs.IntervalSetMask)]
+    if not sets or len (sets) == len (masks):
+        return True
+    set0 = functools.reduce (lambda s, t: s.intersection (t), sets)
+    return len (set0.intervalBounds ()[0]) <= 1
+
+# Returns the transpose of mask if it can be produced without sorting
+# the connections of mask, otherwise None
+#
+def nativeTranspose (mask):
+    if isinstance (mask, (cs.IntervalSetMask, cs.ArrayMask,
+                          _elementary.OneToOne)):
+        return mask.transpose ()
+    return None
+
+
+# Sort key placing the operands which produce the fewest connections
+# first: finite masks of known size, then random masks by density
+#
+def sparsity (mask):
+    if isinstance (mask, (cs.ExplicitMask, cs.FiniteISetMask)):
+        return (0, len (mask))
+    elif isinstance (mask, _elementary.ConstantRandomMask):
+        return (1, mask.p)
+    elif isinstance (mask, _misc.RandomDiscMask):
+        return (1, mask.randomMask.p)
+    elif cs.isFinite (mask):
+        return (2, 0)
+    else:
+        return (3, 0)
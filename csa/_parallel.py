@@ -0,0 +1,93 @@
+#
+#  This file is part of the Connection-Set Algebra (CSA).
+#  Copyright (C) 2010,2011,2012 Mikael Djurfeldt
+#
+#  CSA is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  CSA is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import multiprocessing
+import concurrent.futures
+
+from . import connset as cs
+from . import _sparse
+from . import _balance
+
+# Parallel evaluation of finite masks and connection sets
+#
+# The target range is split into chunks with about the same expected
+# number of connections, which are evaluated in a pool of processes,
+# each chunk through the same partition mechanism as used by MPI
+# ranks.  The random masks draw their numbers as
+# functions of the positions of the connections, so that the chunks
+# together produce exactly the connections of serial iteration.  The
+# chunks are returned in target order and therefore merge into
+# post-order by concatenation.
+#
+# Where processes can be forked, the connection set is inherited by
+# the workers, so that it need not be picklable.  Otherwise it is
+# sent to the workers pickled.
+#
+chunksPerProcess = 4
+
+# The connection set of the current parallel evaluation, inherited
+# by forked workers
+#
+shared = None
+
+def evaluate (c, masks, k):
+    if isinstance (c, cs.ConnectionSet):
+        part = cs.ConnectionSet (cs.CSetPartition (c, masks, k, None))
+    else:
+        part = cs.MaskPartition (c, masks, k, None)
+    return _sparse.collect (part)
+
+def evaluateShared (masks, k):
+    return evaluate (shared, masks, k)
+
+# Yields blocks (sources, targets, values) of the chunks of c in
+# post-order
+#
+def parallelBlocks (c, processes = None, masks = None):
+    global shared
+    assert cs.isFinite (_sparse.maskOf (c)), 'expected finite connection-set'
+    if processes == None:
+        processes = multiprocessing.cpu_count ()
+    if masks == None:
+        masks = _balance.balancedMasks (c, chunksPerProcess * processes)
+    if 'fork' in multiprocessing.get_all_start_methods ():
+        context = multiprocessing.get_context ('fork')
+        shared = c
+        (function, args) = (evaluateShared, [])
+    else:
+        context = None
+        (function, args) = (evaluate, [c])
+    try:
+        with concurrent.futures.ProcessPoolExecutor (processes, context) \
+                 as executor:
+            futures = [executor.submit (function, *(args + [masks, k]))
+                       for k in range (len (masks))]
+            for future in futures:
+                yield future.result ()
+    finally:
+        shared = None
+
+def parallelIter (c, processes = None, masks = None):
+    blocks = parallelBlocks (c, processes, masks)
+    if isinstance (c, cs.ConnectionSet):
+        for (i, j, values) in cs.valueBlocksToIterator (blocks):
+            yield (i, j) + tuple (values)
+    else:
+        for (sources, targets, values) in blocks:
+            for x in zip (sources.tolist (), targets.tolist ()):
+                yield x
@@ -0,0 +1,239 @@
+#
+#  This file is part of the Connection-Set Algebra (CSA).
+#  Copyright (C) 2010,2011,2012 Mikael Djurfeldt
+#
+#  CSA is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  CSA is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+
+from . import connset as cs
+from . import valueset
+from . import _sparse
+
+# Profiling of the evaluation of expressions
+#
+# profile (c) iterates over all connections of c with the iteration
+# methods of all mask and connection-set classes, and the evaluation
+# and calls of value sets, temporarily wrapped so that they record,
+# for each node of the expression, the number of calls, the number of
+# connections produced and the time spent (including the time spent
+# in the operands).  The calls of a mask are its iterations; those of
+# a value set are the values it computes, singly or as arrays.  The
+# report also shows, for each node, the connections produced by its
+# operands.  Outside of profile, nothing is wrapped and there is no
+# cost.
+#
+methods = ['startIteration', 'iterator', 'blockIterator']
+labelWidth = 48
+
+
+class Stats (object):
+    def __init__ (self):
+        self.calls = 0
+        self.connections = 0
+        self.time = 0.0
+
+
+class Profile (object):
+    def __init__ (self):
+        self.stats = {}
+        self.active = []
+        self.root = None
+        self.depth = 0
+        # objects are kept alive so that their ids are not reused
+        self.objects = []
+
+    def record (self, obj):
+        if id (obj) not in self.stats:
+            self.stats[id (obj)] = Stats ()
+            self.objects.append (obj)
+        return self.stats[id (obj)]
+
+    def wrapStartIteration (self, method):
+        profile = self
+        def startIteration (obj, state):
+            profile.depth += 1
+            try:
+                result = method (obj, state)
+            finally:
+                profile.depth -= 1
+            if profile.depth == 0:
+                profile.root = result
+            return result
+        return startIteration
+
+    def wrapIterator (self, method, blocks):
+        profile = self
+        def iterator (obj, *args):
+            stats = profile.record (obj)
+            stats.calls += 1
+            return profile.measure (obj, stats, method (obj, *args), blocks)
+        return iterator
+
+    # Times each step of the iterator and counts its connections,
+    # unless the node is already being measured (an iterator
+    # implemented by the block iterator of the same node or vice
+    # versa)
+    #
+    def measure (self, obj, stats, iterator, blocks):
+        while True:
+            nested = id (obj) in self.active
+            self.active.append (id (obj))
+            start = time.perf_counter ()
+            try:
+                x = next (iterator)
+            except StopIteration:
+                return
+            finally:
+                if not nested:
+                    stats.time += time.perf_counter () - start
+                self.active.pop ()
+            if not nested:
+                stats.connections += len (x[0]) if blocks else 1
+            yield x
+
+    # Value sets evaluated as arrays may call themselves for each
+    # element; such calls are already counted by the evaluation
+    #
+    def wrapEvaluate (self, function):
+        profile = self
+        def evaluate (f, i, j):
+            stats = profile.record (f)
+            stats.calls += len (i)
+            profile.active.append (id (f))
+            start = time.perf_counter ()
+            try:
+                return function (f, i, j)
+            finally:
+                stats.time += time.perf_counter () - start
+                profile.active.pop ()
+        return evaluate
+
+    def wrapCall (self, method):
+        profile = self
+        def call (obj, i, j):
+            if id (obj) in profile.active:
+                return method (obj, i, j)
+            stats = profile.record (obj)
+            stats.calls += 1
+            start = time.perf_counter ()
+            try:
+                return method (obj, i, j)
+            finally:
+                stats.time += time.perf_counter () - start
+        return call
+
+    def run (self, c):
+        originals = []
+        for cls in subclasses (cs.CSet):
+            for name in methods:
+                if name in cls.__dict__:
+                    originals.append ((cls, name, cls.__dict__[name]))
+        for cls in subclasses (valueset.ValueSet):
+            if '__call__' in cls.__dict__:
+                originals.append ((cls, '__call__', cls.__dict__['__call__']))
+        evaluate = valueset.evaluate
+        try:
+            for (cls, name, method) in originals:
+                if name == 'startIteration':
+                    wrapper = self.wrapStartIteration (method)
+                elif name == '__call__':
+                    wrapper = self.wrapCall (method)
+                else:
+                    wrapper = self.wrapIterator (method,
+                                                 name == 'blockIterator')
+                setattr (cls, name, wrapper)
+            valueset.evaluate = self.wrapEvaluate (evaluate)
+            start = time.perf_counter ()
+            for b in _sparse.valueBlocks (c):
+                pass
+            self.time = time.perf_counter () - start
+        finally:
+            for (cls, name, method) in originals:
+                setattr (cls, name, method)
+            valueset.evaluate = evaluate
+
+    # The report is the tree of the evaluated expression with one
+    # line per node
+    #
+    def __str__ (self):
+        lines = ['%-*s %12s %12s %14s %10s' % (labelWidth, 'expression',
+                                               'calls', 'connections',
+                                               'from operands', 'time (s)')]
+        self.report (self.root, 0, lines, set ())
+        lines.append ('total time %.3f s' % self.time)
+        return '\n'.join (lines)
+
+    def report (self, obj, indent, lines, visited):
+        visited.add (id (obj))
+        nodes = [x for x in children (obj)
+                 if id (x) not in visited and self.evaluated (x)]
+        stats = self.stats.get (id (obj), Stats ())
+        operands = sum (self.stats[id (x)].connections for x in nodes
+                        if id (x) in self.stats and not isValueSet (x))
+        text = ('  ' * indent + label (obj))[:labelWidth]
+        lines.append ('%-*s %12d %12s %14s %10.3f'
+                      % (labelWidth, text, stats.calls,
+                         '' if isValueSet (obj) else stats.connections,
+                         operands if operands else '',
+                         stats.time))
+        for x in nodes:
+            if id (x) not in visited:
+                self.report (x, indent + 1, lines, visited)
+
+    # Whether obj or one of its operands has been evaluated
+    #
+    def evaluated (self, obj, visited = None):
+        if id (obj) in self.stats:
+            return True
+        visited = visited or set ()
+        visited.add (id (obj))
+        return any (self.evaluated (x, visited) for x in children (obj)
+                    if id (x) not in visited)
+
+
+def subclasses (cls):
+    result = [cls]
+    for c in cls.__subclasses__ ():
+        result.extend (x for x in subclasses (c) if x not in result)
+    return result
+
+def isValueSet (x):
+    return not isinstance (x, cs.CSet)
+
+def label (obj):
+    try:
+        text = obj.repr ()
+    except Exception:
+        text = getattr (obj, '__name__', type (obj).__name__)
+    return 'value %s' % text if isValueSet (obj) else text
+
+# The operands and value sets of a node of the evaluated expression
+#
+def children (obj):
+    if isValueSet (obj):
+        return []
+    nodes = []
+    for (name, value) in sorted (obj.__dict__.items ()):
+        if name == 'valueSets':
+            nodes.extend (value)
+        elif isinstance (value, cs.CSet) and value is not obj:
+            nodes.append (value)
+    return nodes
+
+def profile (c):
+    p = Profile ()
+    p.run (c)
+    return p
@@ -0,0 +1,111 @@
+#
+#  This file is part of the Connection-Set Algebra (CSA).
+#  Copyright (C) 2010,2011,2012 Mikael Djurfeldt
+#
+#  CSA is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  CSA is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import random
+import hashlib
+import numpy
+
+# Random numbers for the random masks
+#
+# The masks use counter-based random numbers: each number is a
+# function of a key, derived from the seed of the mask, and of its
+# position (j, k) where j is a target index and k a draw number.
+# Numbers can therefore be computed in any order, so that any
+# partition of a mask produces the same connections as the complete
+# mask, without drawing the numbers of the other partitions.
+#
+# The generator is Philox4x32-10 (Salmon et al. (2011) "Parallel
+# random numbers: as easy as 1, 2, 3", SC'11), here evaluated in
+# bulk over arrays of positions.
+
+MASK32 = numpy.uint64 (0xffffffff)
+MASK64 = 0xffffffffffffffff
+SHIFT32 = numpy.uint64 (32)
+
+PHILOX_M0 = numpy.uint64 (0xD2511F53)
+PHILOX_M1 = numpy.uint64 (0xCD9E8D57)
+PHILOX_W0 = 0x9E3779B9
+PHILOX_W1 = 0xBB67AE85
+
+
+def philox (c0, c1, c2, c3, k0, k1):
+    # c0, ..., c3 are arrays holding 32-bit counter words
+    c0 = c0.astype (numpy.uint64)
+    c1 = c1.astype (numpy.uint64)
+    c2 = c2.astype (numpy.uint64)
+    c3 = c3.astype (numpy.uint64)
+    p0 = numpy.empty_like (c0)
+    p1 = numpy.empty_like (c0)
+    for r in range (10):
+        numpy.multiply (c0, PHILOX_M0, out = p0)
+        numpy.multiply (c2, PHILOX_M1, out = p1)
+        numpy.right_shift (p1, SHIFT32, out = c0)
+        c0 ^= c1
+        c0 ^= numpy.uint64 (k0)
+        numpy.bitwise_and (p1, MASK32, out = c1)
+        numpy.right_shift (p0, SHIFT32, out = c2)
+        c2 ^= c3
+        c2 ^= numpy.uint64 (k1)
+        numpy.bitwise_and (p0, MASK32, out = c3)
+        k0 = (k0 + PHILOX_W0) & 0xffffffff
+        k1 = (k1 + PHILOX_W1) & 0xffffffff
+    return (c0, c1, c2, c3)
+
+
+def makeSeed ():
+    # Seeds are drawn from the random module so that random.seed
+    # determines the connectivity
+    return random.getrandbits (64)
+
+def seedFromObject (obj):
+    if isinstance (obj, int):
+        return obj & MASK64
+    # hash () of strings differs between processes
+    digest = hashlib.sha256 (repr (obj).encode ('utf-8')).digest ()
+    return int.from_bytes (digest[:8], 'little')
+
+
+class RandomStream (object):
+    def __init__ (self, seed, name = ''):
+        self.key = seedFromObject ((seed, name))
+
+    # Uniform random numbers in (0, 1) at positions (j, k), which are
+    # broadcast against each other
+    #
+    def uniform (self, j, k):
+        j = numpy.asarray (j, dtype = numpy.uint64)
+        k = numpy.asarray (k, dtype = numpy.uint64)
+        (j, k) = numpy.broadcast_arrays (j, k)
+        (r0, r1, r2, r3) = philox (k & MASK32, k >> SHIFT32,
+                                   j & MASK32, j >> SHIFT32,
+                                   self.key & 0xffffffff, self.key >> 32)
+        # 52 random bits, so that x + 0.5 is exact and u < 1
+        x = (r0 << numpy.uint64 (20)) ^ (r1 >> numpy.uint64 (12))
+        return (x.astype (numpy.float64) + 0.5) * 2.0**-52
+
+    # Random integers in [0, n)
+    #
+    def integers (self, n, j, k):
+        return numpy.floor (self.uniform (j, k) * n).astype (numpy.int64)
+
+    # A numpy generator keyed by this stream and the given words, for
+    # distributions which are drawn as a whole
+    #
+    def generator (self, *words):
+        key = seedFromObject ((self.key,) + words)
+        return numpy.random.Generator (numpy.random.Philox (key = key))
@@ -0,0 +1,143 @@
+#
+#  This file is part of the Connection-Set Algebra (CSA).
+#  Copyright (C) 2010,2011,2012 Mikael Djurfeldt
+#
+#  CSA is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  CSA is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import numpy
+
+try:
+    import scipy.sparse
+    HAVE_SCIPY=True
+except ImportError:
+    HAVE_SCIPY=False
+
+from . import connset as cs
+
+# Materialization of finite connection sets as compressed sparse
+# arrays
+#
+# The connection matrix has sources as rows and targets as columns.
+# Since connections are produced in post-order (by target), the
+# compressed sparse column (CSC) form is filled directly from the
+# blocks of the connection set, while the compressed sparse row (CSR)
+# form needs an additional stable sort by source.
+
+def cheapLength (mask):
+    return mask.count (*mask.bounds ())
+
+# The mask of a mask or connection set (some masks have an attribute
+# mask which hides the method)
+#
+def maskOf (c):
+    if isinstance (c, cs.ConnectionSet):
+        c = c.c
+    return c if isinstance (c, cs.Mask) else c.mask ()
+
+# Yields blocks (sources, targets, values) of a finite mask or
+# connection set
+#
+def valueBlocks (c):
+    if isinstance (c, cs.ConnectionSet):
+        c = c.c
+    assert cs.isFinite (maskOf (c)), 'expected finite connection-set'
+    if isinstance (c, cs.Mask):
+        for (sources, targets) in c.blocks ():
+            yield (sources, targets, [])
+    else:
+        state = cs.State ()
+        obj = c.startIteration (state)
+        (low0, high0, low1, high1) = c.bounds ()
+        for b in obj.blockIterator (low0, high0, low1, high1, state):
+            yield b
+
+# Collects all connections in one pass.  If the number of
+# connections is known in advance, the arrays are filled in place.
+#
+# Values of empty connection-sets are float arrays, like the values of
+# numerical value sets.
+#
+def collect (c):
+    mask = maskOf (c)
+    arity = (c.c if isinstance (c, cs.ConnectionSet) else c).arity
+    empty = numpy.empty (0, dtype = numpy.float64)
+    n = cheapLength (mask)
+    if n == None:
+        blocks = list (valueBlocks (c))
+        sources = numpy.concatenate ([b[0] for b in blocks] + [cs.emptyBlock ()[0]])
+        targets = numpy.concatenate ([b[1] for b in blocks] + [cs.emptyBlock ()[1]])
+        values = [numpy.concatenate ([b[2][k] for b in blocks])
+                  if blocks else empty
+                  for k in range (arity)]
+        return (sources, targets, values)
+    sources = numpy.empty (n, dtype = numpy.int64)
+    targets = numpy.empty (n, dtype = numpy.int64)
+    values = None
+    k = 0
+    for (s, t, v) in valueBlocks (c):
+        if values == None:
+            values = [numpy.empty (n, dtype = a.dtype) for a in v]
+        sources[k:k + len (s)] = s
+        targets[k:k + len (t)] = t
+        for (a, b) in zip (values, v):
+            a[k:k + len (b)] = b
+        k += len (s)
+    assert k == n, 'connection-set has wrong length'
+    if values == None:
+        values = [empty for k in range (arity)]
+    return (sources, targets, values)
+
+def defaultShape (c, shape):
+    if shape != None:
+        return shape
+    (low0, high0, low1, high1) = c.bounds () if not isinstance (c, cs.ConnectionSet) \
+                                 else c.c.bounds ()
+    return (high0, high1)
+
+def compress (major, minor, values, n, order = None):
+    if order is not None:
+        (major, minor) = (major[order], minor[order])
+        values = [v[order] for v in values]
+    indptr = numpy.zeros (n + 1, dtype = numpy.int64)
+    numpy.cumsum (numpy.bincount (major, minlength = n)[:n], out = indptr[1:])
+    return (indptr, minor, values)
+
+def sparseMatrices (kind, indptr, indices, values, shape):
+    if not HAVE_SCIPY:
+        raise ImportError ('scipy is needed for sparse matrix output')
+    matrix = scipy.sparse.csr_matrix if kind == 'csr' \
+             else scipy.sparse.csc_matrix
+    if not values:
+        values = [numpy.ones (len (indices))]
+    matrices = [matrix ((v, indices, indptr), shape = shape) for v in values]
+    return matrices[0] if len (matrices) == 1 else matrices
+
+def toCSR (c, shape = None, sparse = False):
+    shape = defaultShape (c, shape)
+    (sources, targets, values) = collect (c)
+    order = numpy.argsort (sources, kind = 'stable')
+    (indptr, indices, values) = compress (sources, targets, values,
+                                          shape[0], order)
+    if sparse:
+        return sparseMatrices ('csr', indptr, indices, values, shape)
+    return (indptr, indices, values)
+
+def toCSC (c, shape = None, sparse = False):
+    shape = defaultShape (c, shape)
+    (sources, targets, values) = collect (c)
+    (indptr, indices, values) = compress (targets, sources, values, shape[1])
+    if sparse:
+        return sparseMatrices ('csc', indptr, indices, values, shape)
+    return (indptr, indices, values)
@@ -0,0 +1,160 @@
+#
+#  This file is part of the Connection-Set Algebra (CSA).
+#  Copyright (C) 2010,2011,2012 Mikael Djurfeldt
+#
+#  CSA is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  CSA is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import itertools
+import weakref
+import numpy
+
+from . import connset as cs
+
+# Spatial indices for distance-based masks and value sets
+#
+# Geometries which know the coordinates of their elements (they have
+# the attribute coordinates, returning an (n, dim) array for an array
+# of indices) are indexed by a uniform grid of cells.  For each
+# target, only sources in the cells neighbouring the cell of the
+# target are tested, which reduces the cost of enumerating all pairs
+# within a radius from O(N^2) to O(N k) for N points with k neighbours.
+#
+# Indices are cached for each source geometry, keyed by the range of
+# sources and the radius.
+#
+maxCellsPerDimension = 2**20
+maxCachedIndices = 8
+
+spatialIndices = weakref.WeakKeyDictionary ()
+
+
+class CellGrid (object):
+    def __init__ (self, coords, size):
+        self.dim = coords.shape[1]
+        if len (coords) == 0:
+            coords = numpy.zeros ((1, self.dim))
+        self.lower = coords.min (axis = 0)
+        extent = (coords.max (axis = 0) - self.lower).max ()
+        # cells may be larger than the radius, but their number must
+        # fit in the int64 keys
+        self.size = max (size, extent / maxCellsPerDimension)
+        if not self.size > 0.0:
+            self.size = 1.0
+        cells = self.cells (coords)
+        self.shape = cells.max (axis = 0) + 1
+        keys = self.keys (cells)
+        self.order = numpy.argsort (keys, kind = 'stable')
+        self.sortedKeys = keys[self.order]
+        # mean number of elements in the occupied cells
+        occupied = 1 + numpy.count_nonzero (numpy.diff (self.sortedKeys))
+        self.occupancy = len (keys) / occupied
+
+    def cells (self, coords):
+        return numpy.floor ((coords - self.lower) / self.size).astype (numpy.int64)
+
+    def keys (self, cells):
+        keys = numpy.zeros (len (cells), dtype = numpy.int64)
+        for d in reversed (range (self.dim)):
+            keys = keys * self.shape[d] + cells[:,d]
+        return keys
+
+    # Returns arrays (p, s) of all pairs of points p and indexed
+    # elements s in the same or neighbouring cells
+    #
+    def candidates (self, points):
+        cells = self.cells (points)
+        ps = []
+        ss = []
+        for offset in itertools.product ((-1, 0, 1), repeat = self.dim):
+            c = cells + numpy.array (offset, dtype = numpy.int64)
+            valid = numpy.all ((c >= 0) & (c < self.shape), axis = 1)
+            keys = self.keys (c[valid])
+            start = numpy.searchsorted (self.sortedKeys, keys, 'left')
+            counts = numpy.searchsorted (self.sortedKeys, keys, 'right') - start
+            ps.append (numpy.repeat (numpy.flatnonzero (valid), counts))
+            ss.append (self.order[cs.expandRanges (start, counts)])
+        return (numpy.concatenate (ps), numpy.concatenate (ss))
+
+
+def isIndexable (g):
+    return getattr (g, 'coordinates', None) != None
+
+
+def cellGrid (g, low, high, size):
+    cache = spatialIndices.setdefault (g, {})
+    key = (low, high, size)
+    if key not in cache:
+        if len (cache) >= maxCachedIndices:
+            cache.clear ()
+        indices = numpy.arange (low, high, dtype = numpy.int64)
+        cache[key] = CellGrid (g.coordinates (indices), size)
+    return cache[key]
+
+
+# Returns arrays (sources, targets) of candidate pairs, including all
+# pairs of sources in [low0, high0) and targets for which the
+# distance between g0 (i) and g1 (j) + offset is less than r.  Pairs
+# are in no particular order.
+#
+def candidatePairs (g0, g1, r, low0, high0, targets, offset = None):
+    grid = cellGrid (g0, low0, high0, r)
+    points = g1.coordinates (targets)
+    if offset != None:
+        points = points + numpy.array (offset)
+    (p, s) = grid.candidates (points)
+    return (s + low0, targets[p])
+
+
+# Expected number of candidate sources in [low0, high0) per target,
+# for chunking targets into blocks of candidates of a given size
+#
+def expectedCandidates (g0, low0, high0, r, images = 1):
+    grid = cellGrid (g0, low0, high0, r)
+    return images * grid.occupancy * 3**grid.dim
+
+
+def isIndexableMetric (metric):
+    geometries = getattr (metric, 'geometries', None)
+    return geometries != None \
+           and isIndexable (geometries[0]) and isIndexable (geometries[1])
+
+
+def expectedNeighbourCandidates (metric, r, low0, high0):
+    return expectedCandidates (metric.geometries[0], low0, high0, r,
+                               len (metric.images))
+
+
+# Returns arrays (sources, targets, distances) of all pairs of
+# sources in [low0, high0) and targets for which metric (i, j) < r, in
+# post-order
+#
+def neighbours (metric, r, low0, high0, targets):
+    (g0, g1) = metric.geometries
+    pairs = [candidatePairs (g0, g1, r, low0, high0, targets, offset)
+             for offset in metric.images]
+    sources = numpy.concatenate ([p[0] for p in pairs])
+    targets = numpy.concatenate ([p[1] for p in pairs])
+    if len (pairs) > 1 and len (targets) > 0:
+        # a pair may be found in several images of a periodic space
+        width = high0 - low0
+        base = targets.min ()
+        keys = numpy.unique ((targets - base) * width + (sources - low0))
+        (sources, targets) = (keys % width + low0, keys // width + base)
+    distances = metric.distances (sources, targets)
+    keep = distances < r
+    (sources, targets, distances) = \
+        (sources[keep], targets[keep], distances[keep])
+    order = numpy.lexsort ((sources, targets))
+    return (sources[order], targets[order], distances[order])
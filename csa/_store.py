@@ -0,0 +1,199 @@
+#
+#  This file is part of the Connection-Set Algebra (CSA).
+#  Copyright (C) 2010,2011,2012 Mikael Djurfeldt
+#
+#  CSA is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  CSA is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import json
+import numpy
+
+from . import connset as cs
+from . import _sparse
+
+# On-disk storage of finite masks and connection sets
+#
+# A store is a directory holding a binary file of sources in
+# post-order, one binary file per value set, and a per-target offset
+# index: the connections of target j are at positions
+# offsets[j - low1] to offsets[j - low1 + 1].  The files are opened
+# with numpy.memmap, so that iteration over a range of targets only
+# reads the corresponding part of the files, and several processes
+# can share one store.
+#
+headerName = 'header.json'
+
+def indexType (high):
+    return numpy.int32 if high <= numpy.iinfo (numpy.int32).max \
+           else numpy.int64
+
+def store (c, path, valueType = numpy.float64):
+    if isinstance (c, list):
+        c = cs.ExplicitMask (c)
+    inner = c.c if isinstance (c, cs.ConnectionSet) else c
+    (low0, high0, low1, high1) = inner.bounds ()
+    sourceType = indexType (high0)
+    counts = numpy.zeros (max (high1 - low1, 0), dtype = numpy.int64)
+    if not os.path.isdir (path):
+        os.makedirs (path)
+    sources = open (os.path.join (path, 'sources'), 'wb')
+    columns = None
+    n = 0
+    try:
+        for (s, t, values) in _sparse.valueBlocks (c):
+            if columns == None:
+                columns = [open (os.path.join (path, 'values%d' % k), 'wb')
+                           for k in range (len (values))]
+            s.astype (sourceType).tofile (sources)
+            for (f, v) in zip (columns, values):
+                v.astype (valueType).tofile (f)
+            counts += numpy.bincount (t - low1, minlength = len (counts))
+            n += len (s)
+    finally:
+        sources.close ()
+        for f in columns or []:
+            f.close ()
+    offsets = numpy.zeros (len (counts) + 1, dtype = numpy.int64)
+    numpy.cumsum (counts, out = offsets[1:])
+    offsets.tofile (os.path.join (path, 'offsets'))
+    header = { 'bounds' : [low0, high0, low1, high1],
+               'length' : n,
+               'arity' : len (columns or []),
+               'sourceType' : numpy.dtype (sourceType).str,
+               'valueType' : numpy.dtype (valueType).str }
+    with open (os.path.join (path, headerName), 'w') as f:
+        json.dump (header, f)
+
+def load (path):
+    with open (os.path.join (path, headerName)) as f:
+        header = json.load (f)
+    mask = StoredMask (path, header)
+    if header['arity'] == 0:
+        return mask
+    return cs.ConnectionSet (StoredCSet (mask, path, header))
+
+def memmap (path, name, dtype, n):
+    if n == 0:
+        return numpy.empty (0, dtype = dtype)
+    return numpy.memmap (os.path.join (path, name), dtype = dtype,
+                         mode = 'r', shape = (n,))
+
+
+class StoredMask (cs.FiniteMask):
+    def __init__ (self, path, header):
+        cs.FiniteMask.__init__ (self)
+        self.path = path
+        (self.low0, self.high0, self.low1, self.high1) = header['bounds']
+        self.n = header['length']
+        self.sources = memmap (path, 'sources', header['sourceType'], self.n)
+        self.offsets = numpy.fromfile (os.path.join (path, 'offsets'),
+                                       dtype = numpy.int64)
+
+    def repr (self):
+        return 'load(%r)' % self.path
+
+    def __len__ (self):
+        return self.n
+
+    def count (self, low0, high0, low1, high1):
+        if low0 <= self.low0 and high0 >= self.high0:
+            (low1, high1) = (max (low1, self.low1), min (high1, self.high1))
+            if high1 <= low1:
+                return 0
+            return int (self.offsets[high1 - self.low1]
+                        - self.offsets[low1 - self.low1])
+        return sum (len (sources)
+                    for (sources, targets)
+                    in self.blockIterator (low0, high0, low1, high1, None))
+
+    # Ranges of positions of the connections of targets in [low1,
+    # high1), in blocks of about blockSize connections
+    #
+    def positionBlocks (self, low1, high1):
+        low1 = max (low1, self.low1)
+        high1 = min (high1, self.high1)
+        if low1 >= high1:
+            return
+        first = self.offsets[low1 - self.low1]
+        last = self.offsets[high1 - self.low1]
+        for start in range (first, last, cs.blockSize):
+            yield (start, min (start + cs.blockSize, last))
+
+    def targets (self, start, end):
+        # the targets of positions start to end
+        k0 = numpy.searchsorted (self.offsets, start, 'right') - 1
+        k1 = numpy.searchsorted (self.offsets, end, 'left')
+        counts = numpy.diff (numpy.clip (self.offsets[k0:k1 + 1], start, end))
+        return numpy.repeat (numpy.arange (k0, k0 + len (counts),
+                                           dtype = numpy.int64) + self.low1,
+                             counts)
+
+    def selected (self, low0, high0, low1, high1):
+        for (start, end) in self.positionBlocks (low1, high1):
+            sources = self.sources[start:end].astype (numpy.int64)
+            targets = self.targets (start, end)
+            keep = (sources >= low0) & (sources < high0)
+            yield (start, end, keep, sources[keep], targets[keep])
+
+    def iterator (self, low0, high0, low1, high1, state):
+        return cs.blocksToIterator (self.blockIterator (low0, high0,
+                                                        low1, high1,
+                                                        state))
+
+    def blockIterator (self, low0, high0, low1, high1, state):
+        for (start, end, keep, sources, targets) \
+                in self.selected (low0, high0, low1, high1):
+            yield (sources, targets)
+
+
+class StoredCSet (cs.CSet):
+    def __init__ (self, mask, path, header):
+        n = header['length']
+        self.columns = [memmap (path, 'values%d' % k, header['valueType'], n)
+                        for k in range (header['arity'])]
+        cs.CSet.__init__ (self, mask,
+                          *[StoredValueSet (mask, column)
+                            for column in self.columns])
+
+    def repr (self):
+        return self.mask ().repr ()
+
+    def startIteration (self, state):
+        return self
+
+    def blockIterator (self, low0, high0, low1, high1, state):
+        for (start, end, keep, sources, targets) \
+                in self._mask.selected (low0, high0, low1, high1):
+            yield (sources, targets,
+                   [ numpy.asarray (column[start:end])[keep]
+                     for column in self.columns ])
+
+
+# Value lookup for single connections of a stored connection set
+#
+class StoredValueSet (object):
+    def __init__ (self, mask, column):
+        self.mask = mask
+        self.column = column
+
+    def __call__ (self, i, j):
+        if not self.mask.low1 <= j < self.mask.high1:
+            raise KeyError ((i, j))
+        start = self.mask.offsets[j - self.mask.low1]
+        end = self.mask.offsets[j - self.mask.low1 + 1]
+        k = start + numpy.searchsorted (self.mask.sources[start:end], i)
+        if k == end or self.mask.sources[k] != i:
+            raise KeyError ((i, j))
+        return self.column[k].item ()
@@ -16,12 +16,37 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import numpy
+
+from . import _sparse
+
 try:
     from nineml.connection_generator import ConnectionGenerator
     HAVE_CG=True
 except ImportError:
     HAVE_CG=False
 
+# Yields the connections of a finite mask or connection set in
+# batches (sources, targets, values) where sources and targets are
+# int64 arrays and values is a C-contiguous float64 array with one
+# row per connection and one column per value set.  This is the form
+# in which libpycsa fetches connections, so that it only needs to
+# call into Python once per batch.
+#
+def batchIterator (c):
+    for (sources, targets, values) in _sparse.valueBlocks (c):
+        values = [numpy.asarray (v) for v in values]
+        for v in values:
+            if v.dtype.kind not in 'biuf':
+                raise TypeError ('connection generators require numeric value sets')
+        batch = numpy.empty ((len (sources), len (values)),
+                             dtype = numpy.float64)
+        for (k, v) in enumerate (values):
+            batch[:,k] = v
+        yield (numpy.ascontiguousarray (sources, dtype = numpy.int64),
+               numpy.ascontiguousarray (targets, dtype = numpy.int64),
+               batch)
+
 if HAVE_CG:
     from .csaobject import from_xml
     from .elementary import arity, cross, partition
@@ -65,6 +90,9 @@ if HAVE_CG:
         def __iter__ (self):
             return self.generator.__iter__ ()
 
+        def batches (self):
+            return batchIterator (self.generator)
+
 def connectionGeneratorClosureFromXML (element):
     cset = from_xml (element)
     if isinstance (cset, Closure):
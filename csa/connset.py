@@ -17,6 +17,8 @@
 #
 
 import copy
+import itertools
+import numpy
 
 from . import intervalset
 from . import valueset
@@ -90,12 +92,29 @@ class CSet (CSAObject):
 
     def startIteration (self, state):
         obj = copy.copy (self)
-        obj._mask = self.mask ().startIteration (state)
+        obj._mask = optimize (self.mask ()).startIteration (state)
+        obj.valueSets = [ valueset.startIteration (v, state)
+                          for v in self.valueSets ]
         return obj
 
     def iterator (self, low0, high0, low1, high1, state):
-        for (i, j) in self._mask.iterator (low0, high0, low1, high1, state):
-            yield (i, j, [ v (i, j) for v in self.valueSets ])
+        return valueBlocksToIterator (self.blockIterator (low0, high0,
+                                                          low1, high1,
+                                                          state))
+
+    def cursor (self, low0, high0, low1, high1, state):
+        return Cursor (self, low0, high0, low1, high1, state)
+
+    # Yields blocks (sources, targets, values) where values is a list
+    # with an array of values for each value set
+    #
+    def blockIterator (self, low0, high0, low1, high1, state):
+        for (sources, targets) in self._mask.blockIterator (low0, high0,
+                                                            low1, high1,
+                                                            state):
+            yield (sources, targets,
+                   [ valueset.evaluate (v, sources, targets)
+                     for v in self.valueSets ])
 
     def multisetSum (self, other):
         return CSetMultisetSum (self, other)
@@ -207,6 +226,12 @@ def coerceValueSet (obj):
     else:
         return valueSet (obj)
 
+# Masks are rewritten by the optimizer in _optimize before iteration
+#
+def optimize (mask):
+    from . import _optimize
+    return _optimize.optimize (mask)
+
 def isFinite (x):
     return isinstance (x, Finite)
 
@@ -222,6 +247,253 @@ def transpose (obj):
     return obj.transpose ()
 
 
+# Block iteration
+#
+# Masks can produce their connections in blocks: pairs (sources,
+# targets) of int64 arrays in the same post-order (target-major) as
+# produced by iterator.  Blocks hold at most around blockSize
+# connections.  A target may be split over consecutive blocks.
+#
+blockSize = 65536
+transposeTileSize = 16 * blockSize
+
+def emptyBlock ():
+    return (numpy.empty (0, dtype = numpy.int64),
+            numpy.empty (0, dtype = numpy.int64))
+
+def iteratorToBlocks (iterator):
+    while True:
+        chunk = list (itertools.islice (iterator, blockSize))
+        if not chunk:
+            return
+        a = numpy.array (chunk, dtype = numpy.int64).reshape (-1, 2)
+        yield (a[:,0].copy (), a[:,1].copy ())
+
+def blocksToIterator (blocks):
+    for (sources, targets) in blocks:
+        for c in zip (sources.tolist (), targets.tolist ()):
+            yield c
+
+def iteratorToValueBlocks (iterator, arity):
+    while True:
+        chunk = list (itertools.islice (iterator, blockSize))
+        if not chunk:
+            return
+        yield (numpy.array ([c[0] for c in chunk], dtype = numpy.int64),
+               numpy.array ([c[1] for c in chunk], dtype = numpy.int64),
+               [ valueset.valueArray ([c[2][k] for c in chunk])
+                 for k in range (arity) ])
+
+def valueBlocksToIterator (blocks):
+    for (sources, targets, values) in blocks:
+        columns = [ v.tolist () for v in values ]
+        for c in zip (sources.tolist (), targets.tolist (), *columns):
+            yield (c[0], c[1], list (c[2:]))
+
+def concatenateBlocks (blocks):
+    blocks = list (blocks)
+    if not blocks:
+        return emptyBlock ()
+    return (numpy.concatenate ([b[0] for b in blocks]),
+            numpy.concatenate ([b[1] for b in blocks]))
+
+# Concatenation of the ranges [start, start + count)
+#
+def expandRanges (start, counts):
+    offsets = numpy.cumsum (counts) - counts
+    return numpy.arange (counts.sum (), dtype = numpy.int64) \
+           + numpy.repeat (start - offsets, counts)
+
+def rangeBlocks (low, high, width):
+    # split [low, high) into ranges of about blockSize / width elements
+    step = max (1, blockSize // max (1, width))
+    for start in range (low, high, step):
+        yield (start, min (start + step, high))
+
+
+# BlockQueue buffers a block iterator and hands out the connections
+# of complete targets.  All connections with target < horizon have
+# been fetched.
+#
+class BlockQueue (object):
+    def __init__ (self, blocks):
+        self.blocks = blocks
+        self.sources = []
+        self.targets = []
+        self.done = False
+        self.horizon = 0
+
+    def empty (self):
+        return not any (len (t) for t in self.targets)
+
+    def fetch (self):
+        try:
+            (sources, targets) = next (self.blocks)
+        except StopIteration:
+            self.done = True
+            self.horizon = intervalset.infinity
+            return
+        if len (targets):
+            self.sources.append (sources)
+            self.targets.append (targets)
+            self.horizon = int (targets[-1])
+
+    def take (self, horizon):
+        (sources, targets) = concatenateBlocks (zip (self.sources,
+                                                     self.targets))
+        k = numpy.searchsorted (targets, horizon)
+        self.sources = [sources[k:]]
+        self.targets = [targets[k:]]
+        return (sources[:k], targets[:k])
+
+
+# Yield pairs of blocks from the two block iterators which cover the
+# same range of complete targets.  If finishEarly is true, stop as
+# soon as one of the iterators is exhausted.
+#
+def alignedBlocks (blocks1, blocks2, finishEarly = False):
+    q1 = BlockQueue (blocks1)
+    q2 = BlockQueue (blocks2)
+    while not (q1.done and q2.done):
+        if q1.horizon <= q2.horizon:
+            q1.fetch ()
+        else:
+            q2.fetch ()
+        if finishEarly and ((q1.done and q1.empty ())
+                            or (q2.done and q2.empty ())):
+            return
+        horizon = min (q1.horizon, q2.horizon)
+        b1 = q1.take (horizon)
+        b2 = q2.take (horizon)
+        if len (b1[1]) or len (b2[1]):
+            yield (b1, b2)
+
+
+# Yield the blocks of an iterator regrouped so that the connections
+# of a target are never split between blocks
+#
+def wholeTargetBlocks (blocks):
+    q = BlockQueue (blocks)
+    while not q.done:
+        q.fetch ()
+        b = q.take (q.horizon)
+        if len (b[1]):
+            yield b
+
+# Split a block into runs of consecutive targets, as (start, end)
+# index ranges
+#
+def targetRuns (targets):
+    starts = numpy.flatnonzero (numpy.diff (targets) > 1) + 1
+    bounds = numpy.concatenate (([0], starts, [len (targets)])).tolist ()
+    return zip (bounds[:-1], bounds[1:])
+
+# Map the connections of two blocks to int64 keys which preserve
+# post-order
+#
+def blockKeys (b1, b2):
+    sources = numpy.unique (numpy.concatenate ((b1[0], b2[0])))
+    targets = numpy.unique (numpy.concatenate ((b1[1], b2[1])))
+    width = len (sources)
+    return (numpy.searchsorted (targets, b1[1]) * width
+            + numpy.searchsorted (sources, b1[0]),
+            numpy.searchsorted (targets, b2[1]) * width
+            + numpy.searchsorted (sources, b2[0]))
+
+# For each connection in b1, return its occurrence number among equal
+# connections in b1 and the number of equal connections in b2
+#
+def blockMultiplicities (b1, b2):
+    (k1, k2) = blockKeys (b1, b2)
+    occurrence = numpy.arange (len (k1)) - numpy.searchsorted (k1, k1)
+    count = numpy.searchsorted (k2, k1, 'right') - numpy.searchsorted (k2, k1)
+    return (occurrence, count)
+
+
+# Cursors iterate over connections in post-order, like iterator, but
+# can also skip ahead: seek (c) returns the first remaining connection
+# which is not before c.  The default cursor first steps through the
+# iterator and then restarts the iterator of the connection set within
+# the remaining bounds.  This relies on iterators producing the same
+# connections for any subdivision of the bounds.
+#
+seekSteps = 16
+
+def postOrderKey (c):
+    return (c[1], c[0])
+
+class Cursor (object):
+    def __init__ (self, cset, low0, high0, low1, high1, state):
+        self.cset = cset
+        self.bounds = (low0, high0, low1, high1)
+        self.state = state
+        self.iterator = cset.iterator (low0, high0, low1, high1, state)
+
+    def next (self):
+        return next (self.iterator)
+
+    def seek (self, c):
+        (i, j) = c[:2]
+        key = (j, i)
+        iterator = self.iterator
+        for k in range (seekSteps):
+            x = next (iterator)
+            if (x[1], x[0]) >= key:
+                return x
+        # restarting is only worth while when skipping whole targets
+        while x[1] >= j - 1:
+            if (x[1], x[0]) >= key:
+                return x
+            x = next (iterator)
+        (low0, high0, low1, high1) = self.bounds
+        self.iterator = itertools.chain (
+            self.cset.iterator (max (i, low0), high0, j, j + 1, self.state),
+            self.windows (j + 1))
+        return next (self.iterator)
+
+    # Iterates over the targets from low1 in windows of doubling
+    # width, so that a restart only generates connections as far as
+    # they are used
+    #
+    def windows (self, low1):
+        (low0, high0, _, high1) = self.bounds
+        width = 1
+        while low1 < high1:
+            for x in self.cset.iterator (low0, high0,
+                                         low1, min (low1 + width, high1),
+                                         self.state):
+                yield x
+            low1 += width
+            width *= 2
+
+
+# Cursor over arrays of sources and targets in post-order, which
+# seeks by binary search, first among the targets and then among the
+# sources of the target
+#
+class ArrayCursor (object):
+    def __init__ (self, sources, targets):
+        self.sources = sources
+        self.targets = targets
+        self.position = 0
+
+    def next (self):
+        if self.position >= len (self.targets):
+            raise StopIteration
+        self.position += 1
+        return (int (self.sources[self.position - 1]),
+                int (self.targets[self.position - 1]))
+
+    def seek (self, c):
+        (i, j) = c[:2]
+        low = self.position
+        start = low + numpy.searchsorted (self.targets[low:], j, 'left')
+        end = start + numpy.searchsorted (self.targets[start:], j, 'right')
+        self.position = start \
+                        + numpy.searchsorted (self.sources[start:end], i)
+        return self.next ()
+
+
 # This is the fundamental mask class
 #
 class Mask (CSet):
@@ -229,11 +501,21 @@ class Mask (CSet):
         CSet.__init__ (self, self)
 
     def __len__ (self):
+        if isFinite (self):
+            N = self.count (*self.bounds ())
+            if N != None:
+                return N
         N = 0
         for c in self:
             N += 1
         return N
 
+    # Returns the number of connections within the bounds if it can be
+    # computed without generating the connections, otherwise None
+    #
+    def count (self, low0, high0, low1, high1):
+        return None
+
     def __iter__ (self):
         raise RuntimeError ('attempt to retrieve iterator over infinite mask')
 
@@ -277,6 +559,11 @@ class Mask (CSet):
     def iterator (self, low0, high0, low1, high1, state):
         return NotImplemented
 
+    def blockIterator (self, low0, high0, low1, high1, state):
+        # default action: collect the connections of iterator
+        return iteratorToBlocks (self.iterator (low0, high0, low1, high1,
+                                                state))
+
     def multisetSum (self, other):
         if isFinite (self) and isFinite (other):
             return FiniteMaskMultisetSum (self, other)
@@ -311,11 +598,19 @@ class Finite (object):
                 min (b1[2], b2[2]), max (b1[3], b2[3]))
 
     def __iter__ (self):
+        mask = optimize (self)
         state = State ()
-        obj = self.startIteration (state)
-        (low0, high0, low1, high1) = self.bounds ()
+        obj = mask.startIteration (state)
+        (low0, high0, low1, high1) = mask.bounds ()
         return obj.iterator (low0, high0, low1, high1, state)
 
+    def blocks (self):
+        mask = optimize (self)
+        state = State ()
+        obj = mask.startIteration (state)
+        (low0, high0, low1, high1) = mask.bounds ()
+        return obj.blockIterator (low0, high0, low1, high1, state)
+
 
 class FiniteMask (Finite, Mask):
     def __init__ (self):
@@ -372,27 +667,89 @@ class BinaryMask (BinaryCSAObject, Mask):
         return obj
 
 
+# Counts the connections of cross (set0, set1) * mask within the
+# bounds by counting the connections of mask within each pair of
+# intervals of the sets
+#
+maxCountIntervals = 64
+
+def boundedCount (set0, set1, mask, low0, high0, low1, high1):
+    if high0 <= low0 or high1 <= low1:
+        return 0
+    (lower0, upper0) = set0.intersection (
+        intervalset.IntervalSet ((low0, high0 - 1))).intervalBounds ()
+    (lower1, upper1) = set1.intersection (
+        intervalset.IntervalSet ((low1, high1 - 1))).intervalBounds ()
+    if len (lower0) * len (lower1) > maxCountIntervals:
+        return None
+    N = 0
+    for (a0, b0) in zip (lower0.tolist (), upper0.tolist ()):
+        for (a1, b1) in zip (lower1.tolist (), upper1.tolist ()):
+            n = mask.count (a0, b0 + 1, a1, b1 + 1)
+            if n == None:
+                return None
+            N += n
+    return N
+
+
 class MaskIntersection (BinaryMask):
     def __init__ (self, op1, op2):
         BinaryMask.__init__ (self, '*', op1, op2, 1)
 
     def iterator (self, low0, high0, low1, high1, state):
-        try:
-            iter1 = self.op1.iterator (low0, high0, low1, high1, state)
-            iter2 = self.op2.iterator (low0, high0, low1, high1, state)
-            (i1, j1) = next (iter1)
-            (i2, j2) = next (iter2)
-            while True:
-                if (j1, i1) < (j2, i2):
-                    (i1, j1) = next (iter1)
-                elif (j2, i2) < (j1, i1):
-                    (i2, j2) = next (iter2)
-                else:
-                    yield (i1, j1)
-                    (i1, j1) = next (iter1)
-                    (i2, j2) = next (iter2)
-        except StopIteration:
-            return
+        cursor1 = self.op1.cursor (low0, high0, low1, high1, state)
+        cursor2 = self.op2.cursor (low0, high0, low1, high1, state)
+        return leapfrog (cursor1, cursor2)
+
+    def count (self, low0, high0, low1, high1):
+        for (op1, op2) in [(self.op1, self.op2), (self.op2, self.op1)]:
+            if isinstance (op1, IntervalSetMask):
+                return boundedCount (op1.set0, op1.set1, op2,
+                                     low0, high0, low1, high1)
+        return None
+
+    # The second operand is only generated within the bounds of runs
+    # of targets of the first, so that a sparse first operand skips
+    # over most of a dense second one
+    #
+    def blockIterator (self, low0, high0, low1, high1, state):
+        blocks1 = self.op1.blockIterator (low0, high0, low1, high1, state)
+        for (sources, targets) in wholeTargetBlocks (blocks1):
+            for (a, b) in targetRuns (targets):
+                run = (sources[a:b], targets[a:b])
+                blocks2 = self.op2.blockIterator (int (run[0].min ()),
+                                                  int (run[0].max ()) + 1,
+                                                  int (run[1][0]),
+                                                  int (run[1][-1]) + 1,
+                                                  state)
+                for (b1, b2) in alignedBlocks (iter ([run]), blocks2, True):
+                    (occurrence, count) = blockMultiplicities (b1, b2)
+                    keep = occurrence < count
+                    yield (b1[0][keep], b1[1][keep])
+
+
+# Merge of two cursors yielding the connections of the first which
+# are matched by the second.  The cursor which is behind seeks to the
+# connection of the other, so that a sparse operand lets the merge
+# skip over a dense one.
+#
+def leapfrog (cursor1, cursor2):
+    try:
+        c1 = cursor1.next ()
+        c2 = cursor2.next ()
+        while True:
+            k1 = (c1[1], c1[0])
+            k2 = (c2[1], c2[0])
+            if k1 < k2:
+                c1 = cursor1.seek (c2)
+            elif k2 < k1:
+                c2 = cursor2.seek (c1)
+            else:
+                yield c1
+                c1 = cursor1.next ()
+                c2 = cursor2.next ()
+    except StopIteration:
+        return
 
 
 class FiniteMaskIntersection (Finite, MaskIntersection):
@@ -408,6 +765,13 @@ class MaskMultisetSum (BinaryMask):
     def __init__ (self, op1, op2):
         BinaryMask.__init__ (self, "+", op1, op2, 0)
 
+    def count (self, low0, high0, low1, high1):
+        n1 = self.op1.count (low0, high0, low1, high1)
+        n2 = self.op2.count (low0, high0, low1, high1)
+        if n1 == None or n2 == None:
+            return None
+        return n1 + n2
+
     def iterator (self, low0, high0, low1, high1, state):
         try:
             iter1 = self.op1.iterator (low0, high0, low1, high1, state)
@@ -447,6 +811,16 @@ class MaskMultisetSum (BinaryMask):
         except StopIteration:
             return
 
+    def blockIterator (self, low0, high0, low1, high1, state):
+        blocks1 = self.op1.blockIterator (low0, high0, low1, high1, state)
+        blocks2 = self.op2.blockIterator (low0, high0, low1, high1, state)
+        for (b1, b2) in alignedBlocks (blocks1, blocks2):
+            sources = numpy.concatenate ((b1[0], b2[0]))
+            targets = numpy.concatenate ((b1[1], b2[1]))
+            # lexsort is stable so op1 connections come first
+            order = numpy.lexsort ((sources, targets))
+            yield (sources[order], targets[order])
+
 
 class FiniteMaskMultisetSum (Finite, MaskMultisetSum):
     def __init__ (self, op1, op2):
@@ -483,6 +857,14 @@ class MaskDifference (BinaryMask):
         except StopIteration:
             return
 
+    def blockIterator (self, low0, high0, low1, high1, state):
+        blocks1 = self.op1.blockIterator (low0, high0, low1, high1, state)
+        blocks2 = self.op2.blockIterator (low0, high0, low1, high1, state)
+        for (b1, b2) in alignedBlocks (blocks1, blocks2):
+            (occurrence, count) = blockMultiplicities (b1, b2)
+            keep = occurrence >= count
+            yield (b1[0][keep], b1[1][keep])
+
 
 def cmpPostOrder (c0, op1):
     return  ((c0[1], c0[0]) > (op1[1], op1[0])) -  ((c0[1], c0[0]) < (op1[1], op1[0]))
@@ -508,38 +890,70 @@ def cmp_to_key(mycmp):
     return K
 
 
-class ExplicitMask (FiniteMask):
-    def __init__ (self, connections):
+# Finite mask stored as arrays of sources and targets in post-order
+# with an index of offsets: the connections of target j are at
+# positions offsets[j - low1] to offsets[j - low1 + 1]
+#
+class ArrayMask (FiniteMask):
+    def __init__ (self, sources, targets):
         FiniteMask.__init__ (self)
-        self.connections = list (connections)
-        self.connections.sort (key=cmp_to_key(cmpPostOrder))
-        if connections:
-            self.low0 = min ((i for (i, j) in self.connections))
-            self.high0 = max ((i for (i, j) in self.connections)) + 1
-            self.low1 = self.connections[0][1]
-            self.high1 = self.connections[-1][1] + 1
+        sources = numpy.asarray (sources, dtype = numpy.int64)
+        targets = numpy.asarray (targets, dtype = numpy.int64)
+        order = numpy.lexsort ((sources, targets))
+        self.sources = sources[order]
+        self.targets = targets[order]
+        if len (order) > 0:
+            self.low0 = int (self.sources.min ())
+            self.high0 = int (self.sources.max ()) + 1
+            self.low1 = int (self.targets[0])
+            self.high1 = int (self.targets[-1]) + 1
+        self.offsets = numpy.searchsorted (self.targets,
+                                           numpy.arange (self.low1,
+                                                         self.high1 + 1))
 
     def __len__ (self):
-        return len (self.connections)
+        return len (self.targets)
+
+    def count (self, low0, high0, low1, high1):
+        return len (self.select (low0, high0, low1, high1)[1])
+
+    # Returns the arrays (sources, targets) of the connections within
+    # the bounds
+    #
+    def select (self, low0, high0, low1, high1):
+        low1 = min (max (low1, self.low1), self.high1)
+        high1 = min (max (high1, low1), self.high1)
+        start = self.offsets[low1 - self.low1]
+        end = self.offsets[high1 - self.low1]
+        sources = self.sources[start:end]
+        targets = self.targets[start:end]
+        if low0 > self.low0 or high0 < self.high0:
+            keep = (sources >= low0) & (sources < high0)
+            return (sources[keep], targets[keep])
+        return (sources, targets)
 
     def iterator (self, low0, high0, low1, high1, state):
-        if not self.isBoundedBy (low0, high0, low1, high1):
-            return iter (self.connections)
-        else:
-            return self.boundedIterator (low0, high0, low1, high1, state)
+        return blocksToIterator (self.blockIterator (low0, high0,
+                                                     low1, high1, state))
 
-    def boundedIterator (self, low0, high0, low1, high1, state):
-        iterator = iter (self.connections)
-        try:
-            (i, j) = next (iterator)
-            while j < low1:
-                (i, j) = next (iterator)
-            while j < high1:
-                if low0 <= i and i < high0:
-                    yield (i, j)
-                (i, j) = next (iterator)
-        except StopIteration:
-            return
+    def blockIterator (self, low0, high0, low1, high1, state):
+        (sources, targets) = self.select (low0, high0, low1, high1)
+        for start in range (0, len (targets), blockSize):
+            yield (sources[start:start + blockSize],
+                   targets[start:start + blockSize])
+
+    def cursor (self, low0, high0, low1, high1, state):
+        return ArrayCursor (*self.select (low0, high0, low1, high1))
+
+    def transpose (self):
+        return ArrayMask (self.targets, self.sources)
+
+
+class ExplicitMask (ArrayMask):
+    def __init__ (self, connections):
+        connections = numpy.array ([c[:2] for c in connections],
+                                   dtype = numpy.int64).reshape (-1, 2)
+        ArrayMask.__init__ (self, connections[:,0], connections[:,1])
 
 
 class IntervalSetMask (Mask):
@@ -560,6 +974,14 @@ class IntervalSetMask (Mask):
     def __contains__ (self, c):
         return c[0] in self.set0 and c[1] in self.set1
 
+    # bulk membership test for arrays of sources and targets
+    #
+    def contains (self, sources, targets):
+        return self.set0.contains (sources) & self.set1.contains (targets)
+
+    def count (self, low0, high0, low1, high1):
+        return self.set0.count (low0, high0) * self.set1.count (low1, high1)
+
     def transpose (self):
         return IntervalSetMask (self.set1, self.set0)
 
@@ -598,6 +1020,31 @@ class IntervalSetMask (Mask):
         except StopIteration:
             return
 
+    def blockIterator (self, low0, high0, low1, high1, state):
+        sources = self.set0.boundedArray (low0, high0)
+        nSources = len (sources)
+        if not nSources:
+            return
+        for i1 in self.set1.intervalIterator ():
+            if i1[0] >= high1:
+                break
+            if i1[1] < low1:
+                continue
+            for (start, end) in rangeBlocks (max (i1[0], low1),
+                                             min (i1[1] + 1, high1),
+                                             nSources):
+                if nSources > blockSize:
+                    for j in range (start, end):
+                        for k in range (0, nSources, blockSize):
+                            s = sources[k:k + blockSize]
+                            yield (s, numpy.full (len (s), j,
+                                                  dtype = numpy.int64))
+                else:
+                    yield (numpy.tile (sources, end - start),
+                           numpy.repeat (numpy.arange (start, end,
+                                                       dtype = numpy.int64),
+                                         nSources))
+
     def intersection (self, other):
         if isinstance (other, IntervalSetMask):
             set0 = self.set0.intersection (other.set0)
@@ -725,6 +1172,10 @@ class ISetBoundedMask (FiniteMask):
                 self.high1 = high1
         assert self.high0 != inf and self.high1 != inf, 'infinite ISetBoundedMask:s currently not supported'
 
+    def count (self, low0, high0, low1, high1):
+        return boundedCount (self.set0, self.set1, self.subMask,
+                             low0, high0, low1, high1)
+
     def startIteration (self, state):
         obj = copy.copy (self)
         obj.subMask = self.subMask.startIteration (state)
@@ -787,6 +1238,25 @@ class ISetBoundedMask (FiniteMask):
         except StopIteration:
             return
 
+    def blockIterator (self, low0, high0, low1, high1, state):
+        # visits the sub-mask in the same order as iterator
+        for i1 in self.set1.intervalIterator ():
+            if i1[0] >= high1:
+                break
+            if i1[1] < low1:
+                continue
+            for i0 in self.set0.intervalIterator ():
+                if i0[0] >= high0:
+                    break
+                if i0[1] < low0:
+                    continue
+                for b in self.subMask.blockIterator (max (i0[0], low0),
+                                                     min (i0[1] + 1, high0),
+                                                     max (i1[0], low1),
+                                                     min (i1[1] + 1, high1),
+                                                     state):
+                    yield b
+
     def repr (self):
         return '%s*%s' % (IntervalSetMask._sets_to_repr (self.set0, self.set1),
                           self.subMask._repr_as_op2 (self.precedence))
@@ -839,21 +1309,99 @@ class BinaryCSet (BinaryCSAObject, CSet):
         self.name = operator
         self.op1 = op1
         self.op2 = op2
-        self.valueSetMap = None
+
+    def startIteration (self, state):
+        obj = CSet.startIteration (self, state)
+        obj.op1 = self.op1.startIteration (state)
+        obj.op2 = self.op2.startIteration (state)
+        return obj
+
+    def blockIterator (self, low0, high0, low1, high1, state):
+        return iteratorToValueBlocks (self.iterator (low0, high0,
+                                                     low1, high1,
+                                                     state),
+                                      self.arity)
 
     def makeFiniteValueSet (self, k, bounds):
-        if self.valueSetMap == None:
-            self.valueSetMap = self.makeValueSetMap (bounds)
-        return lambda i, j: self.valueSetMap[(i, j)][k]
+        return IndexedValueSet (self, k, bounds)
 
-    def makeValueSetMap (self, bounds):
-        m = {}
+    def makeValueStore (self, bounds):
         state = State ()
         obj = self.startIteration (state)
         (low0, high0, low1, high1) = bounds
-        for (i, j, v) in obj.iterator (low0, high0, low1, high1, state):
-            m[(i, j)] = v
-        return m
+        blocks = list (obj.blockIterator (low0, high0, low1, high1, state))
+        (sources, targets) = concatenateBlocks (blocks)
+        values = [ numpy.concatenate ([b[2][k] for b in blocks]
+                                      + [numpy.empty (0)])
+                   for k in range (self.arity) ]
+        return ValueStore (sources, targets, values, low0, high0)
+
+
+# The values of a finite connection-set in columnar form: the
+# connections as keys in post-order and an array of values for each
+# value set.  Values are looked up by binary search.  Of multiple
+# connections, the value of the last is found.
+#
+class ValueStore (object):
+    def __init__ (self, sources, targets, values, low0, high0):
+        self.low0 = low0
+        self.width = max (high0 - low0, 1)
+        self.keys = targets * self.width + (sources - low0)
+        self.values = values
+
+    def __len__ (self):
+        return len (self.keys)
+
+    # Returns the indices of the connections (i, j) for arrays i and j
+    #
+    def index (self, i, j):
+        i = numpy.asarray (i, dtype = numpy.int64)
+        j = numpy.asarray (j, dtype = numpy.int64)
+        keys = j * self.width + (i - self.low0)
+        index = numpy.searchsorted (self.keys, keys, 'right') - 1
+        found = (index >= 0) & (i >= self.low0) & (i < self.low0 + self.width)
+        if len (self.keys):
+            found &= self.keys[numpy.maximum (index, 0)] == keys
+        if not numpy.all (found):
+            raise KeyError ('connection not in connection-set')
+        return index
+
+
+# A value set of a BinaryCSet within bounds.  The values of all value
+# sets are collected into a ValueStore at the first lookup.  During an
+# iteration, the store is kept in the iteration state, so that it is
+# shared by the value sets of the connection-set and freed when the
+# iteration finishes.
+#
+class IndexedValueSet (valueset.ValueSet):
+    derivedAttributes = frozenset (['stores'])
+
+    def __init__ (self, c, k, bounds):
+        valueset.ValueSet.__init__ (self)
+        self.c = c
+        self.k = k
+        self.bounds = bounds
+        self.stores = {}
+
+    def startIteration (self, state):
+        obj = copy.copy (self)
+        obj.stores = state.setdefault ('valueStores', {})
+        return obj
+
+    def valueStore (self):
+        key = (id (self.c), self.bounds)
+        if key not in self.stores:
+            self.stores[key] = self.c.makeValueStore (self.bounds)
+        return self.stores[key]
+
+    def __call__ (self, i, j):
+        store = self.valueStore ()
+        v = store.values[self.k][store.index (i, j)]
+        return v.item () if isinstance (v, numpy.generic) else v
+
+    def evaluate (self, i, j):
+        store = self.valueStore ()
+        return store.values[self.k][store.index (i, j)]
 
 
 class BinaryCSets (BinaryCSet):
@@ -869,22 +1417,9 @@ class CSetIntersection (BinaryCSet):
         self._mask = op1.mask ().intersection (op2)
 
     def iterator (self, low0, high0, low1, high1, state):
-        iter1 = self.op1.iterator (low0, high0, low1, high1, state)
-        iter2 = self.op2.iterator (low0, high0, low1, high1, state)
-        try:
-            (i1, j1, v1) = next (iter1)
-            (i2, j2) = next (iter2)
-            while True:
-                if (j1, i1) < (j2, i2):
-                    (i1, j1, v1) = next (iter1)
-                elif (j2, i2) < (j1, i1):
-                    (i2, j2) = next (iter2)
-                else:
-                    yield (i1, j1, v1)
-                    (i1, j1, v1) = next (iter1)
-                    (i2, j2) = next (iter2)
-        except StopIteration:
-            return        
+        cursor1 = self.op1.cursor (low0, high0, low1, high1, state)
+        cursor2 = self.op2.cursor (low0, high0, low1, high1, state)
+        return leapfrog (cursor1, cursor2)
 
 
 class CSetMultisetSum (BinaryCSets):
@@ -944,6 +1479,7 @@ class CSetMultisetSum (BinaryCSets):
 
 class TransposedMask (Finite, Mask):
     def __init__ (self, mask):
+        Mask.__init__ (self)
         self.subMask = mask
 
     def transpose (self):
@@ -953,6 +1489,9 @@ class TransposedMask (Finite, Mask):
         (low0, high0, low1, high1) = self.subMask.bounds ()
         return (low1, high1, low0, high0)
 
+    def count (self, low0, high0, low1, high1):
+        return self.subMask.count (low1, high1, low0, high0)
+
     def startIteration (self, state):
         obj = copy.copy (self)
         obj.transposedState = state.transpose ()
@@ -960,16 +1499,65 @@ class TransposedMask (Finite, Mask):
         return obj
 
     def iterator (self, low0, high0, low1, high1, state):
-        ls = []
-        for c in self.subMask.iterator (low1, high1, low0, high0, \
-                                        self.transposedState):
-            ls.append ((c[1], c[0]))
-        ls.sort (key=cmp_to_key(cmpPostOrder))
-        return iter (ls)
+        return blocksToIterator (self.blockIterator (low0, high0,
+                                                     low1, high1,
+                                                     state))
+
+    # Connections are sorted in tiles of sources of the sub-mask, so
+    # that at most about transposeTileSize connections are held in
+    # memory.  The sub-mask is first iterated as a whole.  If it turns
+    # out to hold more connections than a tile, the width of the tiles
+    # is estimated from the connections seen so far, and each tile is
+    # then collected from the sub-mask, bounded to the sources of the
+    # tile.
+    #
+    def blockIterator (self, low0, high0, low1, high1, state):
+        (bLow0, bHigh0, bLow1, bHigh1) = self.bounds ()
+        (low0, high0) = (max (low0, bLow0), min (high0, bHigh0))
+        (low1, high1) = (max (low1, bLow1), min (high1, bHigh1))
+        blocks = []
+        n = 0
+        for block in self.subMask.blockIterator (low1, high1, low0, high0,
+                                                 self.transposedState):
+            blocks.append (block)
+            n += len (block[0])
+            if n > transposeTileSize:
+                break
+        else:
+            for block in self.sortedBlocks (blocks):
+                yield block
+            return
+        # estimate the number of connections from the fraction of the
+        # targets of the sub-mask seen
+        seen = blocks[-1][1][-1] + 1 - low0
+        estimate = n * (high0 - low0) / seen
+        width = max (1, int ((high1 - low1) * transposeTileSize / estimate))
+        blocks = None
+        start = low1
+        while start < high1:
+            end = min (start + width, high1)
+            tile = list (self.subMask.blockIterator (start, end, low0, high0,
+                                                     self.transposedState))
+            for block in self.sortedBlocks (tile):
+                yield block
+            n = sum (len (block[0]) for block in tile)
+            start = end
+            width = max (1, min (16 * width,
+                                 width * transposeTileSize // max (n, 1)))
+
+    @staticmethod
+    def sortedBlocks (subBlocks):
+        (targets, sources) = concatenateBlocks (subBlocks)
+        order = numpy.lexsort ((sources, targets))
+        sources = sources[order]
+        targets = targets[order]
+        for k in range (0, len (targets), blockSize):
+            yield (sources[k:k + blockSize], targets[k:k + blockSize])
 
 
 class ShiftedMask (Mask):
     def __init__ (self, mask, M, N):
+        Mask.__init__ (self)
         self.subMask = mask
         self.M = M
         self.N = N
@@ -979,6 +1567,13 @@ class ShiftedMask (Mask):
         obj.subMask = self.subMask.startIteration (state)
         return obj
 
+    def count (self, low0, high0, low1, high1):
+        (low0, high0) = (max (low0 - self.M, 0), high0 - self.M)
+        (low1, high1) = (max (low1 - self.N, 0), high1 - self.N)
+        if high0 <= low0 or high1 <= low1:
+            return 0
+        return self.subMask.count (low0, high0, low1, high1)
+
     def iterator (self, low0, high0, low1, high1, state):
         low0 -= self.M
         high0 -= self.M
@@ -991,6 +1586,18 @@ class ShiftedMask (Mask):
             if i1 >= 0 and j1 >= 0:
                 yield (i1, j1)
 
+    def blockIterator (self, low0, high0, low1, high1, state):
+        for (sources, targets) in \
+                self.subMask.blockIterator (max (low0 - self.M, 0),
+                                            high0 - self.M,
+                                            max (low1 - self.N, 0),
+                                            high1 - self.N,
+                                            state):
+            sources = sources + self.M
+            targets = targets + self.N
+            keep = (sources >= 0) & (targets >= 0)
+            yield (sources[keep], targets[keep])
+
 
 class FiniteShiftedMask (Finite, ShiftedMask):
     def bounds (self):
@@ -1040,6 +1647,9 @@ class MaskPartition (Finite, Mask):
     def bounds (self):
         return self.subMask.bounds ()
 
+    def count (self, low0, high0, low1, high1):
+        return self.subMask.count (low0, high0, low1, high1)
+
     def startIteration (self, state):
         for key in self.state:
             state[key] = self.state[key]
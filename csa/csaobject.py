@@ -57,6 +57,15 @@ class CSAObject (object):
     def __repr__ (self):
         return 'CSA(%s)' % self.repr ()
 
+    # Copies are usually modified, so they do not inherit the
+    # structural key memoized by _cache
+    #
+    def __copy__ (self):
+        obj = self.__class__.__new__ (self.__class__)
+        obj.__dict__.update (self.__dict__)
+        obj.__dict__.pop ('_structuralKey', None)
+        return obj
+
     def repr (self):
         if hasattr (self, 'name'):
             return self.name
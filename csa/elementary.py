@@ -24,6 +24,13 @@ from . import connset as _cs
 from . import valueset as _vs
 from . import _elementary
 from . import _misc
+from . import _optimize
+from . import _sparse
+from . import _store
+from . import _parallel
+from . import _balance
+from . import _profile
+from . import _cache
 from .csaobject import registerTag
 
 # Connection-Set constructor
@@ -64,14 +71,14 @@ def vset (obj):
 # Intervals
 #
 def ival (beg, end):
-    return _iset.IntervalSet ((beg, end))
+    return _cache.intern (_iset.IntervalSet ((beg, end)))
 
 N = _iset.N
 
 # Cartesian product
 #
 def cross (set0, set1):
-    return _cs.intervalSetMask (set0, set1)
+    return _cache.intern (_cs.intervalSetMask (set0, set1))
 
 # Elementary masks
 #
@@ -91,6 +98,62 @@ def partition (c, masks, selected, seed = None):
     elif isinstance (c, _cs.ConnectionSet):
         return _cs.ConnectionSet (_cs.CSetPartition (c, masks, selected, seed))
 
+# Returns K cross masks for partition which divide the targets of
+# the finite mask or connection set c into ranges with about the same
+# expected number of connections
+#
+def balanced_masks (c, K):
+    return _balance.balancedMasks (c, K)
+
+# Expression optimizer
+#
+# Returns the mask which is iterated in place of obj.  If log is a
+# list, a tuple (rule, before, after) is appended for each rewrite.
+#
+def optimize (obj, log = None):
+    return _optimize.optimize (mask (obj), log)
+
+# Compressed sparse arrays
+#
+# The connection matrix has sources as rows and targets as columns.
+# to_csr and to_csc return (indptr, indices, values), where values
+# is a list with one array per value set, or scipy.sparse matrices if
+# sparse is true.
+#
+def to_csr (c, shape = None, sparse = False):
+    return _sparse.toCSR (c, shape, sparse)
+
+def to_csc (c, shape = None, sparse = False):
+    return _sparse.toCSC (c, shape, sparse)
+
+# Parallel iteration
+#
+# Iterates over the finite mask or connection set c in post-order,
+# evaluating chunks of the target range in a pool of processes
+#
+def parallel_iter (c, processes = None):
+    return _parallel.parallelIter (c, processes)
+
+# Profiling
+#
+# Iterates over the finite mask or connection set c and returns a
+# report of the connections produced and the time spent by each node
+# of the expression
+#
+def profile (c):
+    return _profile.profile (c)
+
+# On-disk storage
+#
+# store writes a finite mask or connection set to the directory path,
+# from which load returns it memory-mapped
+#
+def store (c, path, valueType = float):
+    _store.store (c, path, valueType)
+
+def load (path):
+    return _store.load (path)
+
 # Utilities
 #
 def tabulate (c):
@@ -22,36 +22,99 @@ import numpy as _numpy
 
 from . import intervalset as _iset
 
+# Geometries map indices to coordinates.  Called with an index they
+# return a point; called with an array of indices they return an
+# (n, dim) array of coordinates.
+#
+class Geometry (object):
+    def __call__ (self, i):
+        if type (i) is int or _numpy.ndim (i) == 0:
+            return self.point (i)
+        return self.coordinates (_numpy.asarray (i, dtype = _numpy.int64))
+
+    def point (self, i):
+        return tuple (self.coordinates (_numpy.array ([i]))[0].tolist ())
+
+    # A function mapping an index to a point, for fast scalar calls
+    #
+    def pointFunction (self):
+        return self.point
+
+    def coordinates (self, i):
+        return NotImplemented
+
+    # Index of the element of domain closest to a point
+    #
+    def nearest (self, p, domain):
+        indices = domain.boundedArray (domain.min (), domain.max () + 1)
+        d = self.coordinates (indices) - _numpy.array (p, dtype = float)
+        return int (indices[(d * d).sum (axis = 1).argmin ()])
+
+
+class Grid2d (Geometry):
+    def __init__ (self, width, xScale, yScale, x0, y0):
+        self.type = 'grid'
+        self.dim = 2
+        self.width = width
+        self.xScale = xScale / width
+        self.yScale = yScale / width
+        self.x0 = x0
+        self.y0 = y0
+
+    def point (self, i):
+        return (self.x0 + self.xScale * (i % self.width),
+                self.y0 + self.yScale * (i // self.width))
+
+    def pointFunction (self):
+        (width, xScale, yScale, x0, y0) = \
+            (self.width, self.xScale, self.yScale, self.x0, self.y0)
+        return lambda i: (x0 + xScale * (i % width), y0 + yScale * (i // width))
+
+    def coordinates (self, i):
+        return _numpy.column_stack ((self.x0 + self.xScale * (i % self.width),
+                                     self.y0 + self.yScale * (i // self.width)))
+
+    def inverse (self, x, y):
+        return int (round (x / self.xScale - self.x0)) \
+               + self.width * int (round (y / self.yScale - self.y0))
+
 def grid2d (width, xScale = 1.0, yScale = 1.0, x0 = 0.0, y0 = 0.0):
-    xScale /= width
-    yScale /= width
-    g = lambda i: \
-        (x0 + xScale * (i % width), y0 + yScale * (i // width))
-    g.type = 'grid'
-    g.width = width
-    g.xScale = xScale
-    g.yScale = yScale
-    g.x0 = x0
-    g.y0 = y0
-    g.inverse = lambda x, y: \
-                    int (round (x / xScale - x0)) \
-                    + width * int (round (y / yScale - y0))
-    return g
+    return Grid2d (width, xScale, yScale, x0, y0)
+
+
+class Random2d (Geometry):
+    derivedAttributes = frozenset (['pointList'])
+
+    def __init__ (self, N, xScale, yScale):
+        self.type = 'ramdom'
+        self.dim = 2
+        self.N = N
+        self.xScale = xScale
+        self.yScale = yScale
+        self.coords = _numpy.array ([(xScale * _random.random (),
+                                      yScale * _random.random ())
+                                     for i in range (0, N)],
+                                    dtype = float).reshape ((N, 2))
+        # the points as tuples, for single indices
+        self.pointList = [tuple (p) for p in self.coords.tolist ()]
+
+    def point (self, i):
+        return self.pointList[i]
+
+    def pointFunction (self):
+        return self.pointList.__getitem__
+
+    def coordinates (self, i):
+        return self.coords[i]
+
+    def inverse (self, x, y, domain = None):
+        if domain == None:
+            domain = _iset.IntervalSet ((0, self.N - 1))
+        return self.nearest ((x, y), domain)
 
 def random2d (N, xScale = 1.0, yScale = 1.0):
-    coords = [(xScale * _random.random (), yScale * _random.random ())
-              for i in range (0, N)]
-    g = lambda i: coords[i]
-    g.type = 'ramdom'
-    g.N = N
-    g.xScale = xScale
-    g.yScale = yScale
-    # We should use a KD-tree here
-    g.inverse = lambda x, y, domain=_iset.IntervalSet ((0, N - 1)): \
-                    _numpy.array ([euclidDistance2d ((x, y), g(i)) \
-                                   for i in domain]).argmin () \
-                                   + domain.min ()
-    return g
+    return Random2d (N, xScale, yScale)
+
 
 class ProjectionOperator (object):
     def __init__ (self, projection):
@@ -61,14 +124,87 @@ class ProjectionOperator (object):
         projection = self.projection
         return lambda i: projection (g (i))
 
+
+# Metrics map pairs of indices to distances.  They are called with a
+# pair of indices or with a pair of index arrays, which are broadcast
+# against each other.  Metrics with known geometries can be used with
+# spatial indices.
+#
+def _coordinates (g, i):
+    if isinstance (g, Geometry):
+        return g.coordinates (i)
+    # other callables, e.g., projections, map one index at a time
+    return _numpy.array ([g (k) for k in i.tolist ()],
+                         dtype = float).reshape ((len (i), -1))
+
+class Metric (object):
+    # offsets of the periodic images of the space
+    images = [None]
+    derivedAttributes = frozenset (['scalarDistance'])
+
+    def __init__ (self, g1, g2):
+        self.geometries = (g1, g2)
+        # distances between single elements, without the dispatch on
+        # the type of the indices
+        p1 = g1.pointFunction () if isinstance (g1, Geometry) else g1
+        p2 = g2.pointFunction () if isinstance (g2, Geometry) else g2
+        distance = self.distanceFunction ()
+        self.scalarDistance = lambda i, j: distance (p1 (i), p2 (j))
+
+    def __call__ (self, i, j):
+        if type (i) is int and type (j) is int:
+            return self.scalarDistance (i, j)
+        (g1, g2) = self.geometries
+        if _numpy.ndim (i) == 0 and _numpy.ndim (j) == 0:
+            return self.distance (g1 (i), g2 (j))
+        (i, j) = _numpy.broadcast_arrays (_numpy.asarray (i, dtype = _numpy.int64),
+                                          _numpy.asarray (j, dtype = _numpy.int64))
+        return self.distances (i.ravel (), j.ravel ()).reshape (i.shape)
+
+    def evaluate (self, i, j):
+        return self.distances (i, j)
+
+    def distance (self, p1, p2):
+        return NotImplemented
+
+    def distanceFunction (self):
+        return self.distance
+
+    # Distances between the elements of two 1-D index arrays
+    #
+    def distances (self, i, j):
+        (g1, g2) = self.geometries
+        return self.pointDistances (_coordinates (g1, i), _coordinates (g2, j))
+
+    def pointDistances (self, p1, p2):
+        return NotImplemented
+
+
 def euclidDistance2d (p1, p2):
     dx = p1[0] - p2[0]
     dy = p1[1] - p2[1]
     return _math.sqrt (dx * dx + dy * dy)
 
+# Distances between arrays of points, with the same arithmetic as
+# euclidDistance2d
+#
+def euclidDistances (p1, p2):
+    d = p1 - p2
+    return _numpy.sqrt ((d * d).sum (axis = 1))
+
+class EuclidMetric2d (Metric):
+    def distance (self, p1, p2):
+        return euclidDistance2d (p1, p2)
+
+    def distanceFunction (self):
+        return euclidDistance2d
+
+    def pointDistances (self, p1, p2):
+        return euclidDistances (p1, p2)
+
 def euclidMetric2d (g1, g2 = None):
     g2 = g1 if g2 == None else g2
-    return lambda i, j: euclidDistance2d (g1 (i), g2 (j))
+    return EuclidMetric2d (g1, g2)
 
 # These functions were contributed by Dr. Birgit Kriener
 
@@ -78,12 +214,64 @@ def euclidToroidDistance2d (p1, p2, xScale=1.0, yScale=1.0):
     dy = ddy if ddy < yScale/2. else  yScale - ddy
     return _math.sqrt (dx * dx + dy * dy)
 
+def euclidToroidDistances2d (p1, p2, xScale=1.0, yScale=1.0):
+    dd = _numpy.abs (p1 - p2)
+    scale = _numpy.array ([xScale, yScale])
+    d = _numpy.where (dd < scale/2., dd, scale - dd)
+    return _numpy.sqrt ((d * d).sum (axis = 1))
+
+class EuclidToroidMetric2d (Metric):
+    def __init__ (self, g1, g2, xScale, yScale):
+        self.xScale = xScale
+        self.yScale = yScale
+        Metric.__init__ (self, g1, g2)
+        # Neighbours across the borders are found in the images of the
+        # torus
+        self.images = [(dx, dy)
+                       for dx in (-xScale, 0.0, xScale)
+                       for dy in (-yScale, 0.0, yScale)]
+
+    def distance (self, p1, p2):
+        return euclidToroidDistance2d (p1, p2, self.xScale, self.yScale)
+
+    def pointDistances (self, p1, p2):
+        return euclidToroidDistances2d (p1, p2, self.xScale, self.yScale)
+
 def euclidToroidMetric2d (g1, g2 = None, xScale=1.0, yScale=1.0):
     g2 = g1 if g2 == None else g2
-    return lambda i, j: euclidToroidDistance2d (g1 (i), g2 (j), xScale, yScale)
+    return EuclidToroidMetric2d (g1, g2, xScale, yScale)
 
 # 3D functions
 
+class Grid3d (Geometry):
+    def __init__ (self, width, xScale, yScale, zScale, x0, y0, z0):
+        self.type = 'grid3d'
+        self.dim = 3
+        self.width = width
+        self.xScale = xScale / width
+        self.yScale = yScale / width
+        self.zScale = zScale / width
+        self.x0 = x0
+        self.y0 = y0
+        self.z0 = z0
+
+    def point (self, i):
+        width = self.width
+        return (self.x0 + self.xScale * (i % width),
+                self.y0 + self.yScale * ((i % (width*width)) // width),
+                self.z0 + self.zScale * (i // (width*width)))
+
+    def coordinates (self, i):
+        width = self.width
+        return _numpy.column_stack ((self.x0 + self.xScale * (i % width),
+                                     self.y0 + self.yScale * ((i % (width*width)) // width),
+                                     self.z0 + self.zScale * (i // (width*width))))
+
+    def inverse (self, x, y, z):
+        return int (round (x / self.xScale - self.x0)) \
+               + self.width * (int (round (y / self.yScale - self.y0)
+               + self.width * int (round (z / self.zScale - self.z0))))
+
 def grid3d(width, xScale = 1.0, yScale = 1.0, zScale = 1.0, x0 = 0.0, y0 = 0.0, z0 = 0.0):
     """Returns a 3D grid between (0, 0, 0) and (1, 1, 1)
     :param width: The number of rows/columns the grid has
@@ -101,25 +289,33 @@ def grid3d(width, xScale = 1.0, yScale = 1.0, zScale = 1.0, x0 = 0.0, y0 = 0.0,
     :param z0: Translates the grid along the z axis
     :type zScale: float
     :return: A callable grid that returns 3d positions when given an index"""
-    xScale /= width
-    yScale /= width
-    zScale /= width
-    g = lambda i: \
-        (x0 + xScale * (i % width), y0 + yScale * ((i % (width*width)) / width), z0 + zScale * (i / (width*width)))
-    g.type = 'grid3d'
-    g.width = width
-    g.xScale = xScale
-    g.yScale = yScale
-    g.zScale = zScale
-    g.x0 = x0
-    g.y0 = y0
-    g.z0 = z0
-    g.inverse = lambda x, y, z: \
-                    int (round (x / xScale - x0)) \
-                    + width * (int (round (y / yScale - y0)
-                    + width * int (round (z / zScale - z0))))
-    return g
-    
+    return Grid3d (width, xScale, yScale, zScale, x0, y0, z0)
+
+
+class Random3d (Geometry):
+    def __init__ (self, N, xScale, yScale, zScale):
+        self.type = 'random'
+        self.dim = 3
+        self.N = N
+        self.xScale = xScale
+        self.yScale = yScale
+        self.zScale = zScale
+        self.coords = _numpy.random.random((N, 3))
+        self.coords[...,0] *= xScale
+        self.coords[...,1] *= yScale
+        self.coords[...,2] *= zScale
+
+    def point (self, i):
+        return self.coords[i]
+
+    def coordinates (self, i):
+        return self.coords[i]
+
+    def inverse (self, x, y, z, domain = None):
+        if domain == None:
+            domain = _iset.IntervalSet ((0, self.N - 1))
+        return self.nearest ((x, y, z), domain)
+
 def random3d(N, xScale = 1.0, yScale = 1.0, zScale = 1.0):
     """Creates a set of points scattered uniformly inside a 3D box
     :param N: Number of 3D points
@@ -130,22 +326,9 @@ def random3d(N, xScale = 1.0, yScale = 1.0, zScale = 1.0):
     :type yScale: float
     :param zScale: The scale of the box on the z axis
     :type zScale: float
+    :return: A callable geometry that returns 3d positions when given an index
     """
-    coords = _numpy.random.random((N, 3))
-    coords[...,0] *= xScale
-    coords[...,1] *= yScale
-    coords[...,2] *= zScale
-    g = lambda i: coords[i]
-    g.type = 'random'
-    g.N = N
-    g.xScale = xScale
-    g.yScale = yScale
-    g.zScale = zScale
-    g.inverse = lambda x, y, z, domain=_iset.IntervalSet ((0, N - 1)): \
-                    _numpy.array ([euclidDistance3d (_numpy.array((x, y, z)), g(i)) \
-                                   for i in domain]).argmin () \
-                                   + domain.min ()
-    return g
+    return Random3d (N, xScale, yScale, zScale)
 
 def euclidDistance3d(p1, p2):
     """Returns the euclidean distance in 3D between two points
@@ -156,7 +339,19 @@ def euclidDistance3d(p1, p2):
     :return: The euclidean distance
     :rtype: float
     """
-    return _numpy.linalg.norm(p2 - p1)
+    return _numpy.linalg.norm(_numpy.subtract (p2, p1))
+
+class EuclidMetric3d (Metric):
+    # The same arithmetic as euclidDistances, so that scalar and
+    # array distances agree exactly
+    def distance (self, p1, p2):
+        dx = p1[0] - p2[0]
+        dy = p1[1] - p2[1]
+        dz = p1[2] - p2[2]
+        return _math.sqrt (dx * dx + dy * dy + dz * dz)
+
+    def pointDistances (self, p1, p2):
+        return euclidDistances (p1, p2)
 
 def euclidMetric3d (g1, g2 = None):
     """Returns an euclidean metric for 3D points
@@ -164,8 +359,8 @@ def euclidMetric3d (g1, g2 = None):
     :type g1: callable
     :param g2: The second group of points. If None, the first group of points is used
     :type g2: callable
-    :return: A 3D euclidean metric function
-    :rtype: function
+    :return: A 3D euclidean metric, callable with indices or index arrays
+    :rtype: EuclidMetric3d
     """
     g2 = g1 if g2 == None else g2
-    return lambda i, j: euclidDistance3d (g1 (i), g2 (j))
+    return EuclidMetric3d (g1, g2)
@@ -17,15 +17,53 @@
 #
 
 import sys
+import numpy
 
 from .csaobject import *
 
 infinity = sys.maxsize - 1
 
+# Intersection of two sorted lists of disjoint closed intervals given
+# as (lower, upper) bound arrays
+#
+def intersectBounds (b0, b1):
+    (lower0, upper0) = b0
+    (lower1, upper1) = b1
+    # the intervals of b1 overlapping interval k of b0 are
+    # first[k] <= l < last[k]
+    first = numpy.searchsorted (upper1, lower0)
+    last = numpy.searchsorted (lower1, upper0, 'right')
+    n = numpy.maximum (last - first, 0)
+    k0 = numpy.repeat (numpy.arange (len (lower0)), n)
+    k1 = numpy.arange (len (k0)) + numpy.repeat (first - (numpy.cumsum (n) - n), n)
+    return mergeBounds (numpy.maximum (lower0[k0], lower1[k1]),
+                        numpy.minimum (upper0[k0], upper1[k1]))
+
+def unionBounds (b0, b1):
+    lower = numpy.concatenate ((b0[0], b1[0]))
+    upper = numpy.concatenate ((b0[1], b1[1]))
+    order = numpy.argsort (lower, kind = 'stable')
+    return mergeBounds (lower[order], upper[order])
+
+# Merge overlapping and adjacent intervals of bound arrays sorted on
+# lower bounds
+#
+def mergeBounds (lower, upper):
+    if len (lower) == 0:
+        return (lower, upper)
+    reach = numpy.maximum.accumulate (upper)
+    start = numpy.ones (len (lower), dtype = bool)
+    start[1:] = lower[1:] > reach[:-1] + 1
+    first = numpy.flatnonzero (start)
+    last = numpy.append (first[1:], len (lower)) - 1
+    return (lower[first], reach[last])
+
+
 # Interval sets are represented as ordered lists of closed intervals
 #
 class IntervalSet (CSAObject):
     tag = 'intervalset'
+    derivedAttributes = frozenset (['cumulative', 'nIntegers', '_intervals'])
     
     @staticmethod
     # return true if tuple i represents a well-formed interval
@@ -92,10 +130,39 @@ class IntervalSet (CSAObject):
     
     def __init__ (self, s = [], intervals = None, nIntegers = None):
         if intervals:
-            self.intervals = intervals
-            self.nIntegers = nIntegers
+            intervals = numpy.array (intervals, dtype = numpy.int64)
+            self.setBounds (intervals[:,0], intervals[:,1])
         else:
-            (self.intervals, self.nIntegers) = self.coerce (s)
+            (intervals, N) = self.coerce (s)
+            intervals = numpy.array (intervals, dtype = numpy.int64)
+            self.setBounds (intervals[:,0] if N else intervals,
+                            intervals[:,1] if N else intervals)
+
+    @classmethod
+    def fromBounds (cls, lower, upper):
+        iset = cls ()
+        iset.setBounds (lower, upper)
+        return iset
+
+    # The set is stored as sorted arrays of lower and upper interval
+    # bounds together with the cumulative count of integers preceding
+    # each interval.
+    #
+    def setBounds (self, lower, upper):
+        self.lower = numpy.asarray (lower, dtype = numpy.int64)
+        self.upper = numpy.asarray (upper, dtype = numpy.int64)
+        self.cumulative = numpy.zeros (len (self.lower) + 1,
+                                       dtype = numpy.int64)
+        numpy.cumsum (self.upper - self.lower + 1, out = self.cumulative[1:])
+        self.nIntegers = int (self.cumulative[-1])
+        self._intervals = None
+
+    @property
+    def intervals (self):
+        if self._intervals is None:
+            self._intervals = list (zip (self.lower.tolist (),
+                                         self.upper.tolist ()))
+        return self._intervals
 
     def repr (self):
         return 'IntervalSet(%r)' % self.intervals
@@ -104,14 +171,8 @@ class IntervalSet (CSAObject):
         return self.nIntegers
 
     def __contains__ (self, n):
-        for i in self.intervals:
-            if n > i[1]:
-                continue
-            elif n >= i[0]:
-                return True
-            else:
-                return False
-        return False
+        k = numpy.searchsorted (self.upper, n)
+        return bool (k < len (self.lower) and self.lower[k] <= n)
 
     def __iter__ (self):
         for i in self.intervals:
@@ -119,8 +180,7 @@ class IntervalSet (CSAObject):
                 yield e
 
     def __invert__ (self):
-        return ComplementaryIntervalSet (intervals = self.intervals, \
-                                         nIntegers = self.nIntegers)
+        return ComplementaryIntervalSet.fromBounds (self.lower, self.upper)
 
     def __add__ (self, other):
         if not isinstance (other, IntervalSet):
@@ -152,56 +212,82 @@ class IntervalSet (CSAObject):
     def shift (self, N):
         if not self or N == 0:
             return self
+        lower = self.lower + N
+        upper = self.upper + N
+        keep = upper >= 0
+        return IntervalSet.fromBounds (numpy.maximum (lower[keep], 0),
+                                       upper[keep])
 
-        intervals = []
-        nIntegers = self.nIntegers
-        for (i, j) in self.intervals:
-            i += N
-            j += N
-            if i >= 0:
-                intervals.append ((i, j))
-            elif j >= 0:
-                intervals.append ((0, j))
-                nIntegers += i
-                
-        return IntervalSet (intervals = intervals, nIntegers = nIntegers)
+    # return the bounds of the intervals produced by intervalIterator
+    #
+    def intervalBounds (self):
+        return (self.lower, self.upper)
 
     def intervalIterator (self):
         return iter (self.intervals)
 
     def boundedIterator (self, low, high):
-        iterator = iter (self.intervals)
-        try:
-            i = next (iterator)
-            while i[1] < low:
-                i = next (iterator)
-            while i[0] < high:
-                for e in range (max (low, i[0]), min (i[1] + 1, high)):
-                    yield e
-                i = next (iterator)
-        except StopIteration:
-            return
+        k = numpy.searchsorted (self.upper, low)
+        for i in self.intervals[k:]:
+            if i[0] >= high:
+                return
+            for e in range (max (low, i[0]), min (i[1] + 1, high)):
+                yield e
 
+    # return the elements in [low, high) as an int64 array
+    #
+    def boundedArray (self, low, high):
+        (lower, upper) = self.intervalBounds ()
+        k0 = numpy.searchsorted (upper, low)
+        k1 = numpy.searchsorted (lower, high)
+        if k1 <= k0:
+            return numpy.empty (0, dtype = numpy.int64)
+        starts = numpy.maximum (lower[k0:k1], low)
+        sizes = numpy.minimum (upper[k0:k1] + 1, high) - starts
+        offsets = numpy.cumsum (sizes) - sizes
+        return numpy.arange (offsets[-1] + sizes[-1], dtype = numpy.int64) \
+               + numpy.repeat (starts - offsets, sizes)
+
+    # Bulk queries
+    #
+    # contains returns a boolean membership array for an array of
+    # indices, rank the number of elements in the set smaller than
+    # each index (for members, the position of the index in the set)
+    # and select the elements at the given positions in the set.
+    #
+    def contains (self, indices):
+        indices = numpy.asarray (indices, dtype = numpy.int64)
+        if not len (self.lower):
+            return numpy.zeros (indices.shape, dtype = bool)
+        k = numpy.minimum (numpy.searchsorted (self.upper, indices),
+                           len (self.lower) - 1)
+        return (self.lower[k] <= indices) & (indices <= self.upper[k])
+
+    def rank (self, indices):
+        indices = numpy.asarray (indices, dtype = numpy.int64)
+        if not len (self.lower):
+            return numpy.zeros (indices.shape, dtype = numpy.int64)
+        k = numpy.searchsorted (self.upper, indices)
+        last = numpy.minimum (k, len (self.lower) - 1)
+        return self.cumulative[k] \
+               + numpy.where (k < len (self.lower),
+                              numpy.maximum (indices - self.lower[last], 0),
+                              0)
+
+    def select (self, ranks):
+        ranks = numpy.asarray (ranks, dtype = numpy.int64)
+        k = numpy.searchsorted (self.cumulative[1:], ranks, 'right')
+        return self.lower[k] + ranks - self.cumulative[k]
 
     def count (self, low, high):
-        iterator = iter (self.intervals)
-        c = 0
-        try:
-            i = next (iterator)
-            while i[1] < low:
-                i = next (iterator)
-            while i[0] < high:
-                c += min (i[1] + 1, high) - max (low, i[0])
-                i = next (iterator)
-        except StopIteration:
-            pass
-        return c
+        (low, high) = self.rank ([low, high]).tolist ()
+        return high - low
 
     def min (self):
-        return self.intervals[0][0]
+        return int (self.lower[0])
 
     def max (self):
-        return self.intervals[-1][1]
+        return int (self.upper[-1])
 
     def skipIntervals (self):
         if len (self.intervals) <= 1 or self.intervals[0][0] != self.intervals[0][1]:
@@ -222,107 +308,14 @@ class IntervalSet (CSAObject):
         return skip, res
 
     def intersection (self, other):
-        res = []
-        N = 0
-        iter0 = self.intervalIterator ()
-        iter1 = other.intervalIterator ()
-        try:
-            i0 = next (iter0)
-            i1 = next (iter1)
-            while True:
-                if i0[1] <= i1[1]:
-                    if i0[1] >= i1[0]:
-                        lower = max (i0[0], i1[0])
-                        res.append ((lower, i0[1]))
-                        N += 1 + i0[1] - lower
-                    i0 = next (iter0)
-                else:
-                    if i1[1] >= i0[0]:
-                        lower = max (i0[0], i1[0])
-                        res.append ((lower, i1[1]))
-                        N += 1 + i1[1] - lower
-                    i1 = next (iter1)
-        except StopIteration:
-            pass
-        iset = IntervalSet ()
-        iset.intervals = res
-        iset.nIntegers = N
-        return iset
+        return IntervalSet.fromBounds (*intersectBounds (self.intervalBounds (),
+                                                         other.intervalBounds ()))
 
     def union (self, other):
         if isinstance (other, ComplementaryIntervalSet):
             return ~(~self).intersection (~other)
-        
-        iset = IntervalSet ()
-        if not other.nIntegers:
-            iset.intervals = list (self.intervals)
-            iset.nIntegers = self.nIntegers
-            return iset
-        if not self.nIntegers:
-            iset.intervals = list (other.intervals)
-            iset.nIntegers = other.nIntegers
-            return iset
-        res = []
-        N = 0
-        iter0 = self.intervalIterator ()
-        iter1 = other.intervalIterator ()
-        i0 = next (iter0)
-        i1 = next (iter1)
-        if i0[0] <= i1[0]:
-            (lower, upper) = i0
-        else:
-            (lower, upper) = i1
-        try:
-            while True:
-                if i0[0] <= i1[0]:
-                    if i0[0] <= upper + 1:
-                        if i0[1] > upper:
-                            upper = i0[1]
-                    else:
-                        res.append ((lower, upper))
-                        N += 1 + upper - lower
-                        (lower, upper) = i0
-                    try:
-                        i0 = next (iter0)
-                    except StopIteration:
-                        if i1[0] <= upper + 1:
-                            if i1[1] > upper:
-                                upper = i1[1]
-                            i1 = (lower, upper)
-                        else:
-                            res.append ((lower, upper))
-                            N += 1 + upper - lower
-                        while True:
-                            res.append (i1)
-                            N += 1 + i1[1] - i1[0]
-                            i1 = next (iter1)
-                else:
-                    if i1[0] <= upper + 1:
-                        if i1[1] > upper:
-                            upper = i1[1]
-                    else:
-                        res.append ((lower, upper))
-                        N += 1 + upper - lower
-                        (lower, upper) = i1
-                    try:
-                        i1 = next (iter1)
-                    except StopIteration:
-                        if i0[0] <= upper + 1:
-                            if i0[1] > upper:
-                                upper = i0[1]
-                            i0 = (lower, upper)
-                        else:
-                            res.append ((lower, upper))
-                            N += 1 + upper - lower
-                        while True:
-                            res.append (i0)
-                            N += 1 + i0[1] - i0[0]
-                            i0 = next (iter0)
-        except StopIteration:
-            pass
-        iset.intervals = res
-        iset.nIntegers = N
-        return iset
+        return IntervalSet.fromBounds (*unionBounds (self.intervalBounds (),
+                                                     other.intervalBounds ()))
 
     def _to_xml (self):
         intervals = [ E ('interval', E ('cn', str (i)), E ('cn', str (j)))
@@ -356,66 +349,56 @@ class ComplementaryIntervalSet (IntervalSet):
     # def __len__ (self):
     #     raise RuntimeError ('ComplementaryIntervalSet has infinite length')
  
+    # The bound arrays hold the intervals *not* in the set
+    #
     def __contains__ (self, n):
-        for i in self.intervals:
-            if n < i[0]:
-                continue
-            elif n <= i[1]:
-                return False
-            else:
-                return True
-        return True
+        return not IntervalSet.__contains__ (self, n)
 
     def __iter__ (self):
         raise RuntimeError ("can't interate over ComplementaryIntervalSet")
 
     def __invert__ (self):
-        return IntervalSet (intervals = self.intervals, \
-                            nIntegers = self.nIntegers)
+        return IntervalSet.fromBounds (self.lower, self.upper)
 
     def finite (self):
         return False
 
     def shift (self, N):
-        iset = IntervalSet (intervals = self.intervals, \
-                            nIntegers = self.nIntegers).shift (N)
-        return ComplementaryIntervalSet (intervals = iset.intervals, \
-                                         nIntegers = iset.nIntegers)
+        iset = IntervalSet.fromBounds (self.lower, self.upper).shift (N)
+        return ComplementaryIntervalSet.fromBounds (iset.lower, iset.upper)
+
+    def intervalBounds (self):
+        lower = numpy.concatenate (([0], self.upper + 1))
+        upper = numpy.concatenate ((self.lower - 1, [infinity]))
+        keep = lower <= upper
+        return (lower[keep], upper[keep])
 
     def intervalIterator (self):
-        start = 0
-        for i in self.intervals:
-            if i[0] > 0:
-                yield (start, i[0] - 1)
-            start = i[1] + 1
-        yield (start, infinity)
+        (lower, upper) = self.intervalBounds ()
+        return zip (lower.tolist (), upper.tolist ())
 
     def boundedIterator (self, low, high):
         raise RuntimeError ("can't interate over ComplementaryIntervalSet")
 
-    def count (self, low, high):
-        iterator = iter (self.intervals)
-        c = 0
-        prev = low
-        try:
-            i = next (iterator)
-            while i[1] < low:
-                i = next (iterator)
-            while i[0] < high:
-                c += i[0] - prev
-                prev = i[1] + 1
-                i = next (iterator)
-        except StopIteration:
-            pass
-        if prev < high:
-            c += high - prev
-        return c
+    def contains (self, indices):
+        return ~IntervalSet.contains (self, indices)
+
+    def rank (self, indices):
+        indices = numpy.asarray (indices, dtype = numpy.int64)
+        return indices - IntervalSet.rank (self, indices)
+
+    def select (self, ranks):
+        ranks = numpy.asarray (ranks, dtype = numpy.int64)
+        # number of elements preceding each excluded interval
+        preceding = self.lower - self.cumulative[:-1]
+        k = numpy.searchsorted (preceding, ranks, 'right')
+        return ranks + self.cumulative[k]
 
     def min (self):
-        if not self.intervals or self.intervals[0][0] > 0:
+        if not self.nIntegers or self.lower[0] > 0:
             return 0
         else:
-            return self.intervals[0][1] + 1
+            return int (self.upper[0]) + 1
 
     def max (self):
         raise RuntimeError ('the maximum of a ComplementaryIntervalSet is infinity')
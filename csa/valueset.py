@@ -16,24 +16,82 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import numpy
+
 from .csaobject import *
 
+# Evaluation of value sets over arrays of sources i and targets j
+#
+# Objects with an evaluate method (value sets and metrics) are
+# evaluated as array expressions.  Other callables are called once per
+# element.
+#
+def evaluate (f, i, j):
+    if hasattr (f, 'evaluate'):
+        return f.evaluate (i, j)
+    return elementwise (f, i, j)
+
+def elementwise (f, i, j):
+    return valueArray ([f (a, b) for (a, b) in zip (i.tolist (), j.tolist ())])
+
+# Value sets which hold data for lookups during an iteration are
+# copied at its start, and keep the data in the iteration state
+#
+def startIteration (f, state):
+    if isinstance (f, ValueSet) and hasattr (f, 'startIteration'):
+        return f.startIteration (state)
+    return f
+
+# Values of a single Python number type are stored in a numerical
+# array, which gives them back unchanged through tolist.  Other values,
+# including mixtures of ints and floats, are kept as they are in an
+# object array.
+#
+numberTypes = frozenset ([int, float, bool])
+
+def valueArray (values):
+    types = set (map (type, values))
+    if len (types) <= 1 and types <= numberTypes:
+        a = numpy.array (values)
+        if a.shape == (len (values),):
+            return a
+    a = numpy.empty (len (values), dtype = object)
+    a[:] = values
+    return a
+
+
 class ValueSet (CSAObject):
     def __init__ (self):
         CSAObject.__init__ (self, "valueset")
         
+    # Value sets which have a support return, for sources in [low0,
+    # high0) and an array of targets, arrays (sources, targets,
+    # values) in post-order of all pairs with non-zero value
+    #
+    def hasSupport (self):
+        return False
+
+    def support (self, low0, high0, targets):
+        return NotImplemented
+
+    # Expected number of pairs in the support per target
+    #
+    def supportWidth (self, low0, high0):
+        return high0 - low0
+
+    def evaluate (self, i, j):
+        return elementwise (self, i, j)
+
     def __neg__ (self):
-        return GenericValueSet (lambda i, j: - self (i, j))
+        return maybeAffine (0.0, -1.0, self)
     
     def __add__ (self, other):
         if not callable (other):
             return maybeAffine (other, 1.0, self)
         elif isinstance (other, (QuotedValueSet, AffineValueSet)):
             return other.__add__ (self)
-        elif isinstance (other, GenericValueSet):
-            return GenericValueSet (lambda i, j: self (i, j) + other.function (i, j))
         else:
-            return GenericValueSet (lambda i, j: self (i, j) + other (i, j))
+            return ValueSetSum (self, other)
 
     def __radd__ (self, other):
         return self.__add__ (other)
@@ -49,10 +107,8 @@ class ValueSet (CSAObject):
             return maybeAffine (0.0, other, self)
         elif isinstance (other, (QuotedValueSet, AffineValueSet)):
             return other.__mul__ (self)
-        elif isinstance (other, GenericValueSet):
-            return GenericValueSet (lambda i, j: self (i, j) * other.function (i, j))
         else:
-            return GenericValueSet (lambda i, j: self (i, j) * other (i, j))
+            return ValueSetProduct (self, other)
 
     def __rmul__ (self, other):
         return self.__mul__ (other)
@@ -66,6 +122,9 @@ class QuotedValueSet (ValueSet):
     def __call__ (self, i, j):
         return self.expression
 
+    def evaluate (self, i, j):
+        return numpy.full (numpy.shape (i), self.expression)
+
     def __neg__ (self):
         return QuotedValueSet (- self.expression)
     
@@ -98,8 +157,11 @@ class GenericValueSet (ValueSet):
     def __call__ (self, i, j):
         return self.function (i, j)
 
+    def evaluate (self, i, j):
+        return evaluate (self.function, i, j)
+
     def __neg__ (self):
-        return GenericValueSet (lambda i, j: - self.function (i, j))
+        return maybeAffine (0.0, -1.0, self.function)
 
     def __add__ (self, other):
         if not callable (other):
@@ -107,9 +169,9 @@ class GenericValueSet (ValueSet):
         elif isinstance (other, (QuotedValueSet, AffineValueSet)):
             return other.__add__ (self)
         elif isinstance (other, GenericValueSet):
-            return GenericValueSet (lambda i, j: self.function (i, j) + other.function (i, j))
+            return ValueSetSum (self.function, other.function)
         else:
-            return GenericValueSet (lambda i, j: self.function (i, j) + other (i, j))
+            return ValueSetSum (self.function, other)
 
     def __mul__ (self, other):
         if not callable (other):
@@ -117,9 +179,32 @@ class GenericValueSet (ValueSet):
         elif isinstance (other, (QuotedValueSet, AffineValueSet)):
             return other.__mul__ (self)
         elif isinstance (other, GenericValueSet):
-            return GenericValueSet (lambda i, j: self.function (i, j) * other.function (i, j))
+            return ValueSetProduct (self.function, other.function)
         else:
-            return GenericValueSet (lambda i, j: self.function (i, j) * other (i, j))
+            return ValueSetProduct (self.function, other)
+
+
+# Sums and products of two value sets or functions, evaluated
+# element by element or as array expressions
+#
+class ValueSetSum (GenericValueSet):
+    def __init__ (self, f1, f2):
+        GenericValueSet.__init__ (self, lambda i, j: f1 (i, j) + f2 (i, j))
+        self.f1 = f1
+        self.f2 = f2
+
+    def evaluate (self, i, j):
+        return evaluate (self.f1, i, j) + evaluate (self.f2, i, j)
+
+
+class ValueSetProduct (GenericValueSet):
+    def __init__ (self, f1, f2):
+        GenericValueSet.__init__ (self, lambda i, j: f1 (i, j) * f2 (i, j))
+        self.f1 = f1
+        self.f2 = f2
+
+    def evaluate (self, i, j):
+        return evaluate (self.f1, i, j) * evaluate (self.f2, i, j)
 
 
 class AffineValueSet (ValueSet):
@@ -132,6 +217,9 @@ class AffineValueSet (ValueSet):
     def __call__ (self, i, j):
         return self.const + self.coeff * self.func (i, j)
 
+    def evaluate (self, i, j):
+        return self.const + self.coeff * evaluate (self.func, i, j)
+
     def __neg__ (self):
         return maybeAffine (- self.const, - self.coeff, self.func)
     
@@ -142,12 +230,21 @@ class AffineValueSet (ValueSet):
             return maybeAffine (self.const + other.expression,
                                 self.coeff, self.func)
         elif isinstance (other, AffineValueSet):
-            f = lambda i, j: \
-                    self.const * self.func (i, j) \
-                    + other.const * other.func (i, j)
+            f = ValueSetSum (maybeAffine (0.0, self.coeff, self.func),
+                             maybeAffine (0.0, other.coeff, other.func))
             return maybeAffine (self.const + other.const,
                                 1.0,
                                 f)
+        elif isinstance (other, GenericValueSet):
+            return maybeAffine (self.const, 1.0,
+                                ValueSetSum (maybeAffine (0.0, self.coeff,
+                                                          self.func),
+                                             other.function))
+        else:
+            return maybeAffine (self.const, 1.0,
+                                ValueSetSum (maybeAffine (0.0, self.coeff,
+                                                          self.func),
+                                             other))
 
     def __mul__ (self, other):
         if not callable (other):
@@ -159,14 +256,17 @@ class AffineValueSet (ValueSet):
                                 self.coeff * other.expression,
                                 self.func)
         elif isinstance (other, AffineValueSet):
-            f = lambda i, j: \
-                    other.const * self.coeff * self.func (i, j) \
-                    + self.const * other.coeff * other.func (i, j) \
-                    + self.coeff * other.coeff \
-                      * self.func (i, j) * other.func (i, j)
+            f = ValueSetSum (
+                    ValueSetSum (
+                        maybeAffine (0.0, other.const * self.coeff, self.func),
+                        maybeAffine (0.0, self.const * other.coeff, other.func)),
+                    maybeAffine (0.0, self.coeff * other.coeff,
+                                 ValueSetProduct (self.func, other.func)))
             return maybeAffine (self.const * other.const,
                                 1.0,
                                 f)
+        else:
+            return ValueSetProduct (self, other)
 
 def maybeAffine (const, coeff, func):
     if coeff == 0.0:
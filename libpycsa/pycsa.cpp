@@ -26,6 +26,7 @@
 
 #include <string>
 #include <iostream>
+#include <cstring>
 
 #if PY_MAJOR_VERSION >= 3
 #define PYINT_ASLONG PyLong_AsLong
@@ -43,6 +44,7 @@ static PyObject* pCross = 0;
 static PyObject* pPartition = 0;
 static PyObject* pParse = 0;
 static PyObject* pParseString = 0;
+static PyObject* pBatchIterator = 0;
 
 
 static void
@@ -95,6 +97,22 @@ loadCSA ()
   pParseString = PyObject_GetAttrString (pModule, "parseString");
 
   Py_DECREF (pModule);
+
+  PyObject* pConngen = PyImport_ImportModule ("csa.conngen");
+  if (pConngen == NULL)
+    {
+      PYGILSTATE_RELEASE (gstate);
+      error ("Couldn't import csa.conngen");
+      return false;
+    }
+  pBatchIterator = PyObject_GetAttrString (pConngen, "batchIterator");
+  Py_DECREF (pConngen);
+  if (pBatchIterator == NULL)
+    {
+      PYGILSTATE_RELEASE (gstate);
+      error ("Couldn't find the batchIterator function in the CSA library");
+      return false;
+    }
   if (pArity == NULL)
     {
       PYGILSTATE_RELEASE (gstate);
@@ -121,13 +139,37 @@ tryLoadCSA ()
       if (!status)
 	return false;
     }
+  return true;
+}
+
+
+// Copies the contents of the Python buffer pObj, which must hold n
+// elements of type T, into buffer
+//
+template<typename T>
+static bool
+copyBuffer (PyObject* pObj, size_t n, std::vector<T>& buffer)
+{
+  Py_buffer view;
+  if (PyObject_GetBuffer (pObj, &view, PyBUF_C_CONTIGUOUS) < 0)
+    return false;
+  bool ok = (view.len == (Py_ssize_t) (n * sizeof (T)));
+  if (ok)
+    {
+      buffer.resize (n);
+      if (n > 0)
+	std::memcpy (&buffer[0], view.buf, view.len);
+    }
+  PyBuffer_Release (&view);
+  return ok;
 }
 
 
 namespace PyCSA {
 
   PyCSAGenerator::PyCSAGenerator (PyObject* obj)
-    : pCSAObject (obj), pPartitionedCSAObject (NULL), pIterator (NULL)
+    : pCSAObject (obj), pPartitionedCSAObject (NULL), pIterator (NULL),
+      position_ (0)
   {
     PYGILSTATE_ENSURE (gstate);
     Py_INCREF (pCSAObject);
@@ -235,30 +277,34 @@ namespace PyCSA {
       }
     PYGILSTATE_ENSURE (gstate);
     Py_XDECREF (pIterator);
-    pIterator = PyObject_GetIter (pPartitionedCSAObject);
+    pIterator = PyObject_CallFunctionObjArgs (pBatchIterator,
+					      pPartitionedCSAObject,
+					      NULL);
     PYGILSTATE_RELEASE (gstate);
+    sources_.clear ();
+    targets_.clear ();
+    values_.clear ();
+    position_ = 0;
   }
 
 
+  // Fetches the next batch (sources, targets, values) from the batch
+  // iterator into the buffers.  Returns false at the end of the
+  // iteration or on error.
+  //
   bool
-  PyCSAGenerator::next (int& source, int& target, double* value)
+  PyCSAGenerator::fetchBatch ()
   {
-    if (pIterator == NULL)
-      {
-	error ("Must call start() before next()");
-	return false;
-      }
-
     PYGILSTATE_ENSURE (gstate);
-    PyObject* tuple = PyIter_Next (pIterator);
-    PyObject* err = PyErr_Occurred ();
-    if (err)
+    PyObject* batch = PyIter_Next (pIterator);
+    if (PyErr_Occurred ())
       {
+	Py_XDECREF (batch);
 	PYGILSTATE_RELEASE (gstate);
 	return false;
       }
 
-    if (tuple == NULL)
+    if (batch == NULL)
       {
 	Py_DECREF (pIterator);
 	pIterator = NULL;
@@ -266,23 +312,41 @@ namespace PyCSA {
 	return false;
       }
 
-    source = PYINT_ASLONG (PyTuple_GET_ITEM (tuple, 0));
-    target = PYINT_ASLONG (PyTuple_GET_ITEM (tuple, 1));
-    for (int i = 0; i < arity_; ++i)
+    size_t n = PySequence_Size (PyTuple_GET_ITEM (batch, 0));
+    bool ok = copyBuffer (PyTuple_GET_ITEM (batch, 0), n, sources_)
+      && copyBuffer (PyTuple_GET_ITEM (batch, 1), n, targets_)
+      && copyBuffer (PyTuple_GET_ITEM (batch, 2), n * arity_, values_);
+    Py_DECREF (batch);
+    PYGILSTATE_RELEASE (gstate);
+    if (!ok)
+      {
+	error ("Couldn't read a batch of connections from CSA");
+	return false;
+      }
+    position_ = 0;
+    return true;
+  }
+
+
+  bool
+  PyCSAGenerator::next (int& source, int& target, double* value)
+  {
+    while (position_ == sources_.size ())
       {
-	PyObject* v = PyTuple_GET_ITEM (tuple, i + 2);
-	if (!PyFloat_Check (v))
+	if (pIterator == NULL)
 	  {
-	    Py_DECREF (tuple);
-	    PYGILSTATE_RELEASE (gstate);
-	    error ("NEST cannot handle non-float CSA value sets");
+	    error ("Must call start() before next()");
 	    return false;
 	  }
-	value[i] = PyFloat_AsDouble (v);
+	if (!fetchBatch ())
+	  return false;
       }
 
-    Py_DECREF (tuple);
-    PYGILSTATE_RELEASE (gstate);
+    source = sources_[position_];
+    target = targets_[position_];
+    for (int i = 0; i < arity_; ++i)
+      value[i] = values_[position_ * arity_ + i];
+    ++position_;
     return true;
   }
 
@@ -38,6 +38,9 @@ extern "C" {
 
 #include <neurosim/connection_generator.h>
 
+#include <vector>
+#include <stdint.h>
+
 namespace PyCSA {
 
   class PyCSAGenerator : public ConnectionGenerator {
@@ -45,8 +48,15 @@ namespace PyCSA {
     PyObject* pPartitionedCSAObject;
     int arity_;
     PyObject* pIterator;
+    // Connections are fetched from Python in batches and then served
+    // by next () from these buffers
+    std::vector<int64_t> sources_;
+    std::vector<int64_t> targets_;
+    std::vector<double> values_;
+    size_t position_;
   private:
     PyObject* makeIntervals (IntervalSet& iset);
+    bool fetchBatch ();
   public:
     PyCSAGenerator (PyObject* obj);
 
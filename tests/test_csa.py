@@ -20,6 +20,7 @@ import sys
 import numpy
 
 from csa import *
+from csa import connset
 
 import unittest
 
@@ -49,6 +50,10 @@ class TestCSA(unittest.TestCase):
     def assertEqual30x30 (self, cs, ls, msg):
         self.assertEqualCS (cross ((0, 29), (0, 29)) * cs, ls, msg)
 
+    def assertEqualBlocks (self, cs, msg):
+        blocks = connset.blocksToIterator (cs.blocks ())
+        self.assertEqual ([x for x in blocks], [x for x in cs], msg)
+
     def sampleN (self, func, dims, N):
         data = numpy.zeros ((N,) + dims)
         for k in range (N):
@@ -71,6 +76,16 @@ class TestElementary (TestCSA):
                                [(22,7),(8,23)],
                                'list cs')
 
+    def test_listPartition (self):
+        L = [(3, 4), (1, 4), (7, 0), (3, 4), (2, 9), (5, 6)]
+        expected = sorted (L, key = connset.postOrderKey)
+        self.assertEqual (list (connset.ExplicitMask (L)), expected,
+                          'wrong order of list cs')
+        part = cross ((2, 5), (3, 8))
+        self.assertEqual (list (part * connset.ExplicitMask (L)),
+                          [c for c in expected if c in part],
+                          'wrong partition of list cs')
+
     def test_range (self):
         # Test range
         self.assertEqual30x30 (cross (range (10), range (10, 20, 3)),
@@ -183,6 +198,53 @@ class TestElementary (TestCSA):
             row += N
         return N * res           # normalization
 
+    def test_randomPartitionInvariance (self):
+        N = 30
+        R = (0, N - 1)
+        parts = [cross (R, (0, 9)), cross (R, (10, 19)), cross (R, (20, 29))]
+        sourceParts = [cross ((0, 14), R), cross ((15, 29), R)]
+        for c in [cross (R, R) * random (0.2),
+                  random (N = 100) * cross (R, R),
+                  random (fanIn = 5) * cross (R, R),
+                  random (fanOut = 5) * cross (R, R)]:
+            serial = [x for x in c]
+            split = []
+            for k in range (len (parts)):
+                split += [x for x in partition (c, parts, k)]
+            self.assertEqual (split, serial, 'partitioned random mask differs')
+            split = []
+            for k in range (len (sourceParts)):
+                split += [x for x in partition (c, sourceParts, k)]
+            self.assertEqual (sorted (split, key = lambda x: (x[1], x[0])),
+                              serial, 'partitioned random mask differs')
+
+    def test_randomDensity (self):
+        R = (0, 999)
+        for p in [0.001, 0.1, 0.7]:
+            n = len ([x for x in cross (R, R) * random (p)])
+            self.assertAlmostEqual (n / 1e6, p, 2,
+                                    'random (%g) has density %g' % (p, n / 1e6))
+
+    def test_randomFan (self):
+        R = (0, 99)
+        c = [x for x in random (fanIn = 7) * cross (R, (0, 49))]
+        self.assertEqual (len (c), 7 * 50, 'wrong number of connections')
+        for j in range (50):
+            self.assertEqual (len ([x for x in c if x[1] == j]), 7,
+                              'wrong fan-in of target %d' % j)
+        c = [x for x in random (fanOut = 3) * cross ((0, 49), R)]
+        for i in range (50):
+            self.assertEqual (len ([x for x in c if x[0] == i]), 3,
+                              'wrong fan-out of source %d' % i)
+        self.assertEqual (len ([x for x in random (N = 1000) * cross (R, R)]),
+                          1000, 'wrong number of connections')
+
+    def test_randomSeed (self):
+        R = (0, 29)
+        self.assertEqual ([x for x in cross (R, R) * random (0.2, seed = 7)],
+                          [x for x in cross (R, R) * random (0.2, seed = 7)],
+                          'seeded random masks differ')
+
     def test_intersectionRandomN (self):
         self.K = 5
         res = self.sampleN (self.intersectionRandomN, (6 * self.K, 2 * self.K), 1000)
@@ -196,6 +258,456 @@ class TestOperators (TestCSA):
                             [(i, j) for j in range (0,4) for i in range (0,4) if i != j],
                             'difference operator')
 
+    def test_blocks (self):
+        R = (0, 29)
+        self.assertEqualBlocks (cross ([(0, 3), (7, 9)], [(2, 4), (10, 12)]),
+                                'interval set mask blocks')
+        self.assertEqualBlocks (cross ((0, 7), (1, 8)) * oneToOne,
+                                'oneToOne blocks')
+        self.assertEqualBlocks (cross ((0, 5), (0, 5)) * (oneToOne + full),
+                                'multiset sum blocks')
+        self.assertEqualBlocks (cross (R, R) * (full - oneToOne),
+                                'difference blocks')
+        self.assertEqualBlocks (cross (R, R) * (random (0.3) * random (0.5)),
+                                'intersection blocks')
+        self.assertEqualBlocks (shift (2, 3) * (cross (R, R) * oneToOne),
+                                'shifted mask blocks')
+        self.assertEqualBlocks (transpose * (cross ((0, 9), R) * random (0.4)),
+                                'transposed mask blocks')
+
+
+    def test_sparseIntersection (self):
+        R = (0, 999)
+        L = [(i * 37 % 1000, i * 9) for i in range (100)] + [(3, 9)]
+        r = cross (R, R) * random (0.5)
+        dense = set (x for x in r)
+        expected = sorted ((x for x in L if x in dense),
+                           key = lambda x: (x[1], x[0]))
+        self.assertEqual ([x for x in r * L], expected,
+                          'sparse intersection differs')
+        self.assertEqual ([x for x in r.intersection (connset.ExplicitMask (L))],
+                          [x for x in connset.ExplicitMask (L) if x in dense],
+                          'sparse intersection differs')
+        self.assertEqualBlocks (r * L, 'sparse block intersection differs')
+        c = cset (r, 2.0) * L
+        self.assertEqual ([x for x in c], [x + (2.0,) for x in expected],
+                          'sparse connection-set intersection differs')
+
+    def test_csr (self):
+        R = (0, 99)
+        for c in [cross (R, (0, 49)) * random (0.2),
+                  cross ((5, 20), (3, 9)),
+                  cset (cross (R, R) * random (0.2),
+                        vset (lambda i, j: i - j), 2.0)]:
+            expected = [x for x in c]
+            (indptr, indices, values) = to_csc (c)
+            self.assertEqual ([(int (indices[k]), j)
+                               + tuple (v[k] for v in values)
+                               for j in range (len (indptr) - 1)
+                               for k in range (indptr[j], indptr[j + 1])],
+                              expected, 'wrong CSC arrays')
+            (indptr, indices, values) = to_csr (c)
+            self.assertEqual ([(i, int (indices[k]))
+                               + tuple (v[k] for v in values)
+                               for i in range (len (indptr) - 1)
+                               for k in range (indptr[i], indptr[i + 1])],
+                              sorted (expected), 'wrong CSR arrays')
+        c = cset (cross (R, R) * random (0.0), 1.0, 2.0)
+        for (indptr, indices, values) in [to_csr (c), to_csc (c)]:
+            self.assertEqual (len (indices), 0, 'empty arrays not empty')
+            self.assertEqual ([len (v) for v in values], [0, 0],
+                              'empty value arrays lose arity')
+
+    def test_batches (self):
+        from csa.conngen import batchIterator
+        R = (0, 99)
+        c = cset (cross (R, R) * random (0.2), vset (lambda i, j: i - j), 2.0)
+        c = partition (c, [cross (R, (0, 49)), cross (R, (50, 99))], 1)
+        self.assertEqual ([(int (i), int (j)) + tuple (v)
+                           for (sources, targets, values) in batchIterator (c)
+                           for (i, j, v) in zip (sources, targets, values)],
+                          [x for x in c], 'wrong batches')
+
+    def test_parallel (self):
+        R = (0, 199)
+        for c in [cross (R, R) * random (0.1),
+                  random (fanIn = 10) * cross (R, (0, 49)),
+                  cset (cross (R, R) * random (0.1),
+                        vset (lambda i, j: i - j), 2.0)]:
+            self.assertEqual (list (parallel_iter (c, 2)), list (c),
+                              'parallel iteration differs from serial')
+
+    def test_count (self):
+        R = (0, 99)
+        for m in [cross (R, R) * oneToOne,
+                  random (fanIn = 10) * cross (R, (0, 49)),
+                  random (N = 500) * cross (R, R),
+                  transpose * (random (fanIn = 3) * cross (R, (0, 9))),
+                  partition (random (fanIn = 4) * cross (R, R),
+                             [cross (R, (0, 49)), cross (R, (50, 99))], 1),
+                  connset.ExplicitMask ([(1, 2), (3, 4)]) + cross ((0, 9), (0, 9)),
+                  block (3, 2) * (cross ((0, 9), (0, 9)) * oneToOne),
+                  cross ((1, 10), (1, 6))
+                  * (block (3, 2) * connset.ExplicitMask ([(0, 0), (2, 0),
+                                                           (1, 1), (3, 2)])),
+                  cross ((1, 10), (2, 7))
+                  * (repeat (4, 3) * connset.ExplicitMask ([(0, 0), (2, 0),
+                                                            (1, 1), (3, 2)]))]:
+            n = m.count (*m.bounds ())
+            self.assertNotEqual (n, None, 'mask not counted')
+            self.assertEqual (n, len (list (m)), 'wrong count')
+        m = cross ((10, 19), R) * (random (fanIn = 7) * cross (R, R))
+        self.assertEqual (m.count (*m.bounds ()), None,
+                          'counted connections which need to be drawn')
+        self.assertEqual (len (m), len (list (m)), 'wrong length')
+
+    def test_balancedMasks (self):
+        R = (0, 999)
+        c = cross (R, (0, 499)) * random (0.05) \
+            + cross (R, (500, 999)) * random (0.005)
+        sizes = [len (list (partition (c, balanced_masks (c, 4), k)))
+                 for k in range (4)]
+        self.assertEqual (sum (sizes), len (list (c)), 'wrong partition')
+        self.assertTrue (max (sizes) < 1.2 * min (sizes),
+                         'unbalanced partition')
+
+    def test_transpose (self):
+        R = (0, 199)
+        masks = [cross (R, (0, 99)) * random (0.2),
+                 connset.ExplicitMask ([(3, 4), (1, 4), (7, 0), (3, 4)]),
+                 cross (R, R) * oneToOne,
+                 cross ((0, 11), [(0, 3), (7, 9)])
+                 * connset.ExplicitMask ([(11, 1), (2, 7), (5, 3), (1, 9)])]
+        tileSize = connset.transposeTileSize
+        self.addCleanup (setattr, connset, 'transposeTileSize', tileSize)
+        for connset.transposeTileSize in [tileSize, 100]:
+            for m in masks:
+                self.assertEqual (list (transpose * m),
+                                  sorted (((j, i) for (i, j) in m),
+                                          key = connset.postOrderKey),
+                                  'wrong transpose')
+
+    def test_blockRepeat (self):
+        T = [(0, 0), (2, 0), (1, 1), (1, 1), (3, 2), (0, 2)]
+        m = connset.ExplicitMask (T)
+        blocked = sorted (((i, j) for (k, t) in T
+                           for i in range (3 * k, 3 * k + 3)
+                           for j in range (2 * t, 2 * t + 2)),
+                          key = connset.postOrderKey)
+        repeated = sorted (((k + 4 * a, t + 3 * b) for (k, t) in T
+                            for a in range (10) for b in range (10)),
+                           key = connset.postOrderKey)
+        blockSize = connset.blockSize
+        self.addCleanup (setattr, connset, 'blockSize', blockSize)
+        for (connset.blockSize, c, expected) in \
+                [(blockSize, block (3, 2) * m, blocked),
+                 (blockSize, repeat (4, 3) * m, repeated),
+                 (3, repeat (4, 3) * m, repeated)]:
+            for (low0, high0, low1, high1) in [(0, 12, 0, 6), (1, 11, 1, 5),
+                                               (5, 30, 4, 17)]:
+                w = cross ((low0, high0 - 1), (low1, high1 - 1))
+                self.assertEqual (list (w * c),
+                                  [(i, j) for (i, j) in expected
+                                   if low0 <= i < high0 and low1 <= j < high1],
+                                  'wrong expansion')
+                n = c.count (low0, high0, low1, high1)
+                if n != None:
+                    self.assertEqual (n, len (list (w * c)), 'wrong count')
+
+    def test_blockRepeatValues (self):
+        T = [(0, 0), (2, 0), (1, 1), (3, 2), (0, 2)]
+        calls = []
+        def f (i, j):
+            calls.append ((i, j))
+            return 10 * i + j
+        c = cset (connset.ExplicitMask (T), f, 1.5)
+        blocked = sorted (((i, j, 10 * k + t, 1.5) for (k, t) in T
+                           for i in range (3 * k, 3 * k + 3)
+                           for j in range (2 * t, 2 * t + 2)),
+                          key = connset.postOrderKey)
+        self.assertEqual (list (block (3, 2) * c), blocked, 'wrong block')
+        self.assertEqual (len (calls), len (T), 'values not broadcast')
+        w = cross ((1, 7), (1, 4))
+        self.assertEqual (list (w * (block (3, 2) * c)),
+                          [x for x in blocked
+                           if 1 <= x[0] <= 7 and 1 <= x[1] <= 4],
+                          'wrong bounded block')
+        repeated = sorted (((k + 4 * a, t + 3 * b, 10 * k + t, 1.5)
+                            for (k, t) in T
+                            for a in range (3) for b in range (3)),
+                           key = connset.postOrderKey)
+        self.assertEqual (list (cross ((0, 11), (0, 8)) * (repeat (4, 3) * c)),
+                          repeated, 'wrong repeat')
+        # windows which filter out all rows of some template columns
+        c = cset (connset.ExplicitMask ([(1, 3), (3, 1), (3, 0), (1, 0)]), f)
+        for (low0, high0, low1, high1) in [(6, 7, 4, 8), (5, 9, 0, 11)]:
+            self.assertEqual (list (cross ((low0, high0 - 1), (low1, high1 - 1))
+                                    * (repeat (2, 3) * c)),
+                              sorted (((i + 2 * a, j + 3 * b, 10 * i + j)
+                                       for (i, j) in [(1, 0)]
+                                       for a in range (5) for b in range (4)
+                                       if low0 <= i + 2 * a < high0
+                                       and low1 <= j + 3 * b < high1),
+                                      key = connset.postOrderKey),
+                              'wrong unaligned repeat')
+
+    def test_cache (self):
+        from csa import _cache
+        R = (0, 99)
+        self.assertTrue (cross (R, R) is cross (R, R), 'cross not interned')
+        self.assertFalse (cross (R, R) is cross (R, (0, 98)),
+                          'different crosses interned')
+        f1 = fix * (cross (R, R) * random (0.1, seed = 1))
+        f2 = fix * (cross (R, R) * random (0.1, seed = 1))
+        f3 = fix * (cross (R, R) * random (0.1, seed = 2))
+        self.assertEqual (list (f1), list (f2), 'wrong cached mask')
+        self.assertNotEqual (list (f1), list (f3), 'seed not in key')
+        from csa import _optimize
+        b = block (3) * cset (cross ((0, 1), (0, 1)), 1.0)
+        key = _cache.structuralKey (b)
+        self.assertNotEqual (_cache.structuralKey (b * cross (R, R)), key,
+                             'key kept by intersection')
+        m = transpose * (cross (R, R) * random (0.1))
+        key = _cache.structuralKey (m)
+        m = _optimize.Optimizer.withSubMask (m, cross (R, R))
+        self.assertNotEqual (_cache.structuralKey (m), key,
+                             'key kept by rewrite')
+        self.addCleanup (setattr, _cache, 'maxCachedResults',
+                         _cache.maxCachedResults)
+        _cache.maxCachedResults = 2
+        for k in range (4):
+            ival (0, k)
+        self.assertEqual (len (_cache.cache.entries), 2, 'cache not bounded')
+
+    def test_valueStore (self):
+        R = (0, 49)
+        c = cset (cross (R, R) * random (0.2, seed = 1), 1.0,
+                  vset (lambda i, j: i - j)) \
+            + cset (cross (R, R) * random (0.2, seed = 2), 2.0, 3.0)
+        expected = {}
+        for (i, j, v0, v1) in c:
+            expected[(i, j)] = (v0, v1)
+        for k in range (2):
+            self.assertEqual ([value (c, k) (i, j) for (i, j) in expected],
+                              [v[k] for v in expected.values ()],
+                              'wrong value')
+        self.assertRaises (KeyError, value (c, 0), 60, 0)
+        import gc, weakref
+        from csa import _cache
+        m = connset.ExplicitMask (list (expected))
+        d = cset (m, value (c, 1))
+        self.assertEqual ([x[2] for x in d],
+                          [expected[x[:2]][1] for x in d],
+                          'wrong batch values')
+        state = connset.State ()
+        obj = d.c.startIteration (state)
+        blocks = list (obj.blockIterator (0, 50, 0, 50, state))
+        stores = [weakref.ref (s) for s in state['valueStores'].values ()]
+        del state, obj
+        gc.collect ()
+        self.assertTrue (stores and all (s () == None for s in stores),
+                         'store not freed')
+        self.assertFalse (any (key[0] == 'valueStore'
+                               for key in _cache.cache.entries),
+                          'store cached')
+
+    def test_profile (self):
+        R = (0, 99)
+        v = vset (lambda i, j: i - j)
+        c = cset (cross (R, R) * random (0.2), v)
+        iterator = connset.CSet.iterator
+        call = type (v).__call__
+        p = profile (c)
+        self.assertEqual (p.stats[id (p.root)].connections, len (list (c)),
+                          'wrong number of profiled connections')
+        self.assertEqual (p.stats[id (v)].calls, len (list (c)),
+                          'wrong number of profiled value set calls')
+        self.assertTrue (str (p).startswith ('expression'), 'no report')
+        self.assertTrue (connset.CSet.iterator is iterator
+                         and type (v).__call__ is call,
+                         'instrumentation left in place')
+
+    def test_store (self):
+        import shutil, tempfile
+        R = (0, 99)
+        directory = tempfile.mkdtemp ()
+        self.addCleanup (shutil.rmtree, directory)
+        for (k, c) in enumerate ([cross (R, R) * random (0.2),
+                                  cset (cross (R, R) * random (0.2),
+                                        vset (lambda i, j: i - j), 2.0)]):
+            path = '%s/%d' % (directory, k)
+            store (c, path)
+            s = load (path)
+            self.assertEqual (list (s), list (c), 'wrong stored connections')
+            part = cross ((10, 59), (40, 79))
+            self.assertEqual (list (part * s), list (part * c),
+                              'wrong stored partition')
+
+    def test_optimize (self):
+        from csa import _optimize
+        g = random2d (400)
+        d = euclidMetric2d (g)
+        R = (0, 399)
+        for (c, rule) in [(cross (R, R) * random (0.1) * (disc (0.2) * d),
+                           'fuse random disc'),
+                          (cross ((0, 199), R)
+                           * (random (0.1) * cross ((50, 299), (10, 389))),
+                           'fold cross'),
+                          (cross (R, R) * random (0.5) * random (0.1),
+                           'reorder'),
+                          (shift (3, 4) * (shift (2, 1)
+                                           * (cross (R, R) * random (0.1))),
+                           'merge shifts')]:
+            log = []
+            optimize (c, log)
+            self.assertEqual ([r[0] for r in log], [rule],
+                              'optimizer did not apply %s' % rule)
+            _optimize.enabled = False
+            try:
+                expected = [x for x in c]
+            finally:
+                _optimize.enabled = True
+            self.assertEqual ([x for x in c], expected,
+                              'optimized %s differs' % rule)
+        # neighbours thinned by the random mask
+        R = (0, 1999)
+        c = cross (R, R) * random (0.8) \
+            * (disc (0.005) * euclidMetric2d (random2d (2000)))
+        _optimize.enabled = False
+        try:
+            expected = [x for x in c]
+        finally:
+            _optimize.enabled = True
+        self.assertEqual ([x for x in c], expected,
+                          'fused random disc differs')
+
+
+class TestIntervalSet (TestCSA):
+    def test_algebra (self):
+        a = ival (0, 9) + ival (20, 29)
+        b = ival (5, 24)
+        self.assertEqual ((a * b).intervals, [(5, 9), (20, 24)],
+                          'interval set intersection')
+        self.assertEqual ((a + b).intervals, [(0, 29)],
+                          'interval set union')
+        self.assertEqual ((a - b).intervals, [(0, 4), (25, 29)],
+                          'interval set difference')
+        self.assertEqual ((~a * ival (0, 40)).intervals, [(10, 19), (30, 40)],
+                          'interval set complement')
+
+    def test_queries (self):
+        a = ival (0, 9) + ival (20, 29)
+        self.assertTrue (25 in a and 15 not in a, 'interval set membership')
+        self.assertTrue (15 in ~a and 25 not in ~a,
+                         'complementary interval set membership')
+        self.assertEqual (a.count (5, 25), 10, 'interval set count')
+        self.assertEqual ((~a).count (5, 25), 10,
+                          'complementary interval set count')
+        self.assertEqual (list (a.boundedArray (8, 22)), [8, 9, 20, 21],
+                          'interval set bounded array')
+
+    def test_bulk_queries (self):
+        a = ival (0, 9) + ival (20, 29)
+        indices = numpy.array ([0, 9, 10, 20, 35])
+        self.assertEqual (list (a.contains (indices)),
+                          [True, True, False, True, False],
+                          'bulk interval set membership')
+        self.assertEqual (list ((~a).contains (indices)),
+                          [False, False, True, False, True],
+                          'bulk complementary interval set membership')
+        self.assertEqual (list (a.rank (indices)), [0, 9, 10, 10, 20],
+                          'interval set rank')
+        self.assertEqual (list (a.select ([0, 9, 10, 19])), [0, 9, 20, 29],
+                          'interval set select')
+        self.assertEqual (list ((~a).rank ([10, 19, 30, 35])), [0, 9, 10, 15],
+                          'complementary interval set rank')
+        self.assertEqual (list ((~a).select ([0, 9, 10, 15])), [10, 19, 30, 35],
+                          'complementary interval set select')
+
+
+class TestGeometry (TestCSA):
+    def test_disc (self):
+        for g in [random2d (400), grid2d (20)]:
+            d = euclidMetric2d (g)
+            R = (0, 399)
+            for r in [0.05, 0.3]:
+                self.assertEqual ([x for x in cross (R, R) * (disc (r) * d)],
+                                  [(i, j) for j in range (400)
+                                   for i in range (400) if d (i, j) < r],
+                                  'disc differs from its definition')
+            self.assertEqual ([x for x in cross (R, R)
+                               * (rectangle (0.2, 0.1) * g)],
+                              [(i, j) for j in range (400)
+                               for i in range (400)
+                               if abs (g (i)[0] - g (j)[0]) < 0.1
+                               and abs (g (i)[1] - g (j)[1]) < 0.05],
+                              'rectangle differs from its definition')
+        # blocks are sized by the expected number of candidates
+        blockSize = connset.blockSize
+        self.addCleanup (setattr, connset, 'blockSize', blockSize)
+        connset.blockSize = 2000
+        d = euclidMetric2d (random2d (2000))
+        sizes = [len (b[0]) for b in (disc (0.3) * d).blockIterator (
+                     0, 2000, 0, 2000, connset.State ())]
+        self.assertTrue (max (sizes) < 3 * connset.blockSize,
+                         'disc blocks not bounded')
+
+    def test_arrays (self):
+        i = numpy.arange (100)
+        j = i[::-1]
+        for g in [grid2d (10), random2d (100), grid3d (5), random3d (100)]:
+            d = euclidMetric3d (g) if g.dim == 3 else euclidMetric2d (g)
+            self.assertEqual (list (d (i, j)),
+                              [d (int (a), int (b)) for (a, b) in zip (i, j)],
+                              'metric on arrays differs from scalars')
+            self.assertEqual (g (i[:4]).shape, (4, g.dim),
+                              'geometry on arrays has wrong shape')
+
+    def test_toroid (self):
+        g = grid2d (10)
+        d = euclidToroidMetric2d (g)
+        R = (0, 99)
+        self.assertEqual ([x for x in cross (R, R) * (disc (0.25) * d)],
+                          [(i, j) for j in range (100) for i in range (100)
+                           if d (i, j) < 0.25],
+                          'toroidal disc differs from its definition')
+
+    def test_gaussianCutoff (self):
+        g = random2d (400)
+        d = euclidMetric2d (g)
+        ga = gaussian (0.1, 0.2) * d
+        c = cross ((0, 399), (0, 399)) * (random * ga)
+        for (i, j) in c:
+            self.assertTrue (d (i, j) < 0.2, 'connection beyond cutoff')
+        self.assertEqual ([x for x in c], [x for x in c],
+                          'gaussian random mask is not deterministic')
+
+
+class TestValueSet (TestCSA):
+    def test_evaluate (self):
+        from csa import valueset
+        d = euclidMetric2d (random2d (100))
+        g = gaussian (0.2, 0.5) * d
+        f = valueset.GenericValueSet (lambda i, j: i + 2 * j)
+        i = numpy.arange (100)
+        j = (i * 7) % 100
+        for v in [g, -g, f, 2 * g + 1, (2 * g + 1) * (3 * f - 2),
+                  (2 * g + 1) + (3 * f - 2), g * f, f + d, 5 - g]:
+            self.assertTrue (numpy.allclose (valueset.evaluate (v, i, j),
+                                             [v (a, b) for (a, b)
+                                              in zip (i.tolist (), j.tolist ())],
+                                             rtol = 1e-12),
+                             'array evaluation of %s differs' % v.repr ())
+        c = cset (cross ((0, 9), (0, 9)), g, d)
+        for (a, b, w, delay) in c:
+            self.assertAlmostEqual (w, g (a, b), 12, 'wrong weight')
+            self.assertEqual (delay, d (a, b), 'wrong delay')
+        c = cset (cross ((0, 9), (0, 9)), vset (lambda i, j: 1 if i == j else 0.5))
+        self.assertEqual ([(type (i), type (j), type (v)) for (i, j, v) in c],
+                          [(int, int, int if i == j else float)
+                           for j in range (10) for i in range (10)],
+                          'value types not kept')
+
 
 def main():
     suite = unittest.TestLoader().loadTestsFromTestCase(TestElementary,